@@ -0,0 +1,263 @@
+"""
+FFmpeg capability registry.
+
+Probing ffmpeg means spawning several processes, so we do it once per binary
+and persist the result to disk keyed by the binary's path and mtime. The probe
+only runs again when the binary changes (upgrade, reinstall, different PATH).
+"""
+import json
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+
+from . import metrics
+
+FFMPEG_BINARY = "ffmpeg"
+
+# Options whose value names an encoder/decoder
+CODEC_OPTIONS = {"-c", "-codec", "-c:v", "-c:a", "-c:s", "-vcodec", "-acodec", "-scodec"}
+# Options whose value is a filtergraph
+FILTER_OPTIONS = {"-vf", "-af", "-filter:v", "-filter:a", "-filter_complex", "-lavfi"}
+
+_lock = threading.Lock()
+_resolved_binary = None
+_missing_since = None
+_capabilities = None
+
+# Seconds before looking for a missing ffmpeg binary again
+MISSING_BINARY_RECHECK = 30
+
+
+class FFmpegCapabilities:
+    """What the installed ffmpeg binary can do."""
+
+    def __init__(self, key=None, version="", hwaccels=(), encoders=(), decoders=(), filters=(), muxers=(), demuxers=()):
+        self.key = key or {}
+        self.version = version
+        self.hwaccels = set(hwaccels)
+        self.encoders = set(encoders)
+        self.decoders = set(decoders)
+        self.filters = set(filters)
+        self.muxers = set(muxers)
+        self.demuxers = set(demuxers)
+
+    @property
+    def available(self) -> bool:
+        return bool(self.key)
+
+    @property
+    def has_nvidia_gpu(self) -> bool:
+        # hwaccel can be listed while the NVENC encoder lib is missing, so check both
+        return "cuda" in self.hwaccels and any("nvenc" in e for e in self.encoders)
+
+    def to_dict(self):
+        return {
+            "key": self.key,
+            "version": self.version,
+            "hwaccels": sorted(self.hwaccels),
+            "encoders": sorted(self.encoders),
+            "decoders": sorted(self.decoders),
+            "filters": sorted(self.filters),
+            "muxers": sorted(self.muxers),
+            "demuxers": sorted(self.demuxers),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            key=data.get("key"),
+            version=data.get("version", ""),
+            hwaccels=data.get("hwaccels", ()),
+            encoders=data.get("encoders", ()),
+            decoders=data.get("decoders", ()),
+            filters=data.get("filters", ()),
+            muxers=data.get("muxers", ()),
+            demuxers=data.get("demuxers", ()),
+        )
+
+    def validate_command(self, command_list) -> list:
+        """Returns a list of problems (missing encoders, filters, ...) for a command template."""
+        if not self.available:
+            return []
+
+        problems = []
+        # -f before the last -i names an input format (a demuxer, e.g. lavfi or concat)
+        inputs_end = max((i for i, arg in enumerate(command_list) if arg == "-i"), default=-1)
+        for i, arg in enumerate(command_list[:-1]):
+            value = command_list[i + 1]
+            if "{" in value:
+                # Parameterised values can only be checked once filled in
+                continue
+            if arg in CODEC_OPTIONS and value != "copy" and value not in self.encoders:
+                problems.append(f"encoder '{value}'")
+            elif arg == "-hwaccel" and value != "auto" and value not in self.hwaccels:
+                problems.append(f"hwaccel '{value}'")
+            elif arg == "-f" and i < inputs_end:
+                if value not in self.demuxers:
+                    problems.append(f"demuxer '{value}'")
+            elif arg == "-f" and value not in self.muxers:
+                problems.append(f"muxer '{value}'")
+            elif arg in FILTER_OPTIONS:
+                for name in filter_names(value):
+                    if name not in self.filters:
+                        problems.append(f"filter '{name}'")
+        return problems
+
+
+def filter_names(filtergraph: str) -> list:
+    """Returns the filter names used in a filtergraph string."""
+    names = []
+    for part in re.split(r"[,;]", filtergraph):
+        part = re.sub(r"\[[^\]]*\]", "", part).strip()
+        if part:
+            names.append(part.split("=", 1)[0].strip())
+    return names
+
+
+# =========================
+# Probing
+# =========================
+
+def _run(binary, *args) -> str:
+    metrics.spawned([binary])
+    result = subprocess.run([binary, "-hide_banner", *args], capture_output=True, text=True)
+    return result.stdout
+
+
+def _parse_codecs(output: str) -> list:
+    """Parses `-encoders` / `-decoders` output (entries follow the ' ------' line)."""
+    names = []
+    started = False
+    for line in output.splitlines():
+        if not started:
+            started = line.strip().startswith("------")
+            continue
+        parts = line.split()
+        if len(parts) >= 2:
+            names.append(parts[1])
+    return names
+
+
+def _parse_filters(output: str) -> list:
+    names = []
+    for line in output.splitlines():
+        match = re.match(r"^\s*[TSC.]{2,3}\s+(\S+)\s+\S*->\S*", line)
+        if match:
+            names.append(match.group(1))
+    return names
+
+
+def _parse_formats(output: str, flag: str) -> list:
+    """Parses `-muxers` (flag 'E') / `-demuxers` (flag 'D') output."""
+    names = []
+    started = False
+    for line in output.splitlines():
+        if not started:
+            started = line.strip().startswith("--")
+            continue
+        parts = line.split()
+        if len(parts) >= 2 and flag in parts[0]:
+            names.extend(parts[1].split(","))
+    return names
+
+
+def _parse_hwaccels(output: str) -> list:
+    return [line.strip() for line in output.splitlines()[1:] if line.strip()]
+
+
+def probe_capabilities(binary: str, key: dict) -> FFmpegCapabilities:
+    """Runs the (slow) ffmpeg probes."""
+    version_line = _run(binary, "-version").splitlines()
+    return FFmpegCapabilities(
+        key=key,
+        version=version_line[0] if version_line else "",
+        hwaccels=_parse_hwaccels(_run(binary, "-hwaccels")),
+        encoders=_parse_codecs(_run(binary, "-encoders")),
+        decoders=_parse_codecs(_run(binary, "-decoders")),
+        filters=_parse_filters(_run(binary, "-filters")),
+        muxers=_parse_formats(_run(binary, "-muxers"), "E"),
+        demuxers=_parse_formats(_run(binary, "-demuxers"), "D"),
+    )
+
+
+# =========================
+# Cache
+# =========================
+
+def _cache_path() -> Path:
+    return Path(getattr(settings, "FFMPEG_CAPABILITIES_CACHE", settings.BASE_DIR / ".cache" / "ffmpeg_capabilities.json"))
+
+
+def _binary_key(binary: str):
+    """Identifies the binary by resolved path + mtime, or None if it isn't installed."""
+    global _resolved_binary, _missing_since
+    for attempt in range(2):
+        if _resolved_binary is None:
+            # Searching PATH is a stat per entry, so don't repeat a failed lookup on every call
+            if _missing_since is not None and time.monotonic() - _missing_since < MISSING_BINARY_RECHECK:
+                return None
+            found = shutil.which(binary)
+            if not found:
+                _missing_since = time.monotonic()
+                return None
+            _missing_since = None
+            _resolved_binary = os.path.realpath(found)
+        try:
+            st = os.stat(_resolved_binary)
+            return {"path": _resolved_binary, "mtime": st.st_mtime_ns, "size": st.st_size}
+        except OSError:
+            # Binary moved/removed since we resolved it, look it up again
+            _resolved_binary = None
+    return None
+
+
+def _load_from_disk(key):
+    try:
+        with open(_cache_path(), "r") as f:
+            data = json.load(f)
+        # Caches written before demuxers were probed are probed again
+        if data.get("key") == key and "demuxers" in data:
+            return FFmpegCapabilities.from_dict(data)
+    except (OSError, json.JSONDecodeError, AttributeError):
+        pass
+    return None
+
+
+def _save_to_disk(caps: FFmpegCapabilities):
+    path = _cache_path()
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(caps.to_dict(), f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Could not write ffmpeg capability cache: {e}")
+
+
+def get_capabilities(binary: str = FFMPEG_BINARY) -> FFmpegCapabilities:
+    """Returns the cached capabilities, probing only if the binary changed."""
+    global _capabilities
+    key = _binary_key(binary)
+    if key is None:
+        return FFmpegCapabilities()
+
+    caps = _capabilities
+    if caps is not None and caps.key == key:
+        return caps
+
+    with _lock:
+        if _capabilities is not None and _capabilities.key == key:
+            return _capabilities
+        caps = _load_from_disk(key)
+        if caps is None:
+            caps = probe_capabilities(binary, key)
+            _save_to_disk(caps)
+        _capabilities = caps
+        return caps
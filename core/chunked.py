@@ -0,0 +1,330 @@
+"""
+Chunked (parallel) encoding for long videos.
+
+libx264/libx265 stop scaling after a handful of threads, so one long encode
+leaves most cores idle. Instead we:
+
+1. cut the video stream into chunks at keyframes (stream copy, so the cut is
+   lossless and every chunk starts with a keyframe),
+2. encode the chunks concurrently with the profile's video options, each
+   ffmpeg limited to its share of the cores,
+3. join the encoded chunks with the concat demuxer (stream copy) and mux the
+   audio from the original file in one pass, so audio never has gaps or
+   drift at chunk boundaries and timestamps stay continuous.
+
+Only plain "one input, one output, re-encode the video" commands are
+chunked; anything with trimming, complex filtergraphs, segmenting or
+hardware acceleration runs as a single process as before.
+"""
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+
+from .ffmpeg import ProgressParser, format_eta, with_progress
+from . import metrics, packet_index, scheduler
+
+# Output options that take no value
+FLAG_OPTIONS = {'-an', '-vn', '-sn', '-dn', '-shortest', '-y', '-n', '-nostdin'}
+AUDIO_OPTIONS = ('-c:a', '-codec:a', '-acodec', '-b:a', '-ab', '-q:a', '-aq', '-ar', '-ac', '-af', '-filter:a', '-sample_fmt')
+CONTAINER_OPTIONS = {'-movflags', '-f', '-map_metadata', '-map_chapters', '-brand'}
+# Anything here means the command isn't a plain whole-file encode
+UNCHUNKABLE_OPTIONS = {'-ss', '-to', '-t', '-sseof', '-filter_complex', '-lavfi', '-hwaccel', '-vn', '-stream_loop', '-r'}
+VIDEO_COPY_VALUES = {'copy'}
+
+
+class ChunkedCommand:
+    """A profile command taken apart into the pieces the chunked pipeline needs."""
+
+    def __init__(self, input_path, output_path, video_options, audio_options, container_options, audio):
+        self.input_path = input_path
+        self.output_path = output_path
+        self.video_options = video_options
+        self.audio_options = audio_options
+        self.container_options = container_options
+        self.audio = audio
+
+
+def parse_command(command) -> ChunkedCommand | None:
+    """Splits a resolved ffmpeg command, or returns None if it can't be chunked."""
+    command = list(command)
+    if len(command) < 4 or command.count('-i') != 1:
+        return None
+    if any(arg in UNCHUNKABLE_OPTIONS for arg in command):
+        return None
+    i = command.index('-i')
+    input_path, output_path = command[i + 1], command[-1]
+
+    video, audio, container = [], [], []
+    audio_enabled = True
+    video_codec = None
+    options = command[i + 2:-1]
+    j = 0
+    while j < len(options):
+        arg = options[j]
+        if arg in FLAG_OPTIONS:
+            if arg == '-an':
+                audio_enabled = False
+            elif arg == '-shortest':
+                container.append(arg)
+            j += 1
+            continue
+        value = options[j + 1] if j + 1 < len(options) else None
+        if value is None:
+            return None
+        if arg == '-f' and value == 'segment':
+            return None
+        if arg in ('-c', '-codec'):
+            # "-c copy" copies video too; anything else applies to both streams
+            if value in VIDEO_COPY_VALUES:
+                return None
+            video += ['-c:v', value]
+            audio += ['-c:a', value]
+            video_codec = value
+        elif arg in ('-c:v', '-codec:v', '-vcodec'):
+            video_codec = value
+            video += [arg, value]
+        elif arg == '-map':
+            pass  # Replaced by the pipeline's own mapping
+        elif arg.startswith(AUDIO_OPTIONS):
+            audio += [arg, value]
+        elif arg in CONTAINER_OPTIONS or arg.startswith('-metadata'):
+            container += [arg, value]
+        else:
+            video += [arg, value]
+        j += 2
+
+    if not video_codec or video_codec in VIDEO_COPY_VALUES:
+        return None
+    return ChunkedCommand(input_path, output_path, video, audio, container, audio_enabled)
+
+
+# =========================
+# Planning
+# =========================
+
+def plan_splits(keyframes, duration, chunks, min_chunk=10.0) -> list:
+    """Picks up to chunks-1 keyframe times that divide the video into roughly equal parts."""
+    if chunks < 2 or not duration:
+        return []
+    splits = []
+    candidates = [t for t in keyframes if min_chunk <= t <= duration - min_chunk]
+    for n in range(1, chunks):
+        if not candidates:
+            break
+        target = duration * n / chunks
+        best = min(candidates, key=lambda t: abs(t - target))
+        if not splits or best - splits[-1] >= min_chunk:
+            splits.append(best)
+    return splits
+
+
+def default_workers(cores=None) -> int:
+    """Concurrent chunk encodes: enough that each encoder gets ~8 threads."""
+    configured = getattr(settings, 'CHUNKED_ENCODE_WORKERS', None)
+    if configured:
+        return configured
+    return max((cores or os.cpu_count() or 1) // 8, 1)
+
+
+def should_chunk(command, duration, cores=None) -> bool:
+    """Whether a command is worth chunking on `cores` cores (default: all of them).
+
+    With a single chunk worker the split, sequential encodes and concat are
+    slower than one plain ffmpeg run.
+    """
+    min_duration = getattr(settings, 'CHUNKED_ENCODE_MIN_DURATION', 300)
+    if min_duration is None or not duration or duration < min_duration:
+        return False
+    return default_workers(cores) > 1 and parse_command(command) is not None
+
+
+# =========================
+# Pipeline
+# =========================
+
+class _ChunkRunner:
+    """Runs the chunk encodes with bounded concurrency and aggregates their progress."""
+
+    def __init__(self, commands, durations, workers, ctx=None):
+        self.ctx = ctx
+        self.pending = list(enumerate(commands))
+        self.durations = durations
+        self.workers = workers
+        self.done_time = [0.0] * len(commands)
+        self.processes = {}
+        self.error = None
+        self._lock = threading.Lock()
+
+    def _run_one(self, index, command):
+        parser = ProgressParser(self.durations[index])
+        spawn = with_progress(command)
+        if self.ctx is not None:
+            # The chunk commands already say how many threads to use
+            spawn = self.ctx.prepare(spawn, threads=False)
+        metrics.spawned(spawn)
+        process = subprocess.Popen(
+            spawn, stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, bufsize=1
+        )
+        with self._lock:
+            self.processes[index] = process
+        # stderr is drained in the background so a chatty encoder can't block
+        stderr = []
+        drain = threading.Thread(target=lambda: stderr.extend(process.stderr), daemon=True)
+        drain.start()
+        for line in process.stdout:
+            data = parser.feed(line)
+            if data is not None and data['out_time'] is not None:
+                self.done_time[index] = min(data['out_time'], self.durations[index])
+        usage = scheduler.reap(process)
+        if self.ctx is not None:
+            self.ctx.account(usage)
+        drain.join(timeout=5)
+        with self._lock:
+            self.processes.pop(index, None)
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command, stderr=''.join(stderr[-20:]))
+        self.done_time[index] = self.durations[index]
+
+    def _worker(self):
+        while self.error is None:
+            with self._lock:
+                if not self.pending:
+                    return
+                index, command = self.pending.pop(0)
+            try:
+                self._run_one(index, command)
+            except Exception as e:
+                self.error = self.error or e
+
+    def terminate(self):
+        with self._lock:
+            self.pending.clear()
+            processes = list(self.processes.values())
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+
+    def run(self, on_tick=None, tick=0.5):
+        threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(self.workers)]
+        for t in threads:
+            t.start()
+        try:
+            while any(t.is_alive() for t in threads):
+                time.sleep(tick)
+                if self.error is not None:
+                    self.terminate()
+                if on_tick:
+                    on_tick(sum(self.done_time))
+        except BaseException:
+            self.terminate()
+            raise
+        finally:
+            for t in threads:
+                t.join()
+        if self.error is not None:
+            raise self.error
+
+
+def _read_segment_list(path, tmp_dir) -> list:
+    """(chunk path, duration) pairs from the segment muxer's csv list."""
+    chunks = []
+    with open(path) as f:
+        for line in f:
+            name, start, end = line.strip().rsplit(',', 2)
+            chunks.append((tmp_dir / name, float(end) - float(start)))
+    return chunks
+
+
+def encode(command, duration, ctx=None, workers=None, chunks=None, cores=None) -> dict:
+    """Runs `command` as a chunked parallel encode. Returns stats for logging/benchmarks.
+
+    ctx is an optional jobs.JobContext for progress and cancellation. cores is
+    how many cores the encode may use (default: all of them).
+    """
+    parsed = parse_command(command)
+    if parsed is None:
+        raise ValueError("Command can't be encoded in chunks.")
+    cores = cores or os.cpu_count() or 1
+    workers = workers or default_workers(cores)
+    chunks = chunks or workers * 2  # More chunks than workers evens out uneven chunk costs
+    threads = max(cores // workers, 1)
+    output = Path(parsed.output_path)
+
+    def report(percent, msg, **extra):
+        if ctx is not None:
+            ctx.progress(status='processing', percent=round(percent, 1), msg=msg, **extra)
+            ctx.check_cancelled()
+
+    started = time.monotonic()
+    report(0, "Finding keyframes...")
+    splits = plan_splits(packet_index.keyframe_times(parsed.input_path), duration, chunks)
+    if not splits:
+        raise ValueError("Not enough keyframes to split the video.")
+
+    # Dot-prefixed so the library scanner ignores it
+    tmp_dir = Path(tempfile.mkdtemp(prefix=f".{output.stem}.chunks-", dir=output.parent))
+    try:
+        report(0, f"Splitting into {len(splits) + 1} chunks...")
+        segment_list = tmp_dir / "segments.csv"
+        _run([
+            "ffmpeg", "-y", "-v", "error", "-i", parsed.input_path,
+            "-map", "0:v:0", "-c", "copy", "-f", "segment",
+            # Just before each keyframe, so rounding can't push the cut to the next one
+            "-segment_times", ",".join(f"{max(t - 0.001, 0):.6f}" for t in splits),
+            "-segment_format", "matroska", "-reset_timestamps", "1",
+            "-segment_list", str(segment_list), "-segment_list_type", "csv",
+            str(tmp_dir / "src_%04d.mkv"),
+        ], ctx)
+        pieces = _read_segment_list(segment_list, tmp_dir)
+
+        encoded = [tmp_dir / f"enc_{n:04d}.mkv" for n in range(len(pieces))]
+        commands = [
+            ["ffmpeg", "-y", "-v", "error", "-i", str(src), "-map", "0:v:0",
+             *parsed.video_options, "-threads", str(threads), "-an", str(dst)]
+            for (src, _), dst in zip(pieces, encoded)
+        ]
+        runner = _ChunkRunner(commands, [d for _, d in pieces], workers, ctx)
+        total = sum(d for _, d in pieces) or duration
+        encode_started = time.monotonic()
+
+        def on_tick(done):
+            elapsed = time.monotonic() - encode_started
+            eta = format_eta((total - done) / (done / elapsed)) if done > 0 else "..."
+            report(min(done / total * 95, 95), f"Encoding {len(pieces)} chunks on {workers} workers: {done / total * 100:.1f}%", eta=eta)
+
+        runner.run(on_tick if ctx is not None else None)
+
+        report(95, "Joining chunks...")
+        concat_list = tmp_dir / "concat.txt"
+        concat_list.write_text("".join(f"file '{p.name}'\n" for p in encoded))
+        audio_map = ["-map", "1:a:0?", *parsed.audio_options] if parsed.audio else ["-an"]
+        _run([
+            "ffmpeg", "-y", "-v", "error",
+            "-f", "concat", "-safe", "0", "-i", str(concat_list), "-i", parsed.input_path,
+            "-map", "0:v:0", "-c:v", "copy", *audio_map,
+            *parsed.container_options, str(output),
+        ], ctx)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return {
+        'chunks': len(pieces),
+        'workers': workers,
+        'threads_per_worker': threads,
+        'elapsed': round(time.monotonic() - started, 2),
+    }
+
+
+def _run(command, ctx):
+    if ctx is not None:
+        ctx.run(command, stdin=subprocess.DEVNULL)
+    else:
+        metrics.spawned(command)
+        subprocess.run(command, stdin=subprocess.DEVNULL, check=True)
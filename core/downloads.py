@@ -0,0 +1,461 @@
+"""
+Download manager.
+
+download_video used to start a thread per request, so ten pasted URLs meant
+ten yt-dlp downloads competing for bandwidth and disk, and a URL submitted
+twice was downloaded twice. Downloads are now rows in the database (see
+models.Download) run by a fixed pool of threads:
+
+- at most DOWNLOAD_WORKERS downloads run at once, and at most
+  DOWNLOAD_PER_HOST from the same site
+- a URL that is already queued or running (in any spelling, e.g. youtu.be/X
+  and youtube.com/watch?v=X) joins the existing download and gets its task id
+- yt-dlp fetches DASH/HLS fragments in parallel (DOWNLOAD_FRAGMENTS)
+- downloads interrupted by a restart are requeued, and yt-dlp continues their
+  .part files
+- every finished download is recorded in an archive (models.ArchivedVideo)
+  under its extractor and video id, with the final path and metadata from
+  yt-dlp's info dict; asking for it again is answered at once from disk
+- a download can name a profile to queue as soon as the merged file is
+  ready, so download and transcode run as one pipeline
+
+Claims are an atomic UPDATE that re-checks the limits, so they hold across
+processes (runserver + `manage.py run_workers`) sharing the database.
+"""
+import hashlib
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import Counter
+from pathlib import Path
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import yt_dlp
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, connection, transaction
+from django.db.models import Count, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.lookups import LessThan
+from django.utils import timezone
+
+from . import library, metrics, stream_copy, tracing
+from .globals import PROGRESS_CACHE
+from .jobs import WORKER_ID, enqueue
+from .models import ArchivedVideo, Download
+from .system import pid_alive
+from .utils import COMMAND_REGISTRY, command_kwargs, download_youtube_video
+
+YOUTUBE_HOSTS = {'youtube.com', 'm.youtube.com', 'music.youtube.com', 'youtube-nocookie.com', 'youtu.be'}
+# Path prefixes whose next segment is the video id
+YOUTUBE_ID_PATHS = ('shorts', 'embed', 'live', 'v')
+MAX_KEY_LENGTH = 500
+# How often a running download checks whether it was cancelled
+CANCEL_CHECK_INTERVAL = 2.0
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def canonical(url):
+    """(key, host) for a URL: the key is the same for every spelling of the same video."""
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or '').lower().removeprefix('www.')
+    if host in YOUTUBE_HOSTS:
+        segments = [s for s in parts.path.split('/') if s]
+        video_id = None
+        if host == 'youtu.be':
+            video_id = segments[0] if segments else None
+        elif len(segments) >= 2 and segments[0] in YOUTUBE_ID_PATHS:
+            video_id = segments[1]
+        else:
+            video_id = dict(parse_qsl(parts.query)).get('v')
+        host = 'youtube.com'
+        if video_id:
+            return f"youtube:{video_id}", host
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    key = urlunsplit(((parts.scheme or 'https').lower(), parts.netloc.lower(), parts.path or '/', query, ''))
+    if len(key) > MAX_KEY_LENGTH:
+        key = "sha256:" + hashlib.sha256(key.encode()).hexdigest()
+    return key, host
+
+
+# =========================
+# Queue API
+# =========================
+
+def submit(url, process=None) -> dict:
+    """Queues a download and returns its task: {'task_id', 'duplicate', 'archived', ...}.
+
+    A URL that is already downloading returns that download's task; one that
+    is in the archive is answered straight away. process ({"op", "params"})
+    is queued on the file once it's there.
+    """
+    key, host = canonical(url)
+    entry = archived(key)
+    if entry is not None:
+        return _from_archive(entry, process)
+
+    existing = Download.objects.filter(key=key, status__in=Download.ACTIVE_STATUSES).first()
+    if existing is None:
+        try:
+            with transaction.atomic():
+                download = Download.objects.create(url=url, key=key, host=host, process=process or {})
+        except IntegrityError:
+            # Someone queued the same URL in between
+            existing = Download.objects.filter(key=key, status__in=Download.ACTIVE_STATUSES).first()
+            if existing is None:
+                raise
+    if existing is not None:
+        if process and not existing.process:
+            Download.objects.filter(pk=existing.pk).update(process=process)
+        return {'task_id': str(existing.id), 'duplicate': True, 'archived': False}
+
+    announce_queue()
+    manager = ensure_manager()
+    if manager is not None:
+        manager.wake()
+    return {'task_id': str(download.id), 'duplicate': False, 'archived': False}
+
+
+def _from_archive(entry, process):
+    """Task for a video that's already on disk (plus its processing job, if asked for)."""
+    path = settings.MEDIA_ROOT / entry.path
+    task_id = str(uuid.uuid4())
+    progress = {
+        'status': 'complete',
+        'percent': 100,
+        'msg': 'Already downloaded',
+        'output': path.name,
+        'path': entry.path,
+        'title': entry.title,
+        'archived': True,
+    }
+    if process:
+        try:
+            progress['job_id'] = str(queue_processing(path, process).id)
+        except ValueError as e:
+            progress['msg'] = f"Already downloaded; processing not started: {e}"
+    PROGRESS_CACHE[task_id] = progress
+    response = {'task_id': task_id, 'duplicate': True, 'archived': True, 'output': path.name, 'path': entry.path}
+    if 'job_id' in progress:
+        response['job_id'] = progress['job_id']
+    return response
+
+
+def cancel(download_id) -> bool:
+    """Cancels a queued download immediately, or asks the worker running it to stop."""
+    if Download.objects.filter(pk=download_id, status=Download.STATUS_QUEUED).update(
+            status=Download.STATUS_CANCELLED, finished_at=timezone.now()):
+        PROGRESS_CACHE[str(download_id)] = {'status': 'cancelled', 'msg': 'Cancelled.'}
+        announce_queue()
+        return True
+    return bool(Download.objects.filter(pk=download_id, status=Download.STATUS_RUNNING).update(cancel_requested=True))
+
+
+def download_progress(download: Download) -> dict:
+    """Progress dict for a download, from its database row (used when no live progress is cached)."""
+    if download.status == Download.STATUS_COMPLETE:
+        progress = {'status': 'complete', 'percent': 100, 'msg': 'Download Complete!',
+                    'output': Path(download.output_path).name, 'path': download.output_path}
+        if download.job_id:
+            progress['job_id'] = str(download.job_id)
+        return progress
+    if download.status in (Download.STATUS_FAILED, Download.STATUS_CANCELLED):
+        return {
+            'status': 'error' if download.status == Download.STATUS_FAILED else 'cancelled',
+            'msg': download.error or download.get_status_display(),
+        }
+    if download.status == Download.STATUS_RUNNING:
+        return {'status': 'processing', 'percent': 0, 'msg': 'Downloading...'}
+    return {'status': 'queued', 'percent': 0, 'msg': 'Queued...'}
+
+
+def announce_queue():
+    """Tells every queued download where it stands."""
+    per_host = _setting('DOWNLOAD_PER_HOST', 2)
+    running = Counter(Download.objects.filter(status=Download.STATUS_RUNNING).values_list('host', flat=True))
+    queued = Download.objects.filter(status=Download.STATUS_QUEUED).values_list('pk', 'host')
+    for ahead, (pk, host) in enumerate(queued):
+        if running[host] >= per_host:
+            msg = f"Waiting for a free {host} slot ({ahead} ahead)..."
+        elif ahead:
+            msg = f"Queued ({ahead} ahead)..."
+        else:
+            msg = "Queued, starting shortly..."
+        PROGRESS_CACHE[str(pk)] = {'status': 'queued', 'percent': 0, 'msg': msg}
+
+
+# =========================
+# Archive
+# =========================
+
+def archived(key):
+    """The archive entry for a Download key, if its file is still there."""
+    entry = ArchivedVideo.objects.filter(Q(key=key) | Q(url_key=key)).first()
+    if entry is None:
+        return None
+    if not (settings.MEDIA_ROOT / entry.path).is_file():
+        # Deleted or renamed since: download it again
+        entry.delete()
+        return None
+    return entry
+
+
+def record(download, path, info):
+    """Adds a finished download to the archive."""
+    extractor = (info.get('extractor_key') or 'generic').lower()
+    video_id = info.get('id') or download.key
+    ArchivedVideo.objects.update_or_create(
+        key=f"{extractor}:{video_id}",
+        defaults={
+            'url_key': download.key,
+            'extractor': extractor,
+            'video_id': video_id,
+            'title': (info.get('title') or '')[:512],
+            'path': path.relative_to(settings.MEDIA_ROOT).as_posix(),
+            'info': info,
+            'download': download,
+        },
+    )
+
+
+def queue_processing(path, process):
+    """Queues a profile ({"op", "params"}) on a downloaded file, as process_video would."""
+    cmd_key = process.get('op')
+    compiled = COMMAND_REGISTRY.get(cmd_key)
+    if compiled is None:
+        raise ValueError(f"Unknown operation: {cmd_key}")
+    path = Path(path)
+    source = library.index_file(path)
+    kwargs, output_path, payload = command_kwargs(cmd_key, path, path.stem, source, process.get('params'))
+    problem = library.check_command(compiled, source, kwargs)
+    if problem:
+        raise ValueError(problem)
+
+    command, streams = stream_copy.plan(compiled, compiled.build(**kwargs), source)
+    if streams:
+        payload['stream_copy'] = streams
+    return enqueue(command, profile=cmd_key, input_path=path, output_path=output_path,
+                   kind=compiled.engine, payload=payload)
+
+
+# =========================
+# Running downloads
+# =========================
+
+def _running(**filters):
+    """Number of running downloads (matching filters), as a subquery."""
+    running = (Download.objects.filter(status=Download.STATUS_RUNNING, **filters)
+               .order_by().values('status').annotate(n=Count('pk')).values('n'))
+    return Coalesce(Subquery(running[:1]), 0)
+
+
+def claim_next_download():
+    """Atomically moves the oldest queued download that is within the limits to running."""
+    total = _setting('DOWNLOAD_WORKERS', 3)
+    per_host = _setting('DOWNLOAD_PER_HOST', 2)
+    running = Counter(Download.objects.filter(status=Download.STATUS_RUNNING).values_list('host', flat=True))
+    if sum(running.values()) >= total:
+        return None
+    for pk, host in Download.objects.filter(status=Download.STATUS_QUEUED).values_list('pk', 'host')[:50]:
+        if running[host] >= per_host:
+            continue
+        # The counts are checked again in the UPDATE, in case another worker got there first
+        claimed = Download.objects.filter(
+            LessThan(_running(), total),
+            LessThan(_running(host=host), per_host),
+            pk=pk, status=Download.STATUS_QUEUED,
+        ).update(status=Download.STATUS_RUNNING, worker=WORKER_ID, started_at=timezone.now(), cancel_requested=False)
+        if claimed:
+            return Download.objects.get(pk=pk)
+        return None
+    return None
+
+
+def _finish(download, status, error=''):
+    Download.objects.filter(pk=download.pk).update(status=status, error=error, finished_at=timezone.now())
+    metrics.DOWNLOADS_FINISHED.inc(status=status)
+
+
+def _abandon(download, error):
+    """Fails a download whose run raised, so the row doesn't stay 'running' under a live worker."""
+    print(f"Download {download.pk} failed: {error}")
+    try:
+        _finish(download, Download.STATUS_FAILED, str(error))
+        PROGRESS_CACHE[str(download.pk)] = {'status': 'error', 'msg': str(error)}
+    except Exception as e:
+        print(f"Couldn't record download {download.pk} as failed: {e}")
+
+
+def run_download(download: Download):
+    """Runs one claimed download and records the outcome."""
+    task_id = str(download.id)
+    owner = threading.current_thread()
+    last_check = [time.monotonic()]
+
+    def on_progress(d):
+        now = time.monotonic()
+        if now - last_check[0] < CANCEL_CHECK_INTERVAL:
+            return
+        last_check[0] = now
+        try:
+            cancelled = Download.objects.filter(pk=download.pk, cancel_requested=True).exists()
+        finally:
+            # Fragment downloads report from yt-dlp's own threads
+            if threading.current_thread() is not owner:
+                connection.close()
+        if cancelled:
+            raise yt_dlp.utils.DownloadCancelled("Cancelled by user")
+
+    trace = tracing.Trace()
+    trace.add('queued', download.created_at, timezone.now())
+    PROGRESS_CACHE[task_id] = {'status': 'processing', 'percent': 0, 'msg': 'Starting download...'}
+    try:
+        result = download_youtube_video(download.url, task_id, on_progress, trace)
+    except yt_dlp.utils.DownloadCancelled:
+        _finish(download, Download.STATUS_CANCELLED, "Cancelled by user")
+        PROGRESS_CACHE[task_id] = {'status': 'cancelled', 'msg': 'Cancelled.'}
+        trace.save(task_id, status=Download.STATUS_CANCELLED)
+        return
+    except Exception as e:
+        print(f"Download {task_id} failed: {e}")
+        _finish(download, Download.STATUS_FAILED, str(e))
+        PROGRESS_CACHE[task_id] = {'status': 'error', 'msg': str(e)}
+        trace.save(task_id, status=Download.STATUS_FAILED)
+        return
+
+    if not result:
+        _finish(download, Download.STATUS_FAILED, 'Download failed (Check logs)')
+        PROGRESS_CACHE[task_id] = {'status': 'error', 'msg': 'Download failed (Check logs)'}
+        trace.save(task_id, status=Download.STATUS_FAILED)
+        return
+
+    path = result['path']
+    trace.phase('archive')
+    record(download, path, result['info'])
+    # Probe now, for the library and for the stream-copy planner below
+    trace.phase('index')
+    library.index_file(path)
+    progress = {
+        'status': 'complete',
+        'percent': 100,
+        'msg': 'Download Complete!',
+        'output': path.name,
+        'path': path.relative_to(settings.MEDIA_ROOT).as_posix(),
+        'title': result['info'].get('title'),
+    }
+    # The post-process hook: process may have been added while the download ran
+    process = Download.objects.filter(pk=download.pk).values_list('process', flat=True).first()
+    job = None
+    if process:
+        trace.phase('queue_processing', op=process.get('op'))
+        try:
+            job = queue_processing(path, process)
+            progress['job_id'] = str(job.id)
+        except Exception as e:
+            print(f"Download {task_id}: couldn't queue {process.get('op')}: {e}")
+            progress['msg'] = f"Download Complete! Processing not started: {e}"
+    Download.objects.filter(pk=download.pk).update(
+        status=Download.STATUS_COMPLETE, error='', finished_at=timezone.now(),
+        output_path=progress['path'], job=job,
+    )
+    metrics.DOWNLOADS_FINISHED.inc(status=Download.STATUS_COMPLETE)
+    PROGRESS_CACHE[task_id] = progress
+    trace.save(task_id, status=Download.STATUS_COMPLETE, size=path.stat().st_size if path.exists() else None)
+
+
+def recover_downloads():
+    """Requeues downloads left 'running' by a dead process on this host; yt-dlp resumes their .part files."""
+    host = socket.gethostname()
+    recovered = 0
+    for download in Download.objects.filter(status=Download.STATUS_RUNNING):
+        worker_host, _, pid = download.worker.rpartition(':')
+        if worker_host != host or not pid.isdigit():
+            continue
+        # Our own pid can't be running anything yet: the manager hasn't started
+        if int(pid) != os.getpid() and pid_alive(int(pid)):
+            continue
+        if Download.objects.filter(pk=download.pk, status=Download.STATUS_RUNNING).update(
+                status=Download.STATUS_QUEUED, worker=''):
+            recovered += 1
+            PROGRESS_CACHE[str(download.pk)] = {'status': 'queued', 'percent': 0, 'msg': 'Resuming interrupted download...'}
+    return recovered
+
+
+# =========================
+# Worker pool
+# =========================
+
+class DownloadManager:
+    """A fixed number of threads pulling downloads from the database queue."""
+
+    def __init__(self, workers=3, poll_interval=2.0):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self):
+        recovered = recover_downloads()
+        if recovered:
+            print(f"Resuming {recovered} interrupted download(s)")
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._loop, name=f"download-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self, wait=True):
+        self._stopping.set()
+        self._wake.set()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _loop(self):
+        try:
+            while not self._stopping.is_set():
+                close_old_connections()
+                try:
+                    download = claim_next_download()
+                except Exception as e:
+                    print(f"Download worker error: {e}")
+                    download = None
+                if download is not None:
+                    announce_queue()
+                    try:
+                        run_download(download)
+                    except Exception as e:
+                        # E.g. the database was locked while recording the result
+                        _abandon(download, e)
+                    announce_queue()
+                    # A slot is free: let another worker pick up what was waiting for it
+                    self._wake.set()
+                    continue
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+        finally:
+            connection.close()
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def ensure_manager():
+    """Starts this process's download manager once (unless workers run in a separate process)."""
+    global _manager
+    if _manager is not None or not _setting('JOB_WORKERS_IN_PROCESS', True):
+        return _manager
+    with _manager_lock:
+        if _manager is None:
+            manager = DownloadManager(_setting('DOWNLOAD_WORKERS', 3), _setting('JOB_POLL_INTERVAL', 2.0))
+            manager.start()
+            _manager = manager
+    return _manager
@@ -0,0 +1,278 @@
+"""
+Running ffmpeg with machine-readable progress.
+
+ffmpeg is started with `-progress pipe:1`, which prints blocks of key=value
+lines (out_time_us, fps, speed, total_size, ...) terminated by a
+`progress=continue|end` line. We turn each block into the same progress dict
+the download tasks publish, using ffprobe's duration for the percentage.
+"""
+import glob
+import re
+import subprocess
+from pathlib import Path
+
+from . import metrics
+
+# =========================
+# Probing / time helpers
+# =========================
+
+def probe_duration(path) -> float | None:
+    """Container duration in seconds via ffprobe, or None if unknown."""
+    command = [
+        "ffprobe", "-v", "error", "-show_entries", "format=duration",
+        "-of", "csv=p=0", str(path)
+    ]
+    metrics.spawned(command)
+    try:
+        result = subprocess.run(command, capture_output=True, text=True, check=True)
+        return float(result.stdout.strip())
+    except (subprocess.CalledProcessError, FileNotFoundError, ValueError):
+        return None
+
+
+def parse_time(value) -> float | None:
+    """Parses ffmpeg time syntax ("90", "1:30", "00:01:30.5", "1500ms") into seconds."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    if not value:
+        return None
+    try:
+        if value.endswith("ms"):
+            return float(value[:-2]) / 1000
+        if value.endswith("us"):
+            return float(value[:-2]) / 1_000_000
+        if value.endswith("s"):
+            value = value[:-1]
+        seconds = 0.0
+        for part in value.split(":"):
+            seconds = seconds * 60 + float(part)
+        return seconds
+    except ValueError:
+        return None
+
+
+def format_eta(seconds) -> str:
+    seconds = int(max(seconds, 0))
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60}s"
+    return f"{seconds}s"
+
+
+def expected_duration(command, input_duration) -> float | None:
+    """How much media time the command will produce, accounting for -ss/-to/-t."""
+    start = end = length = None
+    for i, arg in enumerate(command[:-1]):
+        value = command[i + 1]
+        if arg == "-ss":
+            start = parse_time(value)
+        elif arg == "-to":
+            end = parse_time(value)
+        elif arg == "-t":
+            length = parse_time(value)
+
+    if length is not None:
+        duration = length
+    elif end is not None:
+        duration = end - (start or 0)
+    elif input_duration is not None:
+        duration = input_duration - (start or 0)
+    else:
+        return None
+
+    if input_duration is not None:
+        duration = min(duration, input_duration - (start or 0))
+    return duration if duration and duration > 0 else None
+
+
+def with_progress(command) -> list:
+    """Adds progress reporting right after the binary (global options)."""
+    if "-progress" in command:
+        return list(command)
+    return [command[0], "-progress", "pipe:1", "-nostats", *command[1:]]
+
+
+def with_benchmark(command) -> list:
+    """Adds ffmpeg's own profiling right after the binary.
+
+    -benchmark prints CPU time, wall time and max RSS at the end, -benchmark_all
+    the CPU time of every decode/encode call, and verbose logging ends with
+    frame and packet counts for each stream.
+    """
+    return [command[0], "-benchmark", "-benchmark_all", "-loglevel", "verbose", *command[1:]]
+
+
+# =========================
+# Progress parsing
+# =========================
+
+def output_files(outputs) -> list:
+    """Expands output paths; segment patterns like name_%03d.mp4 become globs."""
+    files = []
+    for output in outputs or []:
+        output = str(output)
+        if "%" in output:
+            files.extend(glob.glob(re.sub(r"%0?\d*d", "*", output)))
+        else:
+            files.append(output)
+    return files
+
+
+def outputs_size(outputs) -> int:
+    total = 0
+    for f in output_files(outputs):
+        try:
+            total += Path(f).stat().st_size
+        except OSError:
+            pass
+    return total
+
+
+class ProgressParser:
+    """Accumulates `-progress` key=value lines; feed() returns a snapshot at each block end.
+
+    With per_output, snapshots also list each output's name, size and percent.
+    """
+
+    def __init__(self, duration=None, outputs=None, per_output=False):
+        self.duration = duration
+        self.outputs = outputs or []
+        self.per_output = per_output
+        self._block = {}
+
+    def feed(self, line: str):
+        key, sep, value = line.strip().partition("=")
+        if not sep:
+            return None
+        self._block[key] = value.strip()
+        if key != "progress":
+            return None
+        block, self._block = self._block, {}
+        return self.snapshot(block)
+
+    def snapshot(self, block) -> dict:
+        out_time = None
+        for key in ("out_time_us", "out_time_ms"):  # both are microseconds
+            try:
+                out_time = int(block[key]) / 1_000_000
+                break
+            except (KeyError, ValueError):
+                continue
+
+        try:
+            fps = float(block.get("fps", 0))
+        except ValueError:
+            fps = 0.0
+        try:
+            speed = float(block.get("speed", "").rstrip("x"))
+        except ValueError:
+            speed = None
+
+        # ffmpeg's total_size only covers the first output, so sum every output we know about
+        size = outputs_size(self.outputs) if len(output_files(self.outputs)) > 1 else None
+        if size is None:
+            try:
+                size = int(block.get("total_size", 0))
+            except ValueError:
+                size = 0
+
+        finished = block.get("progress") == "end"
+        percent = 0.0
+        eta = "..."
+        if finished:
+            percent = 100.0
+            eta = "0s"
+        elif self.duration and out_time is not None:
+            percent = min(max(out_time / self.duration * 100, 0.0), 99.9)
+            if speed:
+                eta = format_eta((self.duration - out_time) / speed)
+
+        data = {
+            "percent": round(percent, 1),
+            "fps": round(fps, 1),
+            "speed": speed,
+            "size": size,
+            "eta": eta,
+            "out_time": out_time,
+        }
+        if len(self.outputs) == 1 and "%" in str(self.outputs[0]):
+            data["segments"] = len(output_files(self.outputs))
+        if self.per_output:
+            # Outputs fed by one decode advance together, so they share the percentage
+            data["outputs"] = [
+                {"name": Path(output).name, "size": outputs_size([output]), "percent": data["percent"]}
+                for output in self.outputs
+            ]
+        return data
+
+
+def progress_message(data) -> str:
+    msg = f"Encoding: {data['percent']}%"
+    if data.get("speed"):
+        msg += f" at {data['speed']}x"
+    if data.get("fps"):
+        msg += f", {data['fps']} fps"
+    msg += f", {data['size'] / (1024 * 1024):.1f} MB"
+    if "outputs" in data:
+        msg += f" across {len(data['outputs'])} outputs"
+    if "segments" in data:
+        msg += f", {data['segments']} segment(s)"
+    return msg
+
+
+# =========================
+# Benchmark parsing
+# =========================
+
+BENCH_TOTAL_RE = re.compile(r"bench: utime=([\d.]+)s stime=([\d.]+)s rtime=([\d.]+)s")
+BENCH_RSS_RE = re.compile(r"bench: maxrss=(\d+)\s*[kK]i?B")
+# -benchmark_all: microseconds of user, system and wall time for one call, e.g. "decode_video 0.0"
+BENCH_CALL_RE = re.compile(r"bench:\s*(\d+) user\s+(\d+) sys\s+(\d+) real (\w+)")
+STREAM_STATS_RE = re.compile(r"(Input|Output) stream #(\d+):(\d+) \((\w+)\): (.*)")
+FRAMES_RE = re.compile(r"(\d+) frames (?:decoded|encoded)")
+PACKETS_RE = re.compile(r"(\d+) packets (?:read|muxed) \((\d+) bytes\)")
+
+
+def parse_benchmark(lines) -> dict:
+    """CPU time, max RSS, CPU per decode/encode task and per-stream fps from a with_benchmark() log."""
+    result = {'streams': [], 'tasks': {}}
+    for line in lines:
+        match = BENCH_CALL_RE.search(line)
+        if match:
+            user, system, real, task = match.groups()
+            totals = result['tasks'].setdefault(task, {'cpu': 0.0, 'real': 0.0, 'calls': 0})
+            totals['cpu'] += (int(user) + int(system)) / 1e6
+            totals['real'] += int(real) / 1e6
+            totals['calls'] += 1
+            continue
+        match = BENCH_TOTAL_RE.search(line)
+        if match:
+            result['cpu_user'], result['cpu_system'], result['real'] = (float(v) for v in match.groups())
+            continue
+        match = BENCH_RSS_RE.search(line)
+        if match:
+            result['max_rss_kb'] = int(match.group(1))
+            continue
+        match = STREAM_STATS_RE.search(line)
+        if match:
+            direction, file_index, stream_index, media_type, rest = match.groups()
+            stream = {'stream': f"{'in' if direction == 'Input' else 'out'}#{file_index}:{stream_index}", 'type': media_type}
+            frames = FRAMES_RE.search(rest)
+            packets = PACKETS_RE.search(rest)
+            if frames:
+                stream['frames'] = int(frames.group(1))
+            if packets:
+                stream['packets'], stream['bytes'] = int(packets.group(1)), int(packets.group(2))
+            result['streams'].append(stream)
+
+    for totals in result['tasks'].values():
+        totals['cpu'] = round(totals['cpu'], 3)
+        totals['real'] = round(totals['real'], 3)
+    if result.get('real'):
+        for stream in result['streams']:
+            if 'frames' in stream:
+                stream['fps'] = round(stream['frames'] / result['real'], 1)
+    return result
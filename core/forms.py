@@ -1,3 +1,5 @@
+import json
+
 from django import forms
 
 
@@ -81,3 +83,22 @@ class AddCommandForm(forms.Form):
         'placeholder': 'ffmpeg -i {input} ... {output}',
         'rows': 3
     }))
+    target = forms.CharField(required=False, label="Output Target (JSON)", widget=forms.Textarea(attrs={
+        'class': 'form-control',
+        'placeholder': '{"video": {"codec": "h264"}, "audio": {"codec": "aac"}}',
+        'rows': 2
+    }))
+
+    def clean_target(self):
+        """Optional target streams; sources that already match are stream-copied."""
+        value = self.cleaned_data.get('target', '').strip()
+        if not value:
+            return None
+        try:
+            target = json.loads(value)
+        except json.JSONDecodeError as e:
+            raise forms.ValidationError(f"Invalid JSON: {e}")
+        if not isinstance(target, dict) or set(target) - {'video', 'audio'} or \
+                not all(isinstance(spec, dict) for spec in target.values()):
+            raise forms.ValidationError('Use {"video": {...}, "audio": {...}}.')
+        return target
@@ -1,3 +1,5 @@
-# Simple in-memory cache for task progress
+# Task progress, shared across worker processes (see core/progress.py)
 # Format: { 'task_id': { 'status': 'processing', 'percent': 0, 'eta': '...', 'msg': '...' } }
-PROGRESS_CACHE = {}
+from .progress import get_progress_store
+
+PROGRESS_CACHE = get_progress_store()
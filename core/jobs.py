@@ -0,0 +1,648 @@
+"""
+Persistent background job queue.
+
+Jobs are stored in the database (see models.Job) and executed by a pool of
+worker threads, so long encodes don't run inside the HTTP request. Workers
+claim jobs with an atomic UPDATE, which keeps things correct even when several
+processes (runserver + `manage.py run_workers`) share the same database.
+"""
+import os
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from collections import deque
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .ffmpeg import (
+    ProgressParser, expected_duration, output_files, parse_benchmark, probe_duration, progress_message, with_benchmark,
+    with_progress,
+)
+from .globals import PROGRESS_CACHE
+from . import (
+    chunked, library, metrics, output_cache, pipeline, scheduler, smart_trim, storage, stream_copy, tracing, uploads,
+)
+from .models import Job
+from .system import pid_alive
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# How often a running job re-checks for cancellation and records a heartbeat
+HEARTBEAT_INTERVAL = 2.0
+# A job interrupted this many times (server crashes mid-run) is failed instead of requeued
+MAX_INTERRUPTIONS = 3
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+# =========================
+# Queue API
+# =========================
+
+def enqueue(command, profile="", input_path="", output_path="", priority=0, kind="ffmpeg", payload=None, max_attempts=None) -> Job:
+    """Persists a job and wakes the local worker pool (once the job is committed)."""
+    job = Job.objects.create(
+        kind=kind,
+        profile=profile,
+        command=command,
+        input_path=str(input_path),
+        output_path=str(output_path),
+        payload=payload or {},
+        priority=priority,
+        max_attempts=max_attempts or _setting('JOB_MAX_ATTEMPTS', 2),
+    )
+    transaction.on_commit(lambda: _queued(job))
+    return job
+
+
+def _queued(job):
+    PROGRESS_CACHE[str(job.id)] = {
+        'status': 'queued',
+        'percent': 0,
+        'msg': 'Queued...'
+    }
+    ensure_worker_pool()
+    if _pool is not None:
+        _pool.wake()
+
+
+def cancel_job(job_id) -> bool:
+    """Cancels a queued job immediately, or asks the worker running it to stop."""
+    if Job.objects.filter(pk=job_id, status=Job.STATUS_QUEUED).update(
+            status=Job.STATUS_CANCELLED, finished_at=timezone.now()):
+        output_cache.job_finished(job_id, Job.STATUS_CANCELLED)
+        PROGRESS_CACHE[str(job_id)] = {'status': 'cancelled', 'msg': 'Cancelled.'}
+        return True
+    return bool(Job.objects.filter(pk=job_id, status=Job.STATUS_RUNNING).update(cancel_requested=True))
+
+
+def requeue(job_id) -> bool:
+    """Queues a failed job again with fresh attempts, e.g. an upload's job once the upload finishes."""
+    if not Job.objects.filter(pk=job_id, status=Job.STATUS_FAILED).update(
+            status=Job.STATUS_QUEUED, attempts=0, error='', worker='', finished_at=None):
+        return False
+    PROGRESS_CACHE[str(job_id)] = {'status': 'queued', 'percent': 0, 'msg': 'Queued...'}
+    ensure_worker_pool()
+    if _pool is not None:
+        _pool.wake()
+    return True
+
+
+def job_progress(job: Job) -> dict:
+    """Progress dict for a job, from its database row (used when no live progress is cached)."""
+    if job.status == Job.STATUS_COMPLETE:
+        return {'status': 'complete', 'percent': 100, 'msg': 'Processing Complete!', **job.result}
+    if job.status in (Job.STATUS_FAILED, Job.STATUS_CANCELLED):
+        return {'status': 'error' if job.status == Job.STATUS_FAILED else 'cancelled', 'msg': job.error or job.get_status_display()}
+    if job.status == Job.STATUS_RUNNING:
+        return {'status': 'processing', 'percent': 0, 'msg': 'Processing...'}
+    return {'status': 'queued', 'percent': 0, 'msg': 'Queued...'}
+
+
+# =========================
+# Running jobs
+# =========================
+
+class JobContext:
+    """Handed to job handlers: runs subprocesses with cancellation and heartbeats."""
+
+    def __init__(self, job: Job, grant=None):
+        self.job = job
+        self.task_id = str(job.id)
+        self.profile = job.profile or job.kind
+        self._last_check = 0.0
+        # What the scheduler admitted the job with, and what its processes used
+        self.grant = grant
+        self.usage = {'cpu': 0.0, 'max_rss_kb': 0}
+        self.media_seconds = 0.0
+        # Phases and subprocess runs, saved under the job id (core/tracing.py)
+        self.trace = tracing.Trace()
+        # Run ffmpeg with its own profiling and attach the figures to the trace
+        self.benchmark = job.payload.get('benchmark', _setting('TRACE_FFMPEG_BENCHMARK', False))
+
+    def prepare(self, command, outputs=None, threads=True) -> list:
+        """The command to spawn: the grant's thread count and nice/ionice levels applied."""
+        return scheduler.prepare(command, self.grant, outputs, threads)
+
+    def account(self, usage):
+        """Adds a finished process's resource usage (from scheduler.reap) to the job's."""
+        if usage:
+            self.usage['cpu'] += usage['cpu']
+            self.usage['max_rss_kb'] = max(self.usage['max_rss_kb'], usage['max_rss_kb'])
+
+    def progress(self, **data):
+        PROGRESS_CACHE[self.task_id] = data
+
+    def check_cancelled(self, force=False):
+        """Records a heartbeat and raises JobCancelled if cancellation was requested."""
+        now = time.monotonic()
+        if not force and now - self._last_check < HEARTBEAT_INTERVAL:
+            return
+        self._last_check = now
+        Job.objects.filter(pk=self.job.pk).update(heartbeat_at=timezone.now())
+        if Job.objects.filter(pk=self.job.pk, cancel_requested=True).exists():
+            raise JobCancelled()
+
+    def run(self, command, **popen_kwargs):
+        """Runs a command to completion, killing it if the job is cancelled."""
+        spawn = self.prepare(command, threads=False)
+        metrics.spawned(spawn)
+        with self.trace.span(Path(command[0]).name) as attrs:
+            process = subprocess.Popen(spawn, **popen_kwargs)
+            try:
+                while True:
+                    try:
+                        usage = scheduler.reap(process, timeout=HEARTBEAT_INTERVAL)
+                        break
+                    except subprocess.TimeoutExpired:
+                        self.check_cancelled()
+            except BaseException:
+                _terminate(process)
+                raise
+            self.account(usage)
+            _usage_attrs(attrs, usage)
+            if process.returncode != 0:
+                raise subprocess.CalledProcessError(process.returncode, command)
+        return process.returncode
+
+    def run_ffmpeg(self, command, duration=None, outputs=None, per_output=False, span=None, label=None, stdin=None):
+        """Runs ffmpeg with -progress output, publishing percent/fps/speed/size/ETA as it goes.
+
+        span=(low, high) maps this run's 0-100% onto part of the job (one stage of several).
+        stdin is an optional iterable of bytes fed to ffmpeg's stdin from a thread.
+        """
+        parser = ProgressParser(duration, outputs, per_output)
+        self.media_seconds += duration or 0
+        spawn = with_progress(with_benchmark(command) if self.benchmark else command)
+        spawn = self.prepare(spawn, outputs)
+        metrics.spawned(spawn)
+        # The benchmark log goes to a file: -benchmark_all writes a line per frame
+        log = tempfile.TemporaryFile(mode='w+', errors='replace') if self.benchmark else None
+        try:
+            with self.trace.span('ffmpeg', label=label or self.profile, media_seconds=duration) as attrs:
+                process = subprocess.Popen(
+                    spawn,
+                    stdin=subprocess.DEVNULL if stdin is None else subprocess.PIPE,
+                    stdout=subprocess.PIPE, stderr=log, text=True, bufsize=1
+                )
+                if stdin is not None:
+                    threading.Thread(target=_feed, args=(process, stdin), name=f"job-{self.task_id}-stdin", daemon=True).start()
+                last, usage = self._follow(process, parser, span, label)
+                _usage_attrs(attrs, usage)
+                if last is not None:
+                    attrs.update(fps=last['fps'], speed=last['speed'], size=last['size'])
+                if log is not None:
+                    log.seek(0)
+                    attrs['benchmark'] = parse_benchmark(log)
+                    if process.returncode != 0:
+                        # stderr didn't reach the console, so show how it ended
+                        log.seek(0)
+                        print(f"Job {self.task_id}: ffmpeg failed:\n{''.join(deque(log, maxlen=20))}")
+                if process.returncode != 0:
+                    raise subprocess.CalledProcessError(process.returncode, command)
+        finally:
+            if log is not None:
+                log.close()
+        return process.returncode
+
+    def _follow(self, process, parser, span, label):
+        """Publishes ffmpeg's progress until it exits. Returns (last progress snapshot, resource usage)."""
+        last = None
+        try:
+            # ffmpeg writes a progress block about twice a second
+            for line in process.stdout:
+                data = parser.feed(line)
+                if data is not None:
+                    last = data
+                    metrics.ENCODE_FPS.set(data['fps'], profile=self.profile)
+                    if data['speed'] is not None:
+                        metrics.ENCODE_SPEED.set(data['speed'], profile=self.profile)
+                    msg = progress_message(data)
+                    if span is not None:
+                        data['percent'] = round(span[0] + data['percent'] * (span[1] - span[0]) / 100, 1)
+                    if label:
+                        msg = f"{label}: {msg}"
+                    self.progress(status='processing', msg=msg, **data)
+                self.check_cancelled()
+            usage = scheduler.reap(process)
+            self.account(usage)
+        except BaseException:
+            _terminate(process)
+            raise
+        finally:
+            process.stdout.close()
+        return last, usage
+
+
+def _usage_attrs(attrs, usage):
+    """Adds a process's CPU time and peak RSS (from scheduler.reap) to span attrs."""
+    if usage:
+        attrs['cpu'] = round(usage['cpu'], 3)
+        attrs['max_rss_mb'] = round(usage['max_rss_kb'] / 1024, 1)
+
+
+def _feed(process, chunks):
+    """Writes chunks to a process's stdin, closing it at the end (or when the process exits)."""
+    pipe = process.stdin.buffer
+    try:
+        for chunk in chunks:
+            pipe.write(chunk)
+    except BrokenPipeError:
+        pass  # ffmpeg exited; its return code says why
+    except Exception as e:
+        # The source failed; ffmpeg sees its input end early
+        print(f"Feeding {process.args[0]} stopped: {e}")
+    finally:
+        try:
+            pipe.close()
+        except OSError:
+            pass
+
+
+def _terminate(process, grace=5):
+    if process.poll() is not None:
+        return
+    process.terminate()
+    try:
+        process.wait(timeout=grace)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def run_ffmpeg_job(job: Job, ctx: JobContext) -> dict:
+    ctx.trace.phase('probe')
+    ctx.progress(status='processing', percent=0, msg=f"Probing {Path(job.input_path).name}...")
+    duration = expected_duration(job.command, probe_duration(job.input_path)) if job.input_path else None
+    outputs = job.payload.get('outputs') or [job.output_path]
+    result = {'output': job.output_path}
+    # Which streams the planner chose to copy rather than re-encode (core/stream_copy.py)
+    if job.payload.get('stream_copy'):
+        result['stream_copy'] = job.payload['stream_copy']
+        ctx.progress(status='processing', percent=0, msg=f"Starting ({stream_copy.describe(job.payload['stream_copy'])})...")
+
+    ctx.trace.phase('encode')
+    # Long whole-file encodes are split at keyframes and encoded on several cores,
+    # when the scheduler granted enough of them for more than one chunk worker
+    cores = ctx.grant.threads if ctx.grant else None
+    use_chunks = job.payload.get('chunked', chunked.should_chunk(job.command, duration, cores))
+    stats = None
+    if use_chunks and chunked.parse_command(job.command) is not None:
+        try:
+            stats = chunked.encode(job.command, duration, ctx, cores=cores)
+            ctx.media_seconds += duration or 0
+        except ValueError as e:
+            print(f"Chunked encode not possible for {job.input_path}: {e}")
+    if stats is not None:
+        result['chunked'] = stats
+        ctx.trace.phase('encode', chunked=stats)
+    else:
+        ctx.run_ffmpeg(job.command, duration=duration, outputs=outputs)
+    return {**result, 'outputs': output_files(outputs)}
+
+
+def run_smart_trim_job(job: Job, ctx: JobContext) -> dict:
+    """Frame-accurate trim re-encoding only the edge GOPs; falls back to the plain command."""
+    ctx.trace.phase('probe')
+    ctx.progress(status='processing', percent=0, msg="Finding keyframes...")
+    start, end = smart_trim.cut_points(job.command)
+    entry = library.index_file(job.input_path)
+    ctx.trace.phase('smart_trim')
+    stats = smart_trim.trim(job.input_path, job.output_path, start, end, entry, ctx)
+    if stats is None:
+        return run_ffmpeg_job(job, ctx)
+    return {'output': job.output_path, 'outputs': [job.output_path], 'smart_trim': stats}
+
+
+def run_multi_output_job(job: Job, ctx: JobContext) -> dict:
+    """One decode fanned out to several profiles' outputs (see core/multi_output.py)."""
+    ctx.trace.phase('probe')
+    ctx.progress(status='processing', percent=0, msg=f"Probing {Path(job.input_path).name}...")
+    duration = probe_duration(job.input_path)
+    outputs = job.payload['outputs']
+    ctx.trace.phase('encode', outputs=len(outputs))
+    ctx.run_ffmpeg(job.command, duration=duration, outputs=outputs, per_output=True)
+    return {
+        'output': job.output_path, 'outputs': output_files(outputs), 'profiles': job.payload.get('profiles', []),
+        'stream_copy': job.payload.get('stream_copy', {}),
+    }
+
+
+def run_pipeline_job(job: Job, ctx: JobContext) -> dict:
+    """Runs a pipeline's fused stages in order (see core/pipeline.py)."""
+    steps = pipeline.load_steps(job.payload['steps'])
+    stages = len(pipeline.fuse(steps))
+    source_size = Path(job.input_path).stat().st_size
+    with pipeline.intermediate_dir(job.output_path, source_size, stages) as tmp_dir:
+        commands = pipeline.plan(steps, job.input_path, job.output_path, tmp_dir)
+        for n, command in enumerate(commands):
+            ctx.trace.phase(f"stage {n + 1}")
+            stage_input = command[command.index('-i') + 1]
+            ctx.progress(status='processing', percent=round(n * 100 / len(commands), 1), msg=f"Stage {n + 1}/{len(commands)}: probing...")
+            duration = expected_duration(command, probe_duration(stage_input))
+            ctx.run_ffmpeg(
+                command, duration=duration, outputs=[command[-1]],
+                span=(n * 100 / len(commands), (n + 1) * 100 / len(commands)),
+                label=f"Stage {n + 1}/{len(commands)}" if len(commands) > 1 else None,
+            )
+    outputs = job.payload.get('outputs') or [job.output_path]
+    return {'output': job.output_path, 'outputs': output_files(outputs), 'stages': len(commands)}
+
+
+def run_upload_stream_job(job: Job, ctx: JobContext) -> dict:
+    """Transcodes an upload while it arrives by piping it into ffmpeg (see core/uploads.py).
+
+    Sources ffmpeg can't read from a pipe (e.g. MP4 with the index at the end)
+    and uploads that stall are run again from the finished file instead. If
+    the upload then stops arriving the job fails rather than hold a worker;
+    finishing the upload later queues it again (views.upload_session).
+    """
+    session = uploads.UploadSession.get(job.payload['upload'])
+    if session is None and not Path(job.input_path).is_file():
+        raise uploads.UploadError("The upload was abandoned.")
+    outputs = job.payload.get('outputs') or [job.output_path]
+    piped = False
+    if session is not None and session.status == uploads.STATUS_UPLOADING:
+        follower = uploads.Follower(session)
+        ctx.trace.phase('encode_streaming')
+        ctx.progress(status='processing', percent=0, msg="Transcoding as the upload arrives...")
+        try:
+            ctx.run_ffmpeg(job.command, outputs=outputs, label="Streaming from upload", stdin=follower)
+            piped = follower.error is None
+        except subprocess.CalledProcessError as e:
+            print(f"Piped transcode of {job.input_path} failed ({e}); using the finished upload")
+
+    if not piped:
+        if session is not None:
+            ctx.trace.phase('wait_upload')
+            ctx.progress(status='processing', percent=0, msg="Waiting for the upload to finish...")
+            uploads.wait_until_complete(session, ctx.check_cancelled)
+        command = list(job.command)
+        command[command.index('-i') + 1] = job.input_path
+        ctx.trace.phase('probe')
+        duration = expected_duration(command, probe_duration(job.input_path))
+        ctx.trace.phase('encode')
+        ctx.run_ffmpeg(command, duration=duration, outputs=outputs)
+    return {'output': job.output_path, 'outputs': output_files(outputs), 'piped': piped}
+
+
+# kind -> handler(job, ctx) returning the job's result dict. Handlers write to
+# the staged paths in job.command/output_path/payload; execute_job moves the
+# results into place and indexes them (see core/storage.py).
+JOB_HANDLERS = {
+    'ffmpeg': run_ffmpeg_job,
+    'smart_trim': run_smart_trim_job,
+    'multi': run_multi_output_job,
+    'pipeline': run_pipeline_job,
+    'upload_stream': run_upload_stream_job,
+}
+
+
+def claim_next_job(sched=None):
+    """Atomically moves the highest-priority queued job that the scheduler admits to running.
+
+    Returns (job, grant), or (None, None) when nothing can start now.
+    """
+    queued = Job.objects.filter(status=Job.STATUS_QUEUED)
+    candidates = list(queued.only('pk', 'kind', 'profile', 'command', 'priority', 'created_at')[:5])
+    waiting = queued.count() if sched is not None and candidates else 0
+    starving = timedelta(seconds=_setting('SCHEDULER_STARVATION_WAIT', 120))
+    for candidate in candidates:
+        grant = None
+        if sched is not None:
+            grant, reason = sched.admit(candidate, waiting)
+            if grant is None:
+                PROGRESS_CACHE[str(candidate.pk)] = {'status': 'queued', 'percent': 0, 'msg': f"Queued: {reason}..."}
+                # Smaller jobs may go first, but not forever
+                if timezone.now() - candidate.created_at > starving:
+                    return None, None
+                continue
+        now = timezone.now()
+        claimed = Job.objects.filter(pk=candidate.pk, status=Job.STATUS_QUEUED).update(
+            status=Job.STATUS_RUNNING,
+            worker=WORKER_ID,
+            attempts=F('attempts') + 1,
+            started_at=now,
+            heartbeat_at=now,
+            cancel_requested=False,
+        )
+        if claimed:
+            return Job.objects.get(pk=candidate.pk), grant
+        if grant is not None:
+            sched.release(grant, learn=False)
+    return None, None
+
+
+def execute_job(job: Job, grant=None, sched=None):
+    """Runs one claimed job and records the outcome (complete, retry, failed, cancelled)."""
+    ctx = JobContext(job, grant)
+    task_id = str(job.id)
+    handler = JOB_HANDLERS.get(job.kind)
+    succeeded = False
+    started = time.monotonic()
+    outcome = Job.STATUS_FAILED
+    ctx.trace.add('queued', job.created_at, timezone.now(), attempt=job.attempts)
+    if job.input_path:
+        storage.touch(job.input_path)
+    # Outputs are written under temporary names and only renamed into place on success
+    staging = storage.Staging(job)
+    try:
+        if handler is None:
+            raise ValueError(f"Unknown job kind: {job.kind}")
+        staging.apply()
+        result = handler(job, ctx) or {}
+        ctx.trace.phase('publish')
+        result = staging.commit(result)
+        ctx.trace.phase('index')
+        library.index_outputs(result.get('outputs') or [])
+        succeeded = True
+        outcome = Job.STATUS_COMPLETE
+        if grant is not None:
+            result['scheduler'] = {
+                **grant.as_dict(),
+                'cpu_seconds': round(ctx.usage['cpu'], 2),
+                'peak_rss_mb': round(ctx.usage['max_rss_kb'] / 1024, 1),
+            }
+    except JobCancelled:
+        outcome = Job.STATUS_CANCELLED
+        Job.objects.filter(pk=job.pk).update(status=Job.STATUS_CANCELLED, finished_at=timezone.now(), error="Cancelled by user")
+        output_cache.job_finished(job.pk, Job.STATUS_CANCELLED)
+        PROGRESS_CACHE[task_id] = {'status': 'cancelled', 'msg': 'Cancelled.'}
+        metrics.JOBS_FINISHED.inc(profile=ctx.profile, status=Job.STATUS_CANCELLED)
+        return
+    except Exception as e:
+        print(f"Job {task_id} failed: {e}")
+        # A stalled upload isn't worth retrying now: finishing it requeues the job
+        if job.attempts < job.max_attempts and not isinstance(e, uploads.UploadIncomplete):
+            outcome = 'retrying'
+            Job.objects.filter(pk=job.pk).update(status=Job.STATUS_QUEUED, error=str(e), worker='')
+            PROGRESS_CACHE[task_id] = {
+                'status': 'queued',
+                'percent': 0,
+                'msg': f"Retrying (attempt {job.attempts + 1}/{job.max_attempts})..."
+            }
+        else:
+            Job.objects.filter(pk=job.pk).update(status=Job.STATUS_FAILED, error=str(e), finished_at=timezone.now())
+            output_cache.job_finished(job.pk, Job.STATUS_FAILED)
+            PROGRESS_CACHE[task_id] = {'status': 'error', 'msg': f"Processing failed: {e}"}
+            metrics.JOBS_FINISHED.inc(profile=ctx.profile, status=Job.STATUS_FAILED)
+        return
+    finally:
+        if not succeeded:
+            staging.discard()
+        if sched is not None and grant is not None:
+            # Only complete runs say what the profile costs
+            sched.release(grant, ctx.usage, ctx.media_seconds, learn=succeeded)
+        ctx.trace.save(task_id, status=outcome, cpu_seconds=round(ctx.usage['cpu'], 3),
+                       peak_rss_mb=round(ctx.usage['max_rss_kb'] / 1024, 1))
+
+    Job.objects.filter(pk=job.pk).update(status=Job.STATUS_COMPLETE, result=result, error='', finished_at=timezone.now())
+    output_cache.job_finished(job.pk, Job.STATUS_COMPLETE, result.get('outputs'))
+    PROGRESS_CACHE[task_id] = {
+        'status': 'complete',
+        'percent': 100,
+        'msg': 'Processing Complete!',
+        **result
+    }
+    metrics.JOBS_FINISHED.inc(profile=ctx.profile, status=Job.STATUS_COMPLETE)
+    metrics.JOB_DURATION.observe(time.monotonic() - started, profile=ctx.profile)
+    metrics.JOB_MEDIA_SECONDS.inc(ctx.media_seconds, profile=ctx.profile)
+    # New outputs may have pushed a folder over its quota
+    storage.wake()
+
+
+def _abandon(job: Job, error):
+    """Fails a job whose outcome couldn't be recorded, so it doesn't stay 'running' under a live worker."""
+    print(f"Job {job.pk} failed: {error}")
+    try:
+        Job.objects.filter(pk=job.pk, status=Job.STATUS_RUNNING).update(
+            status=Job.STATUS_FAILED, error=str(error), finished_at=timezone.now())
+        output_cache.job_finished(job.pk, Job.STATUS_FAILED)
+        PROGRESS_CACHE[str(job.pk)] = {'status': 'error', 'msg': f"Processing failed: {error}"}
+    except Exception as e:
+        print(f"Couldn't record job {job.pk} as failed: {e}")
+
+
+def recover_jobs():
+    """Requeues jobs left 'running' by a process that died."""
+    host = socket.gethostname()
+    stale_before = timezone.now() - timedelta(seconds=_setting('JOB_STALE_AFTER', 60))
+    recovered = 0
+    for job in Job.objects.filter(status=Job.STATUS_RUNNING):
+        job_host, _, pid = job.worker.rpartition(':')
+        if job_host == host and pid.isdigit():
+            # Our own pid can't be running anything yet: the pool hasn't started
+            dead = int(pid) == os.getpid() or not pid_alive(int(pid))
+        else:
+            dead = job.heartbeat_at is None or job.heartbeat_at < stale_before
+        if not dead:
+            continue
+
+        interruptions = job.result.get('interruptions', 0) + 1
+        if interruptions > MAX_INTERRUPTIONS:
+            Job.objects.filter(pk=job.pk, status=Job.STATUS_RUNNING).update(
+                status=Job.STATUS_FAILED, error="Interrupted too many times", finished_at=timezone.now())
+            continue
+        # The interrupted run doesn't count against the job's retry budget
+        recovered += Job.objects.filter(pk=job.pk, status=Job.STATUS_RUNNING).update(
+            status=Job.STATUS_QUEUED,
+            worker='',
+            attempts=F('attempts') - 1,
+            result={**job.result, 'interruptions': interruptions},
+        )
+    return recovered
+
+
+# =========================
+# Worker pool
+# =========================
+
+class WorkerPool:
+    """A fixed number of threads pulling jobs from the database queue."""
+
+    def __init__(self, workers=2, poll_interval=2.0):
+        # Upper bound on concurrent jobs; the scheduler admits fewer when the machine is busy
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.scheduler = scheduler.Scheduler(workers) if _setting('SCHEDULER_ENABLED', True) else None
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self):
+        recovered = recover_jobs()
+        if recovered:
+            print(f"Recovered {recovered} interrupted job(s)")
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._loop, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def wake(self):
+        self._wake.set()
+
+    def join(self):
+        """Blocks until the pool is stopped (interruptible with Ctrl+C)."""
+        while not self._stopping.wait(1.0):
+            pass
+
+    def stop(self, wait=True):
+        self._stopping.set()
+        self._wake.set()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _loop(self):
+        try:
+            while not self._stopping.is_set():
+                close_old_connections()
+                try:
+                    job, grant = claim_next_job(self.scheduler)
+                except Exception as e:
+                    print(f"Job worker error: {e}")
+                    job = None
+                if job is not None:
+                    try:
+                        execute_job(job, grant, self.scheduler)
+                    except Exception as e:
+                        # Recording the outcome failed (e.g. the database was locked)
+                        _abandon(job, e)
+                    # Resources were freed: let idle workers look at the queue again
+                    self._wake.set()
+                    continue
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+        finally:
+            connection.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def ensure_worker_pool():
+    """Starts this process's worker pool once (unless workers run in a separate process)."""
+    global _pool
+    if _pool is not None or not _setting('JOB_WORKERS_IN_PROCESS', True):
+        return _pool
+    with _pool_lock:
+        if _pool is None:
+            pool = WorkerPool(_setting('JOB_WORKERS', 2), _setting('JOB_POLL_INTERVAL', 2.0))
+            pool.start()
+            _pool = pool
+    storage.ensure_janitor()
+    return _pool
@@ -0,0 +1,330 @@
+"""
+Media library metadata index.
+
+Every library file gets a MediaFile row holding its ffprobe metadata. The
+row is keyed by (path, size, mtime), so a rescan only probes files that are
+new or changed. A folder whose own mtime hasn't changed since the last scan
+can't have gained or lost files, so it isn't listed again.
+"""
+import hashlib
+import json
+import subprocess
+import threading
+from datetime import datetime
+from pathlib import Path
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.utils import timezone
+
+from .ffmpeg import output_files, parse_time
+from .models import MediaFile
+from . import metrics, thumbnails
+
+# (folder under MEDIA_ROOT, source label shown in the UI)
+MEDIA_FOLDERS = [
+    ("yt_videos", "YouTube"),
+    ("local_videos", "Local"),
+    ("download", "Processed"),
+]
+
+VALID_EXTENSIONS = {'.mp4', '.mkv', '.avi', '.webm', '.mov', '.flv', '.wav', '.mp3', '.aac', '.m4a'}
+
+# Bytes hashed from each sampled region for the content fingerprint
+FINGERPRINT_CHUNK = 1 << 20
+
+# folder -> directory mtime at the last scan (per process)
+_scanned_dirs = {}
+_scan_lock = threading.Lock()
+_prober = None
+_prober_lock = threading.Lock()
+
+
+def relative_path(path: Path) -> str:
+    return str(Path(path).relative_to(settings.MEDIA_ROOT)).replace('\\', '/')
+
+
+# =========================
+# Probing
+# =========================
+
+def _parse_rate(rate) -> float | None:
+    try:
+        num, _, den = str(rate).partition('/')
+        value = float(num) / float(den or 1)
+        return value or None
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+def probe_media(path) -> dict | None:
+    """Runs ffprobe and returns the fields stored on MediaFile, or None if it isn't media."""
+    command = [
+        "ffprobe", "-v", "error", "-show_format", "-show_streams", "-of", "json", str(path)
+    ]
+    metrics.spawned(command)
+    try:
+        result = subprocess.run(command, capture_output=True, text=True, check=True)
+        data = json.loads(result.stdout or "{}")
+    except (subprocess.CalledProcessError, FileNotFoundError, json.JSONDecodeError):
+        return None
+
+    fmt = data.get('format', {})
+    streams = []
+    info = {
+        'duration': None,
+        'format_name': fmt.get('format_name', '')[:128],
+        'bit_rate': int(fmt['bit_rate']) if str(fmt.get('bit_rate', '')).isdigit() else None,
+        'video_codec': '', 'audio_codec': '',
+        'width': None, 'height': None, 'frame_rate': None,
+        'has_video': False, 'has_audio': False,
+    }
+    try:
+        info['duration'] = float(fmt['duration'])
+    except (KeyError, ValueError):
+        pass
+
+    for s in data.get('streams', []):
+        codec_type = s.get('codec_type')
+        # Cover art shows up as a one-frame "video" stream
+        attached_pic = s.get('disposition', {}).get('attached_pic') == 1
+        streams.append({
+            'index': s.get('index'),
+            'type': codec_type,
+            'codec': s.get('codec_name', ''),
+            'profile': s.get('profile', ''),
+            'level': s.get('level'),
+            'pix_fmt': s.get('pix_fmt', ''),
+            'width': s.get('width'),
+            'height': s.get('height'),
+            'frame_rate': _parse_rate(s.get('avg_frame_rate')),
+            'channels': s.get('channels'),
+            'sample_rate': s.get('sample_rate'),
+            'bit_rate': int(s['bit_rate']) if str(s.get('bit_rate', '')).isdigit() else None,
+            'attached_pic': attached_pic,
+        })
+        if codec_type == 'video' and not attached_pic and not info['has_video']:
+            info.update(
+                has_video=True,
+                video_codec=s.get('codec_name', ''),
+                width=s.get('width'),
+                height=s.get('height'),
+                frame_rate=_parse_rate(s.get('avg_frame_rate')) or _parse_rate(s.get('r_frame_rate')),
+            )
+        elif codec_type == 'audio' and not info['has_audio']:
+            info.update(has_audio=True, audio_codec=s.get('codec_name', ''))
+    info['streams'] = streams
+    return info
+
+
+def fingerprint(path, size=None) -> str:
+    """Fast content fingerprint: file size plus hashes of the first, middle and last MiB."""
+    path = Path(path)
+    if size is None:
+        size = path.stat().st_size
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(size).encode())
+    with open(path, 'rb') as f:
+        for offset in sorted({0, max(size // 2 - FINGERPRINT_CHUNK // 2, 0), max(size - FINGERPRINT_CHUNK, 0)}):
+            f.seek(offset)
+            h.update(f.read(FINGERPRINT_CHUNK))
+    return h.hexdigest()
+
+
+def _apply_probe(entry: MediaFile, path: Path):
+    info = probe_media(path)
+    if info is not None:
+        for field, value in info.items():
+            setattr(entry, field, value)
+    try:
+        entry.fingerprint = fingerprint(path, entry.size)
+    except OSError:
+        entry.fingerprint = ''
+    entry.probed = True
+    entry.probed_at = timezone.now()
+    if entry.has_video:
+        thumbnails.schedule(path, entry.fingerprint, entry.duration)
+
+
+# =========================
+# Index maintenance
+# =========================
+
+def index_file(path, probe=True) -> MediaFile | None:
+    """Returns the up-to-date index entry for one file, (re)probing only if it changed."""
+    path = Path(path)
+    try:
+        st = path.stat()
+    except OSError:
+        MediaFile.objects.filter(path=relative_path(path)).delete()
+        return None
+
+    rel = relative_path(path)
+    entry = MediaFile.objects.filter(path=rel).first()
+    if entry is not None and entry.size == st.st_size and entry.mtime == st.st_mtime:
+        if probe and not entry.probed:
+            _apply_probe(entry, path)
+            entry.save()
+        return entry
+
+    folder = rel.split('/', 1)[0]
+    entry = entry or MediaFile(path=rel)
+    entry.folder = folder
+    entry.source = dict(MEDIA_FOLDERS).get(folder, folder)
+    entry.name = path.name
+    entry.extension = path.suffix.lower()
+    entry.size = st.st_size
+    entry.mtime = st.st_mtime
+    entry.probed = False
+    if entry.last_accessed is None:
+        # A new file counts as used when it was written (LRU eviction, core/storage.py)
+        entry.last_accessed = datetime.fromtimestamp(st.st_mtime).astimezone()
+    if probe:
+        _apply_probe(entry, path)
+    entry.save()
+    return entry
+
+
+def index_outputs(outputs):
+    """Indexes a finished job's outputs (segment patterns are expanded)."""
+    for output in output_files(outputs):
+        path = Path(output)
+        if path.suffix.lower() in VALID_EXTENSIONS:
+            index_file(path)
+
+
+def _scan_folder(folder: str, probe: bool) -> int:
+    """Syncs one folder's rows with the disk. Returns the number of new/changed files."""
+    root = settings.MEDIA_ROOT / folder
+    root.mkdir(parents=True, exist_ok=True)
+    existing = {
+        e.path: e for e in MediaFile.objects.filter(folder=folder).only('id', 'path', 'size', 'mtime', 'probed')
+    }
+
+    changed = 0
+    seen = set()
+    for f in root.iterdir():
+        # Dotfiles are in-progress/temporary outputs
+        if f.name.startswith('.') or f.suffix.lower() not in VALID_EXTENSIONS or not f.is_file():
+            continue
+        rel = relative_path(f)
+        seen.add(rel)
+        st = f.stat()
+        entry = existing.get(rel)
+        if entry is not None and entry.size == st.st_size and entry.mtime == st.st_mtime:
+            continue
+        index_file(f, probe=probe)
+        changed += 1
+
+    removed = [e.pk for rel, e in existing.items() if rel not in seen]
+    if removed:
+        MediaFile.objects.filter(pk__in=removed).delete()
+    return changed
+
+
+def rescan(probe=False, force=False) -> int:
+    """Brings the index up to date. Folders whose mtime hasn't changed are skipped.
+
+    With probe=False new files are only stat'ed; ffprobe runs in the background.
+    """
+    changed = 0
+    with _scan_lock:
+        for folder, _source in MEDIA_FOLDERS:
+            root = settings.MEDIA_ROOT / folder
+            try:
+                dir_mtime = root.stat().st_mtime_ns
+            except OSError:
+                dir_mtime = None
+            if not force and dir_mtime is not None and _scanned_dirs.get(folder) == dir_mtime:
+                continue
+            changed += _scan_folder(folder, probe)
+            try:
+                _scanned_dirs[folder] = root.stat().st_mtime_ns
+            except OSError:
+                pass
+    if not probe and MediaFile.objects.filter(probed=False).exists():
+        probe_pending_async()
+    return changed
+
+
+def probe_pending(limit=None) -> int:
+    """Probes index entries that haven't been probed yet."""
+    done = 0
+    while limit is None or done < limit:
+        batch = list(MediaFile.objects.filter(probed=False)[:20])
+        if not batch:
+            break
+        for entry in batch:
+            index_file(settings.MEDIA_ROOT / entry.path, probe=True)
+            done += 1
+    return done
+
+
+def probe_pending_async():
+    """Probes new files in a background thread so page loads don't wait on ffprobe."""
+    global _prober
+
+    def run():
+        global _prober
+        try:
+            close_old_connections()
+            probe_pending()
+        except Exception as e:
+            print(f"Library probe failed: {e}")
+        finally:
+            connection.close()
+            _prober = None
+
+    with _prober_lock:
+        if _prober is None:
+            _prober = threading.Thread(target=run, name="library-prober", daemon=True)
+            _prober.start()
+
+
+def invalidate(folder=None):
+    """Forces the next rescan to list a folder (or all folders) again."""
+    if folder is None:
+        _scanned_dirs.clear()
+    else:
+        _scanned_dirs.pop(folder, None)
+
+
+# =========================
+# Command defaults & validation
+# =========================
+
+def command_defaults(entry: MediaFile | None) -> dict:
+    """Fallback values for command parameters, taken from the source where possible."""
+    defaults = {'width': 1920, 'height': 1080, 'factors': 2.0, 'start': 0, 'duration': 60}
+    if entry is not None and entry.probed:
+        if entry.width and entry.height:
+            defaults['width'] = entry.width
+            defaults['height'] = entry.height
+        if entry.duration:
+            defaults['end'] = round(entry.duration, 3)
+    return defaults
+
+
+def check_command(compiled, entry: MediaFile | None, params: dict) -> str | None:
+    """Returns an error message if the command can't work on this source, else None."""
+    if entry is None or not entry.probed:
+        return None
+
+    template = compiled.template
+    # Video encoding/filtering on a file without a video stream
+    needs_video = any(
+        arg in ("-vf", "-c:v") and template[i + 1] != "copy"
+        for i, arg in enumerate(template[:-1])
+    ) and "-vn" not in template
+    if needs_video and not entry.has_video:
+        return f"{entry.name} has no video stream."
+    if "-vn" in template and not entry.has_audio:
+        return f"{entry.name} has no audio stream."
+
+    start = parse_time(params.get('start'))
+    end = parse_time(params.get('end'))
+    if start is not None and end is not None and end <= start:
+        return "End time must be after start time."
+    if entry.duration and start is not None and start >= entry.duration:
+        return f"Start time is beyond the end of the video ({entry.duration:.1f}s)."
+    return None
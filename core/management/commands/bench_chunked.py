@@ -0,0 +1,103 @@
+"""
+Benchmark: single-process vs chunked parallel encoding.
+
+    python manage.py bench_chunked --duration 600 --profile base_best_quality
+
+Generates a synthetic clip (testsrc2 video + sine audio, keyframe every 2s),
+encodes it both ways with the same profile and reports wall-clock time,
+speedup, output size, PSNR/SSIM against the source, and the video/audio
+durations so timestamp problems at chunk joins would show up.
+"""
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core import chunked, library
+from core.utils import build_command, get_all_commands
+
+
+def _make_source(path, duration, size, rate):
+    subprocess.run([
+        "ffmpeg", "-y", "-v", "error",
+        "-f", "lavfi", "-i", f"testsrc2=size={size}:rate={rate}:duration={duration}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=48000:duration={duration}",
+        "-c:v", "libx264", "-preset", "veryfast", "-crf", "18", "-g", str(rate * 2),
+        "-c:a", "aac", "-b:a", "128k", str(path)
+    ], check=True)
+
+
+def _quality(output, source):
+    """(PSNR average, SSIM all) of output against source."""
+    result = subprocess.run([
+        "ffmpeg", "-v", "info", "-nostats", "-i", str(output), "-i", str(source),
+        "-lavfi", "[0:v]split[a0][a1];[1:v]split[b0][b1];[a0][b0]psnr;[a1][b1]ssim",
+        "-f", "null", "-"
+    ], capture_output=True, text=True, check=True)
+    psnr = re.search(r"PSNR .*average:([\d.]+|inf)", result.stderr)
+    ssim = re.search(r"SSIM .*All:([\d.]+)", result.stderr)
+    return (psnr.group(1) if psnr else "?"), (ssim.group(1) if ssim else "?")
+
+
+def _stream_durations(path):
+    result = subprocess.run([
+        "ffprobe", "-v", "error", "-show_entries", "stream=codec_type,duration",
+        "-of", "csv=p=0", str(path)
+    ], capture_output=True, text=True, check=True)
+    return ", ".join(line.replace(",", " ") + "s" for line in result.stdout.split())
+
+
+class Command(BaseCommand):
+    help = "Compare single-process and chunked parallel encoding on a synthetic clip."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profile', default='base_best_quality')
+        parser.add_argument('--duration', type=int, default=300, help="Seconds of synthetic video")
+        parser.add_argument('--size', default='1920x1080')
+        parser.add_argument('--rate', type=int, default=30)
+        parser.add_argument('--workers', type=int, default=None)
+        parser.add_argument('--keep', action='store_true', help="Keep the generated files")
+
+    def handle(self, *args, **options):
+        if options['profile'] not in get_all_commands():
+            raise CommandError(f"Unknown profile: {options['profile']}")
+        workers = options['workers'] or max(chunked.default_workers(), 2)
+
+        tmp = Path(tempfile.mkdtemp(prefix="bench_chunked_"))
+        source = tmp / "source.mp4"
+        self.stdout.write(f"Generating {options['duration']}s {options['size']} source in {tmp}...")
+        _make_source(source, options['duration'], options['size'], options['rate'])
+
+        rows = []
+        for mode in ("single", "chunked"):
+            output = tmp / f"{mode}.mp4"
+            command = build_command(options['profile'], **library.command_defaults(None), input=str(source), output=str(output))
+            if mode == "chunked" and chunked.parse_command(command) is None:
+                raise CommandError(f"Profile {options['profile']} can't be chunked.")
+            self.stdout.write(f"Encoding ({mode})...")
+            started = time.monotonic()
+            if mode == "single":
+                subprocess.run([*command[:1], "-v", "error", *command[1:]], stdin=subprocess.DEVNULL, check=True)
+                detail = ""
+            else:
+                stats = chunked.encode(command, options['duration'], workers=workers)
+                detail = f"{stats['chunks']} chunks x {stats['threads_per_worker']} threads"
+            elapsed = time.monotonic() - started
+            psnr, ssim = _quality(output, source)
+            rows.append((mode, elapsed, output.stat().st_size, psnr, ssim, _stream_durations(output), detail))
+
+        self.stdout.write("")
+        self.stdout.write(f"{'mode':<8} {'time':>8} {'speedup':>8} {'size MB':>8} {'PSNR':>7} {'SSIM':>8}  streams")
+        base = rows[0][1]
+        for mode, elapsed, size, psnr, ssim, durations, detail in rows:
+            self.stdout.write(
+                f"{mode:<8} {elapsed:>7.1f}s {base / elapsed:>7.2f}x {size / 1048576:>8.1f} {psnr:>7} {ssim:>8}  {durations}"
+                + (f"  ({detail})" if detail else "")
+            )
+
+        if not options['keep']:
+            shutil.rmtree(tmp, ignore_errors=True)
@@ -0,0 +1,215 @@
+"""
+Benchmark: media delivery throughput and seeking.
+
+    python manage.py bench_media --size 4
+    python manage.py bench_media --file /path/to/big.mkv
+
+Serves a multi-GB file (generated in a temp dir, or --file) from local
+servers running this app, and compares the old static() view with
+core/media.py. Servers: wsgiref under WSGI, and uvicorn under ASGI when it is
+installed. For each it reports:
+- full-download throughput
+- the latency of random 1 MiB range requests (what a video player does
+  when seeking)
+- the time to first byte for a seek to 90%
+- how much the process RSS grew
+
+wsgiref copies through Python. Under gunicorn the media view's file is sent
+with os.sendfile instead, so the WSGI figures are a lower bound.
+"""
+import http.client
+import os
+import random
+import resource
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+from pathlib import Path
+from urllib.parse import quote
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from django.urls import path
+from django.views.static import serve as static_serve
+
+from core.views import serve_media
+
+RANGE_SIZE = 1 << 20
+READ_SIZE = 1 << 20
+# static() under ASGI reads the whole file into memory first
+ASGI_STATIC_LIMIT = 512 << 20
+
+
+def _static(request, path):
+    return static_serve(request, path, document_root=settings.MEDIA_ROOT)
+
+
+# URLconf used while benchmarking: the old static view next to the media view
+urlpatterns = [
+    path('static/<path:path>', _static),
+    path('media/<path:path>', serve_media),
+]
+
+
+class _ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def _start_wsgi():
+    server = make_server('127.0.0.1', 0, WSGIHandler(), server_class=_ThreadingWSGIServer, handler_class=_QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1], server.shutdown
+
+
+def _start_asgi():
+    import uvicorn
+    from django.core.asgi import get_asgi_application
+
+    config = uvicorn.Config(get_asgi_application(), host='127.0.0.1', port=0, log_level='error', lifespan='off')
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, daemon=True).start()
+    deadline = time.monotonic() + 10
+    while not server.started and time.monotonic() < deadline:
+        time.sleep(0.05)
+    if not server.started:
+        raise CommandError("uvicorn didn't start")
+    port = server.servers[0].sockets[0].getsockname()[1]
+
+    def stop():
+        server.should_exit = True
+    return port, stop
+
+
+def _make_file(target, size):
+    block = os.urandom(16 << 20)
+    with open(target, 'wb') as f:
+        written = 0
+        while written < size:
+            part = block[:min(len(block), size - written)]
+            f.write(part)
+            written += len(part)
+
+
+def _get(port, url, headers=None):
+    """(status, bytes read, seconds to first byte, total seconds)."""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+    started = time.perf_counter()
+    conn.request('GET', url, headers=headers or {})
+    response = conn.getresponse()
+    first = None
+    total = 0
+    while True:
+        data = response.read(READ_SIZE)
+        if first is None:
+            first = time.perf_counter() - started
+        if not data:
+            break
+        total += len(data)
+    conn.close()
+    return response.status, total, first, time.perf_counter() - started
+
+
+def _rss_mb():
+    # ru_maxrss is KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Command(BaseCommand):
+    help = "Compare media delivery (ranges, sendfile, async streaming) with static() on a large file."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=float, default=2.0, help="GiB of generated data")
+        parser.add_argument('--file', help="Serve this file instead of generating one")
+        parser.add_argument('--ranges', type=int, default=200, help="Random range requests per endpoint")
+        parser.add_argument('--servers', default='wsgi,asgi')
+
+    def handle(self, *args, **options):
+        tmp = Path(tempfile.mkdtemp(prefix="bench_media_"))
+        try:
+            if options['file']:
+                source = Path(options['file']).resolve()
+                if not source.is_file() or source.name.startswith('.'):
+                    raise CommandError(f"Not a servable file: {source}")
+                root, name = source.parent, source.name
+            else:
+                root, name = tmp, "bench.bin"
+                size = int(options['size'] * (1 << 30))
+                self.stdout.write(f"Writing {size / (1 << 30):.1f} GiB to {tmp}...")
+                _make_file(tmp / name, size)
+            with override_settings(MEDIA_ROOT=root, ROOT_URLCONF=__name__, MEDIA_ACCEL=None, DEBUG=False,
+                                   ALLOWED_HOSTS=['127.0.0.1']):
+                self._run(root / name, options)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def _run(self, file_path, options):
+        size = file_path.stat().st_size
+        url_name = quote(file_path.name)
+        servers = {'wsgi': _start_wsgi, 'asgi': _start_asgi}
+        rows = []
+        for server_name in [s.strip() for s in options['servers'].split(',') if s.strip()]:
+            if server_name not in servers:
+                raise CommandError(f"Unknown server: {server_name}")
+            try:
+                port, stop = servers[server_name]()
+            except ImportError:
+                self.stdout.write(f"{server_name}: uvicorn isn't installed, skipping")
+                continue
+            try:
+                for endpoint in ('static', 'media'):
+                    if server_name == 'asgi' and endpoint == 'static' and size > ASGI_STATIC_LIMIT:
+                        rows.append((server_name, endpoint, None, None, None, None, "skipped: buffers the whole file in memory"))
+                        continue
+                    rows.append(self._measure(server_name, endpoint, port, f"/{endpoint}/{url_name}", size, options['ranges']))
+            finally:
+                stop()
+
+        self.stdout.write("")
+        self.stdout.write(f"{file_path.name}: {size / (1 << 20):.0f} MiB")
+        self.stdout.write(f"{'server':<6} {'view':<7} {'MB/s':>8} {'range ms':>9} {'seek TTFB':>10} {'RSS +MB':>8}  notes")
+        for server_name, endpoint, rate, range_ms, ttfb, rss, note in rows:
+            if rate is None:
+                self.stdout.write(f"{server_name:<6} {endpoint:<7} {'-':>8} {'-':>9} {'-':>10} {'-':>8}  {note}")
+                continue
+            range_ms = f"{range_ms:.2f}" if range_ms is not None else "-"
+            self.stdout.write(
+                f"{server_name:<6} {endpoint:<7} {rate:>8.0f} {range_ms:>9} {ttfb * 1000:>8.1f}ms {rss:>8.0f}  {note}"
+            )
+
+    def _measure(self, server_name, endpoint, port, url, size, ranges):
+        self.stdout.write(f"{server_name} {endpoint}: full download...")
+        rss_before = _rss_mb()
+        status, total, _first, elapsed = _get(port, url)
+        if status != 200 or total != size:
+            raise CommandError(f"{url}: got {status} with {total} of {size} bytes")
+        rate = total / elapsed / 1e6
+
+        # Seeking: a player asks for the bytes at the new position
+        seek_at = int(size * 0.9)
+        status, total, ttfb, _elapsed = _get(port, url, {'Range': f"bytes={seek_at}-"})
+        note = ""
+        if status != 206:
+            note = f"no range support ({status}, sent {total / (1 << 20):.0f} MiB for a seek)"
+            return server_name, endpoint, rate, None, ttfb, _rss_mb() - rss_before, note
+
+        self.stdout.write(f"{server_name} {endpoint}: {ranges} range requests...")
+        timings = []
+        rng = random.Random(0)
+        for _ in range(ranges):
+            start = rng.randrange(0, max(size - RANGE_SIZE, 1))
+            status, total, _first, elapsed = _get(port, url, {'Range': f"bytes={start}-{start + RANGE_SIZE - 1}"})
+            if status != 206 or total != min(RANGE_SIZE, size - start):
+                raise CommandError(f"{url}: bad range response {status} ({total} bytes)")
+            timings.append(elapsed)
+        range_ms = sum(timings) / len(timings) * 1000
+        return server_name, endpoint, rate, range_ms, ttfb, _rss_mb() - rss_before, note
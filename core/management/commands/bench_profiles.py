@@ -0,0 +1,423 @@
+"""
+Benchmark: every command profile on deterministic synthetic sources.
+
+    python manage.py bench_profiles
+    python manage.py bench_profiles --profiles compress_ultra,resize_video --sources grain_1080p
+    python manage.py bench_profiles --save-baseline
+    python manage.py bench_profiles --fail-on-regression
+
+Sources are made with ffmpeg's lavfi generators. They differ in resolution,
+length and motion, and are cached under .cache/bench_sources/:
+- still_360p: static SMPTE bars, 20s
+- motion_720p: a mandelbrot zoom, every pixel changes each frame, 10s
+- grain_1080p: a test pattern under temporal noise, the worst case for an
+  encoder, 5s
+
+Every profile (base and custom; GPU ones only with a GPU) runs on every
+source. The profile's own command is run, as a job would run it, without the
+stream-copy planner or chunking. For each run the command records:
+- wall time, and source frames processed per second
+- CPU time and peak RSS, taken from wait4()
+- output size
+- PSNR/SSIM against the source, when there is a single video output
+
+Each run is appended to BENCHMARK_DIR/history.jsonl with the ffmpeg version,
+host and a hash of the command. It is then compared with
+BENCHMARK_DIR/baseline.json, which --save-baseline writes. A run is flagged as
+a regression when it is slower, bigger or worse than the baseline by more than
+the tolerances.
+"""
+import hashlib
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core import library, scheduler, smart_trim
+from core.capabilities import get_capabilities
+from core.ffmpeg import output_files, outputs_size
+from core.models import MediaFile
+from core.utils import COMMAND_REGISTRY, output_extension
+
+# name -> lavfi video source; all are 30 fps with a 440 Hz tone
+SOURCES = {
+    'still_360p': {'video': "smptehdbars=size=640x360:rate=30", 'size': (640, 360), 'duration': 20},
+    'motion_720p': {'video': "mandelbrot=size=1280x720:rate=30", 'size': (1280, 720), 'duration': 10},
+    'grain_1080p': {
+        'video': "testsrc2=size=1920x1080:rate=30,noise=alls=40:allf=t+u:all_seed=1",
+        'size': (1920, 1080), 'duration': 5,
+    },
+}
+RATE = 30
+
+# Allowed change against the baseline before a run counts as a regression
+TIME_TOLERANCE = 0.10
+SIZE_TOLERANCE = 0.05
+PSNR_TOLERANCE = 0.5
+SSIM_TOLERANCE = 0.005
+
+
+def _benchmark_dir() -> Path:
+    return Path(getattr(settings, 'BENCHMARK_DIR', settings.BASE_DIR / 'benchmarks'))
+
+
+def _digest(value) -> str:
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode()).hexdigest()[:10]
+
+
+def _source_spec(name, scale):
+    spec = dict(SOURCES[name])
+    spec['duration'] = max(round(spec['duration'] * scale, 2), 1)
+    return spec
+
+
+def _make_source(path, spec):
+    """Encodes a lavfi source at high quality. -bitexact keeps the file identical between runs."""
+    duration = spec['duration']
+    tmp = path.with_name(f".{path.name}")
+    subprocess.run([
+        "ffmpeg", "-y", "-v", "error",
+        "-f", "lavfi", "-i", f"{spec['video']},trim=duration={duration}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=48000:duration={duration}",
+        "-c:v", "libx264", "-preset", "veryfast", "-crf", "12", "-pix_fmt", "yuv420p", "-g", str(RATE * 2),
+        "-c:a", "aac", "-b:a", "192k", "-shortest",
+        "-fflags", "+bitexact", "-flags:v", "+bitexact", "-flags:a", "+bitexact",
+        "-f", "mp4", str(tmp)
+    ], stdin=subprocess.DEVNULL, check=True)
+    os.replace(tmp, path)
+
+
+def _bench_params(compiled, spec, overrides) -> dict:
+    """Parameter values for a profile on this source; start/end cut out the middle."""
+    width, height = spec['size']
+    duration = spec['duration']
+    params = library.command_defaults(None)
+    params.update({
+        'width': width // 2,
+        'height': height // 2,
+        'start': round(duration * 0.3, 3),
+        'end': round(duration * 0.7, 3),
+        'duration': max(round(duration / 4, 3), 1),
+        'bitrate': '2M',
+    })
+    params.update(overrides)
+    missing = [p for p in compiled.parameters if p not in params]
+    if missing:
+        return None
+    return params
+
+
+def _input_options(command) -> list:
+    """The -ss/-to/-t options the command puts before its input."""
+    options = []
+    i = 1
+    while i < len(command) - 1 and command[i] != "-i":
+        if command[i] in ("-ss", "-to", "-t"):
+            options += command[i:i + 2]
+            i += 2
+        else:
+            i += 1
+    return options
+
+
+def _probe_video(path):
+    """(width, height, frame rate) of the first video stream, or None."""
+    info = library.probe_media(path)
+    if not info or not info.get('has_video'):
+        return None
+    return info.get('width'), info.get('height'), info.get('frame_rate') or RATE
+
+
+def _quality(output, source, command, size):
+    """(PSNR average, SSIM all) of the output against the part of the source it came from.
+
+    Both sides are brought to the output's frame rate (capped at the source's)
+    and the source's size, so resized, slowed or trimmed outputs can be scored too.
+    """
+    video = _probe_video(output)
+    if video is None:
+        return None, None
+    width, height = size
+    rate = min(video[2], RATE)
+    chain = f"setpts=PTS-STARTPTS,fps={rate},scale={width}:{height}:flags=bicubic,format=yuv420p"
+    result = subprocess.run([
+        "ffmpeg", "-v", "info", "-nostats", "-i", str(output), *_input_options(command), "-i", str(source),
+        "-lavfi", f"[0:v]{chain}[a];[1:v]{chain}[b];[a]split[a0][a1];[b]split[b0][b1];[a0][b0]psnr;[a1][b1]ssim",
+        "-f", "null", "-"
+    ], stdin=subprocess.DEVNULL, capture_output=True, text=True)
+    psnr = re.search(r"PSNR .*average:([\d.]+|inf)", result.stderr)
+    ssim = re.search(r"SSIM .*All:([\d.]+)", result.stderr)
+    psnr = psnr.group(1) if psnr else None
+    return (float(psnr) if psnr and psnr != "inf" else psnr), (float(ssim.group(1)) if ssim else None)
+
+
+class _Context:
+    """Stands in for a JobContext: runs processes and adds up what they used."""
+
+    def __init__(self):
+        self.usage = {'cpu': 0.0, 'max_rss_kb': 0}
+
+    def progress(self, **data):
+        pass
+
+    def check_cancelled(self, force=False):
+        pass
+
+    def account(self, usage):
+        if usage:
+            self.usage['cpu'] += usage['cpu']
+            self.usage['max_rss_kb'] = max(self.usage['max_rss_kb'], usage['max_rss_kb'])
+
+    def run(self, command, **popen_kwargs):
+        process = subprocess.Popen(command, stderr=subprocess.PIPE, **popen_kwargs)
+        # -v error keeps stderr small enough not to fill the pipe
+        self.account(scheduler.reap(process))
+        stderr = process.stderr.read().decode(errors='replace')
+        process.stderr.close()
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command, stderr=stderr)
+        return process.returncode
+
+
+def _run_profile(compiled, command, source, output, params, ctx):
+    """Runs one profile the way its job handler would. Returns a note, if any."""
+    if compiled.engine == 'smart_trim':
+        entry = MediaFile(path=source.name, probed=True, **(library.probe_media(source) or {}))
+        if smart_trim.trim(source, output, float(params['start']), float(params['end']), entry, ctx) is not None:
+            return ""
+        note = "smart trim fell back to its command"
+    elif compiled.engine != 'ffmpeg':
+        note = f"ran the {compiled.engine} engine's command"
+    else:
+        note = ""
+    ctx.run([command[0], "-v", "error", *command[1:]], stdin=subprocess.DEVNULL)
+    return note
+
+
+def _compare(record, base, tolerances) -> list:
+    """The ways record is worse than base, e.g. ['time +23%']."""
+    flags = []
+    if base.get('error') or record.get('error'):
+        return flags
+    if base['wall'] and record['wall'] > base['wall'] * (1 + tolerances['time']):
+        flags.append(f"time +{(record['wall'] / base['wall'] - 1) * 100:.0f}%")
+    if base['size'] and record['size'] > base['size'] * (1 + tolerances['size']):
+        flags.append(f"size +{(record['size'] / base['size'] - 1) * 100:.0f}%")
+    if isinstance(base.get('psnr'), float) and isinstance(record.get('psnr'), float):
+        if record['psnr'] < base['psnr'] - tolerances['psnr']:
+            flags.append(f"PSNR {record['psnr'] - base['psnr']:+.2f}dB")
+    if base.get('ssim') is not None and record.get('ssim') is not None:
+        if record['ssim'] < base['ssim'] - tolerances['ssim']:
+            flags.append(f"SSIM {record['ssim'] - base['ssim']:+.4f}")
+    return flags
+
+
+class Command(BaseCommand):
+    help = "Benchmark every command profile on synthetic sources and compare with a saved baseline."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', help="Comma-separated profiles (default: all)")
+        parser.add_argument('--sources', help=f"Comma-separated sources (default: {','.join(SOURCES)})")
+        parser.add_argument('--length', type=float, default=1.0, help="Scale every source's duration")
+        parser.add_argument('--repeat', type=int, default=1, help="Runs per profile; the fastest is kept")
+        parser.add_argument('--param', action='append', default=[], metavar='KEY=VALUE',
+                            help="Override a command parameter (repeatable)")
+        parser.add_argument('--no-quality', action='store_true', help="Skip PSNR/SSIM")
+        parser.add_argument('--baseline', help="Baseline file (default: BENCHMARK_DIR/baseline.json)")
+        parser.add_argument('--save-baseline', action='store_true', help="Make this run the new baseline")
+        parser.add_argument('--fail-on-regression', action='store_true', help="Exit with an error on regressions")
+        parser.add_argument('--time-tolerance', type=float, default=TIME_TOLERANCE)
+        parser.add_argument('--size-tolerance', type=float, default=SIZE_TOLERANCE)
+        parser.add_argument('--psnr-tolerance', type=float, default=PSNR_TOLERANCE)
+        parser.add_argument('--ssim-tolerance', type=float, default=SSIM_TOLERANCE)
+        parser.add_argument('--keep', action='store_true', help="Keep the outputs")
+
+    def handle(self, *args, **options):
+        caps = get_capabilities()
+        if not caps.available:
+            raise CommandError("ffmpeg isn't installed.")
+
+        commands = COMMAND_REGISTRY.compiled()
+        profiles = list(commands)
+        if options['profiles']:
+            profiles = [p.strip() for p in options['profiles'].split(',') if p.strip()]
+            for profile in profiles:
+                if profile not in commands:
+                    raise CommandError(f"Unknown profile: {profile}")
+        sources = list(SOURCES)
+        if options['sources']:
+            sources = [s.strip() for s in options['sources'].split(',') if s.strip()]
+            for name in sources:
+                if name not in SOURCES:
+                    raise CommandError(f"Unknown source: {name} (choose from {', '.join(SOURCES)})")
+        overrides = {}
+        for item in options['param']:
+            key, sep, value = item.partition('=')
+            if not sep:
+                raise CommandError(f"--param needs KEY=VALUE, got {item!r}")
+            overrides[key] = value
+
+        bench_dir = _benchmark_dir()
+        baseline_path = Path(options['baseline']) if options['baseline'] else bench_dir / 'baseline.json'
+        try:
+            baseline = json.loads(baseline_path.read_text())
+        except (OSError, ValueError):
+            baseline = {}
+        tolerances = {
+            'time': options['time_tolerance'], 'size': options['size_tolerance'],
+            'psnr': options['psnr_tolerance'], 'ssim': options['ssim_tolerance'],
+        }
+        run_info = {
+            'run': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'host': platform.node(),
+            'cpus': os.cpu_count(),
+            'ffmpeg': caps.version,
+        }
+
+        source_dir = settings.BASE_DIR / '.cache' / 'bench_sources'
+        source_dir.mkdir(parents=True, exist_ok=True)
+        tmp = Path(tempfile.mkdtemp(prefix="bench_profiles_"))
+        records = []
+        try:
+            for name in sources:
+                spec = _source_spec(name, options['length'])
+                # The spec alone: sources are -bitexact, and an ffmpeg upgrade is exactly
+                # what a run should be comparable across (it's reported as a change)
+                source_hash = _digest(spec)
+                source = source_dir / f"{name}-{source_hash}.mp4"
+                if not source.exists():
+                    self.stdout.write(f"Generating {name} ({spec['duration']}s)...")
+                    _make_source(source, spec)
+                for profile in profiles:
+                    record = self._bench(commands[profile], name, spec, source, source_hash, tmp, overrides, options)
+                    record.update(run_info)
+                    records.append(record)
+        finally:
+            if not options['keep']:
+                shutil.rmtree(tmp, ignore_errors=True)
+            else:
+                self.stdout.write(f"Outputs kept in {tmp}")
+
+        bench_dir.mkdir(parents=True, exist_ok=True)
+        with open(bench_dir / 'history.jsonl', 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+
+        regressions = self._report(records, baseline, tolerances)
+
+        if options['save_baseline']:
+            for record in records:
+                if not record.get('error') and not record.get('skipped'):
+                    baseline[f"{record['source']}/{record['profile']}"] = record
+            baseline_path.parent.mkdir(parents=True, exist_ok=True)
+            baseline_path.write_text(json.dumps(baseline, indent=2, sort_keys=True))
+            self.stdout.write(f"Baseline saved to {baseline_path}")
+        if regressions and options['fail_on_regression']:
+            raise CommandError(f"{regressions} regression(s) against {baseline_path}")
+
+    def _bench(self, compiled, name, spec, source, source_hash, tmp, overrides, options) -> dict:
+        record = {'source': name, 'source_hash': source_hash, 'profile': compiled.key,
+                  'command_hash': _digest(compiled.template)}
+        params = _bench_params(compiled, spec, overrides)
+        if params is None:
+            record['skipped'] = f"no bench value for {', '.join(compiled.parameters)}"
+            return record
+
+        self.stdout.write(f"{name}: {compiled.key}...")
+        runs = []
+        for attempt in range(max(options['repeat'], 1)):
+            output = tmp / f"{name}-{compiled.key}{output_extension(compiled.key)}"
+            pattern = str(tmp / f"{name}-{compiled.key}-{attempt}_%03d.mp4")
+            command = compiled.build(**params, input=str(source), output=str(output), output_pattern=pattern)
+            outputs = [pattern] if 'output_pattern' in compiled.placeholders else [str(output)]
+            for f in output_files(outputs):
+                Path(f).unlink(missing_ok=True)
+            ctx = _Context()
+            started = time.perf_counter()
+            try:
+                note = _run_profile(compiled, command, source, output, params, ctx)
+            except subprocess.CalledProcessError as e:
+                lines = (e.stderr or "").strip().splitlines()
+                record['error'] = lines[-1] if lines else f"exit status {e.returncode}"
+                return record
+            runs.append((time.perf_counter() - started, ctx.usage, command, outputs, note))
+
+        wall, usage, command, outputs, note = min(runs, key=lambda run: run[0])
+        # Seconds of the source that were read: the cut for trims, else all of it
+        media = spec['duration']
+        if _input_options(command) and 'start' in params and 'end' in params:
+            media = float(params['end']) - float(params['start'])
+        record.update({
+            'wall': round(wall, 3),
+            'fps': round(media * RATE / wall, 1),
+            'speed': round(media / wall, 2),
+            'cpu': round(usage['cpu'], 2),
+            'rss_mb': round(usage['max_rss_kb'] / 1024, 1),
+            'size': outputs_size(outputs),
+            'outputs': len(output_files(outputs)),
+            'psnr': None,
+            'ssim': None,
+        })
+        if note:
+            record['note'] = note
+        if not options['no_quality'] and record['outputs'] == 1:
+            record['psnr'], record['ssim'] = _quality(output_files(outputs)[0], source, command, spec['size'])
+        return record
+
+    def _report(self, records, baseline, tolerances) -> int:
+        """Prints the results table. Returns the number of regressions."""
+        regressions = 0
+        self.stdout.write("")
+        self.stdout.write(
+            f"{'source':<12} {'profile':<24} {'time':>8} {'fps':>7} {'speed':>7} {'cpu s':>7} {'RSS MB':>7} "
+            f"{'size MB':>8} {'PSNR':>6} {'SSIM':>7}  vs baseline"
+        )
+        for record in records:
+            prefix = f"{record['source']:<12} {record['profile']:<24}"
+            if record.get('skipped') or record.get('error'):
+                reason = f"skipped: {record['skipped']}" if record.get('skipped') else f"failed: {record['error']}"
+                self.stdout.write(f"{prefix} {reason}")
+                continue
+            psnr = record['psnr']
+            psnr = f"{psnr:.2f}" if isinstance(psnr, float) else (psnr or "-")
+            ssim = f"{record['ssim']:.4f}" if record['ssim'] is not None else "-"
+            line = (
+                f"{prefix} {record['wall']:>7.2f}s {record['fps']:>7.1f} {record['speed']:>6.1f}x {record['cpu']:>7.1f} "
+                f"{record['rss_mb']:>7.0f} {record['size'] / 1048576:>8.2f} {psnr:>6} {ssim:>7}"
+            )
+
+            base = baseline.get(f"{record['source']}/{record['profile']}")
+            if base is None:
+                comparison = "no baseline"
+            elif base.get('source_hash') != record['source_hash']:
+                comparison = "not comparable (different source)"
+            else:
+                changes = []
+                if base.get('command_hash') != record['command_hash']:
+                    changes.append("command changed")
+                if base.get('ffmpeg') != record['ffmpeg']:
+                    changes.append(f"ffmpeg {base.get('ffmpeg')} -> {record['ffmpeg']}")
+                if base.get('host') != record['host']:
+                    changes.append(f"baseline from {base.get('host')}")
+                flags = _compare(record, base, tolerances)
+                if flags:
+                    regressions += 1
+                comparison = (f"REGRESSION: {', '.join(flags)}" if flags
+                              else f"ok ({record['wall'] / base['wall']:.2f}x time)" if base.get('wall') else "ok")
+                if changes:
+                    comparison += f" [{'; '.join(changes)}]"
+            if record.get('note'):
+                comparison += f" ({record['note']})"
+            self.stdout.write(f"{line}  {comparison}")
+        if regressions:
+            self.stdout.write(f"\n{regressions} regression(s).")
+        return regressions
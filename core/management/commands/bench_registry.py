@@ -0,0 +1,113 @@
+"""
+Micro-benchmark: per-request command lookup overhead, legacy vs CommandRegistry.
+
+    python manage.py bench_registry --iterations 200
+
+"index" = the command lookups behind ProcessVideoForm(), index and
+get_command_params_map(); "process_video" = params map + form + build_command().
+"""
+import json
+import re
+import shutil
+import subprocess
+import time
+
+from django.core.management.base import BaseCommand
+
+from core import utils
+
+
+def _legacy_has_nvidia_gpu(spawn):
+    if not spawn:
+        return False
+    result = subprocess.run(["ffmpeg", "-v", "error", "-hwaccels"], capture_output=True, text=True)
+    if "cuda" not in result.stdout:
+        return False
+    result_enc = subprocess.run(["ffmpeg", "-v", "error", "-encoders"], capture_output=True, text=True)
+    return "nvenc" in result_enc.stdout
+
+
+def _legacy_get_all_commands(spawn):
+    commands = utils.BASE_FFMPEG_COMMANDS.copy()
+    try:
+        with open(utils._custom_commands_path(), 'r') as f:
+            commands.update(json.load(f))
+    except (OSError, json.JSONDecodeError):
+        pass
+    if not _legacy_has_nvidia_gpu(spawn):
+        return {k: v for k, v in commands.items()
+                if "gpu" not in k.lower() and "cuda" not in str(v.get("command", "")).lower()}
+    return commands
+
+
+def _legacy_extract_parameters(command_list):
+    params = set()
+    for arg in command_list:
+        for m in re.findall(r"\{([a-zA-Z0-9_]+)\}", arg):
+            if m not in ['input', 'output', 'output_pattern']:
+                params.add(m)
+    return list(params)
+
+
+def _legacy_params_map(spawn):
+    return {k: _legacy_extract_parameters(v['command']) for k, v in _legacy_get_all_commands(spawn).items()}
+
+
+def _legacy_build_command(spawn, profile, **kwargs):
+    return [arg.format(**kwargs) for arg in _legacy_get_all_commands(spawn)[profile]["command"]]
+
+
+class Command(BaseCommand):
+    help = "Benchmark per-request command registry overhead (legacy vs cached)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=200)
+        parser.add_argument('--no-spawn', action='store_true',
+                            help="Skip the legacy ffmpeg probes (isolates the parsing cost).")
+
+    def handle(self, *args, **options):
+        n = options['iterations']
+        spawn = not options['no_spawn'] and shutil.which("ffmpeg") is not None
+        kwargs = {'input': 'in.mp4', 'output': 'out.mp4', 'width': 1280, 'height': 720}
+
+        def legacy_index():
+            _legacy_get_all_commands(spawn)  # ProcessVideoForm.__init__
+            _legacy_get_all_commands(spawn)  # index
+            _legacy_params_map(spawn)
+
+        def legacy_process():
+            _legacy_params_map(spawn)
+            _legacy_get_all_commands(spawn)  # ProcessVideoForm(request.POST)
+            _legacy_build_command(spawn, 'resize_video', **kwargs)
+
+        def registry_index():
+            utils.get_all_commands()  # ProcessVideoForm.__init__
+            utils.get_all_commands()  # index
+            utils.get_command_params_map()
+
+        def registry_process():
+            utils.get_command_params_map()
+            utils.get_all_commands()  # ProcessVideoForm(request.POST)
+            utils.build_command('resize_video', **kwargs)
+
+        # Warm up (first call pays the one-off probe/compile)
+        registry_index()
+
+        self.stdout.write(f"iterations={n} legacy ffmpeg spawns={'yes' if spawn else 'no'}")
+        for name, legacy, cached in (
+            ("index", legacy_index, registry_index),
+            ("process_video", legacy_process, registry_process),
+        ):
+            legacy_t = self._time(legacy, n)
+            cached_t = self._time(cached, n)
+            self.stdout.write(
+                f"{name:14s} legacy {legacy_t * 1e6:10.1f} us/req   "
+                f"registry {cached_t * 1e6:8.1f} us/req   "
+                f"saved {(legacy_t - cached_t) * 1e6:10.1f} us/req ({legacy_t / max(cached_t, 1e-9):.1f}x)"
+            )
+
+    def _time(self, fn, n):
+        start = time.perf_counter()
+        for _ in range(n):
+            fn()
+        return (time.perf_counter() - start) / n
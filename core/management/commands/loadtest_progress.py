@@ -0,0 +1,132 @@
+"""
+Load test: progress polling vs the SSE stream, against a running server.
+
+    uvicorn video_project.asgi:application --port 8000 &
+    python manage.py loadtest_progress --url http://127.0.0.1:8000 \
+        --clients 50 --tasks 3 --duration 30 --server-pid <uvicorn pid>
+
+Fake tasks are written to the shared progress store and updated twice a
+second. Each mode reports request count, bytes received and (with
+--server-pid) the server's CPU seconds from /proc.
+"""
+import http.client
+import os
+import threading
+import time
+import uuid
+from urllib.parse import urlparse
+
+from django.core.management.base import BaseCommand
+
+from core.globals import PROGRESS_CACHE
+
+
+def _server_cpu(pid):
+    """utime + stime of a process in seconds (Linux only)."""
+    if not pid:
+        return None
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class Command(BaseCommand):
+    help = "Compare request volume and server CPU of progress polling vs SSE."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000')
+        parser.add_argument('--clients', type=int, default=20)
+        parser.add_argument('--tasks', type=int, default=3, help="Tasks watched per client")
+        parser.add_argument('--duration', type=float, default=20.0)
+        parser.add_argument('--server-pid', type=int, default=None)
+        parser.add_argument('--mode', choices=['both', 'poll', 'sse'], default='both')
+
+    def handle(self, *args, **options):
+        self.url = urlparse(options['url'])
+        task_ids = [f"loadtest-{uuid.uuid4()}" for _ in range(options['clients'] * options['tasks'])]
+
+        stop_updates = threading.Event()
+        updater = threading.Thread(target=self._update_tasks, args=(task_ids, stop_updates), daemon=True)
+        updater.start()
+        try:
+            modes = ['poll', 'sse'] if options['mode'] == 'both' else [options['mode']]
+            for mode in modes:
+                self._run(mode, task_ids, options)
+        finally:
+            stop_updates.set()
+            updater.join()
+            for task_id in task_ids:
+                PROGRESS_CACHE.delete(task_id)
+
+    def _update_tasks(self, task_ids, stop):
+        percent = 0
+        while not stop.is_set():
+            percent = (percent + 1) % 100
+            for task_id in task_ids:
+                PROGRESS_CACHE[task_id] = {'status': 'processing', 'percent': percent, 'msg': 'load test'}
+            stop.wait(0.5)
+
+    def _run(self, mode, task_ids, options):
+        per_client = options['tasks']
+        stats = {'requests': 0, 'bytes': 0, 'events': 0, 'errors': 0}
+        lock = threading.Lock()
+        deadline = time.monotonic() + options['duration']
+
+        def add(**counts):
+            with lock:
+                for k, v in counts.items():
+                    stats[k] += v
+
+        def poll_client(ids):
+            conn = http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=10)
+            while time.monotonic() < deadline:
+                for task_id in ids:
+                    try:
+                        conn.request("GET", f"/get-progress/{task_id}/")
+                        body = conn.getresponse().read()
+                        add(requests=1, bytes=len(body), events=1)
+                    except (OSError, http.client.HTTPException):
+                        add(errors=1)
+                        conn.close()
+                time.sleep(1.0)
+            conn.close()
+
+        def sse_client(ids):
+            conn = http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=10)
+            try:
+                conn.request("GET", f"/progress-stream/?tasks={','.join(ids)}")
+                response = conn.getresponse()
+                add(requests=1)
+                while time.monotonic() < deadline:
+                    line = response.fp.readline()
+                    if not line:
+                        break
+                    add(bytes=len(line), events=int(line.startswith(b"event: progress")))
+            except (OSError, http.client.HTTPException):
+                add(errors=1)
+            finally:
+                conn.close()
+
+        target = poll_client if mode == 'poll' else sse_client
+        cpu_before = _server_cpu(options['server_pid'])
+        started = time.monotonic()
+        threads = [
+            threading.Thread(target=target, args=(task_ids[i:i + per_client],), daemon=True)
+            for i in range(0, len(task_ids), per_client)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(options['duration'] + 15)
+        elapsed = time.monotonic() - started
+        cpu_after = _server_cpu(options['server_pid'])
+
+        cpu = f"{cpu_after - cpu_before:.2f}s" if cpu_before is not None and cpu_after is not None else "n/a"
+        self.stdout.write(
+            f"{mode:4s} clients={len(threads)} requests={stats['requests']} "
+            f"req/s={stats['requests'] / elapsed:.1f} updates={stats['events']} "
+            f"bytes={stats['bytes']} errors={stats['errors']} server_cpu={cpu}"
+        )
@@ -0,0 +1,21 @@
+"""
+Brings the media metadata index up to date.
+
+    python manage.py rescan_library          # probe new/changed files only
+    python manage.py rescan_library --force  # re-list every folder
+"""
+from django.core.management.base import BaseCommand
+
+from core import library
+
+
+class Command(BaseCommand):
+    help = "Rescan media folders and ffprobe new or changed files."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help="List folders even if their mtime is unchanged.")
+
+    def handle(self, *args, **options):
+        changed = library.rescan(probe=True, force=options['force'])
+        probed = library.probe_pending()
+        self.stdout.write(f"{changed} new/changed file(s), {probed} probed in the background queue.")
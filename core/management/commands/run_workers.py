@@ -0,0 +1,34 @@
+"""
+Runs the background job workers (and the download manager and storage janitor) in their own process.
+
+    python manage.py run_workers --workers 4 --download-workers 3
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.downloads import DownloadManager
+from core.jobs import WorkerPool
+from core.storage import ensure_janitor
+
+
+class Command(BaseCommand):
+    help = "Run background job workers (ffmpeg processing queue and downloads)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=getattr(settings, 'JOB_WORKERS', 2))
+        parser.add_argument('--download-workers', type=int, default=getattr(settings, 'DOWNLOAD_WORKERS', 3))
+
+    def handle(self, *args, **options):
+        pool = WorkerPool(options['workers'], getattr(settings, 'JOB_POLL_INTERVAL', 2.0))
+        pool.start()
+        downloads = DownloadManager(options['download_workers'], getattr(settings, 'JOB_POLL_INTERVAL', 2.0))
+        downloads.start()
+        ensure_janitor(force=True)
+        self.stdout.write(
+            f"Started {options['workers']} job worker(s) and {options['download_workers']} download worker(s). "
+            "Press Ctrl+C to stop."
+        )
+        try:
+            pool.join()
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping workers (running jobs will be recovered on next start)...")
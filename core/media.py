@@ -0,0 +1,226 @@
+"""
+Media delivery.
+
+MEDIA_URL used to be served by django.conf.urls.static, which is meant for
+development:
+- It reads files through Python.
+- It has no byte-range support, so the browser can't seek in a large
+  output without downloading everything up to that point.
+- Under ASGI, Django turns a sync file response into a list in memory
+  before sending any of it.
+
+serve() handles:
+
+- conditional requests: ETag / Last-Modified give 304, and If-Range is honoured
+- single byte ranges: 206, or 416 when the range is unsatisfiable
+- hand-off to a front proxy, after which the proxy does ranges and sendfile
+  itself:
+  - MEDIA_ACCEL = 'x-accel' sends nginx an X-Accel-Redirect to
+    MEDIA_ACCEL_PREFIX
+  - MEDIA_ACCEL = 'x-sendfile' is for Apache and lighttpd
+- under WSGI, the open file (cut to the range) goes to the server's
+  wsgi.file_wrapper, which gunicorn sends with os.sendfile
+- under ASGI, an async iterator that reads blocks in a thread, so nothing
+  is buffered and no worker is held for the whole transfer
+"""
+import asyncio
+import mimetypes
+import re
+from pathlib import Path
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe
+
+BLOCK_SIZE = 1 << 20
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def resolve(rel_path) -> Path:
+    """The file under MEDIA_ROOT for a URL path. Hidden files (work in progress) are not served."""
+    root = Path(settings.MEDIA_ROOT).resolve()
+    parts = [p for p in str(rel_path).replace('\\', '/').split('/') if p]
+    if not parts or any(p.startswith('.') for p in parts):
+        raise Http404("Not found")
+    path = root.joinpath(*parts).resolve()
+    if not path.is_relative_to(root) or not path.is_file():
+        raise Http404("Not found")
+    return path
+
+
+def etag_for(st) -> str:
+    return f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+
+def parse_range(header, size):
+    """(start, end inclusive) for a single-range Range header, or None to send the whole file.
+
+    Multiple ranges are answered with the whole file, which RFC 9110 allows.
+    """
+    if not header:
+        return None
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise RangeNotSatisfiable()
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise RangeNotSatisfiable()
+    return start, end
+
+
+def _etag_matches(header, etag, weak=True) -> bool:
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate == '*':
+            return True
+        if weak:
+            candidate = candidate.removeprefix('W/')
+        if candidate == etag:
+            return True
+    return False
+
+
+def not_modified(request, etag, mtime) -> bool:
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        return _etag_matches(if_none_match, etag)
+    since = parse_http_date_safe(request.headers.get('If-Modified-Since', ''))
+    return since is not None and int(mtime) <= since
+
+
+def _range_allowed(request, etag, mtime) -> bool:
+    """If-Range: ranges only apply if the client's copy is still current."""
+    if_range = request.headers.get('If-Range')
+    if not if_range:
+        return True
+    if if_range.startswith('"'):
+        return if_range == etag
+    date = parse_http_date_safe(if_range)
+    return date is not None and int(mtime) <= date
+
+
+class RangeFile:
+    """A file limited to `length` bytes from its current position.
+
+    Has fileno() so wsgi.file_wrapper implementations can os.sendfile() it.
+    """
+
+    def __init__(self, f, length):
+        self._file = f
+        self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self._file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def close(self):
+        self._file.close()
+
+
+async def _read_async(path, start, length):
+    f = await asyncio.to_thread(open, path, 'rb')
+    try:
+        await asyncio.to_thread(f.seek, start)
+        remaining = length
+        while remaining > 0:
+            data = await asyncio.to_thread(f.read, min(BLOCK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+def _accel_response(path, rel_path):
+    accel = getattr(settings, 'MEDIA_ACCEL', None)
+    response = HttpResponse()
+    if accel == 'x-accel':
+        prefix = getattr(settings, 'MEDIA_ACCEL_PREFIX', '/protected-media/')
+        response['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + quote(rel_path)
+    else:
+        response['X-Sendfile'] = str(path)
+    # The proxy fills in the body and its own length
+    del response['Content-Type']
+    return response
+
+
+def serve(request, rel_path, asgi=False):
+    path = resolve(rel_path)
+    rel_path = path.relative_to(Path(settings.MEDIA_ROOT).resolve()).as_posix()
+    if getattr(settings, 'MEDIA_ACCEL', None) in ('x-accel', 'x-sendfile'):
+        return _accel_response(path, rel_path)
+
+    st = path.stat()
+    etag = etag_for(st)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(st.st_mtime),
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': getattr(settings, 'MEDIA_CACHE_CONTROL', 'no-cache'),
+    }
+    if not_modified(request, etag, st.st_mtime):
+        response = HttpResponseNotModified()
+        for name, value in headers.items():
+            response[name] = value
+        return response
+
+    size = st.st_size
+    start, end, status = 0, size - 1, 200
+    if request.method == 'GET' and _range_allowed(request, etag, st.st_mtime):
+        try:
+            span = parse_range(request.headers.get('Range'), size)
+        except RangeNotSatisfiable:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f"bytes */{size}"
+            return response
+        if span is not None:
+            (start, end), status = span, 206
+    length = end - start + 1 if size else 0
+
+    content_type, encoding = mimetypes.guess_type(path.name)
+    content_type = content_type or 'application/octet-stream'
+    if request.method == 'HEAD':
+        response = HttpResponse(content_type=content_type)
+    elif asgi:
+        response = StreamingHttpResponse(_read_async(path, start, length), status=status, content_type=content_type)
+    else:
+        f = open(path, 'rb')
+        f.seek(start)
+        response = FileResponse(RangeFile(f, length), status=status, content_type=content_type)
+        response.block_size = BLOCK_SIZE
+    for name, value in headers.items():
+        response[name] = value
+    response['Content-Length'] = str(length)
+    if status == 206:
+        response['Content-Range'] = f"bytes {start}-{end}/{size}"
+    if encoding:
+        response['Content-Encoding'] = encoding
+    if request.GET.get('download'):
+        response['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(path.name)}"
+    return response
@@ -0,0 +1,379 @@
+"""
+Prometheus metrics, served at /metrics.
+
+Each process (runserver, gunicorn workers, run_workers) keeps its series in
+memory. An update is a dict operation under a lock, so instrumenting hot
+paths such as ffmpeg progress lines and yt-dlp hooks costs next to nothing.
+Every METRICS_FLUSH_INTERVAL seconds a background thread writes the series
+that changed to a WAL-mode SQLite file that all processes share, one row per
+(process, series). A scrape merges the rows:
+
+- Counters and histograms are summed over processes. When a process on this
+  host exits, its rows are folded into a single 'retired' row, so totals
+  never go backwards and the table doesn't grow with every restart.
+- Gauges take the most recent value set by a live process.
+- Queue depths (jobs and downloads by status) are counted in the database at
+  scrape time, so they're exact whichever process changed them.
+"""
+import atexit
+import functools
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+
+from .system import pid_alive
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+PREFIX = "hyperframe_"
+RETIRED = "retired"
+
+# Seconds
+DURATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _enabled() -> bool:
+    return getattr(settings, 'METRICS_ENABLED', True)
+
+
+# =========================
+# Metric types
+# =========================
+
+# name -> metric, in the order they're rendered
+REGISTRY = {}
+
+
+class Metric:
+    kind = ''
+
+    def __init__(self, name, help, labels=()):
+        self.name = PREFIX + name
+        self.help = help
+        self.labels = tuple(labels)
+        REGISTRY[self.name] = self
+
+    def _key(self, labels) -> tuple:
+        return self.name, tuple(str(labels.get(label, '')) for label in self.labels)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if _enabled():
+            STORE.update(self._key(labels), lambda value: (value or 0) + amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        if _enabled():
+            STORE.update(self._key(labels), lambda _old: value)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        if not _enabled():
+            return
+        # Per-bucket counts (not cumulative) with a last +Inf bucket
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+
+        def add(old):
+            old = old or {'b': [0] * (len(self.buckets) + 1), 's': 0.0, 'c': 0}
+            old['b'][index] += 1
+            old['s'] += value
+            old['c'] += 1
+            return old
+        STORE.update(self._key(labels), add)
+
+
+# =========================
+# Metrics
+# =========================
+
+JOBS_FINISHED = Counter('jobs_finished_total', "Jobs that finished, by profile and outcome.", ('profile', 'status'))
+JOB_DURATION = Histogram('job_duration_seconds', "Run time of completed jobs.", ('profile',))
+JOB_MEDIA_SECONDS = Counter('job_media_seconds_total', "Seconds of media processed by completed jobs.", ('profile',))
+ENCODE_SPEED = Gauge('encode_speed_ratio', "Latest ffmpeg speed (x realtime) reported for a profile.", ('profile',))
+ENCODE_FPS = Gauge('encode_fps', "Latest ffmpeg frames per second reported for a profile.", ('profile',))
+DOWNLOAD_BYTES = Counter('download_bytes_total', "Bytes fetched by yt-dlp.", ('extractor',))
+DOWNLOAD_SPEED = Gauge('download_speed_bytes', "Latest yt-dlp download speed in bytes per second.", ('extractor',))
+DOWNLOADS_FINISHED = Counter('downloads_finished_total', "Downloads that finished, by outcome.", ('status',))
+SPAWNS = Counter('subprocess_spawns_total', "Subprocesses started, by binary.", ('binary',))
+REQUEST_DURATION = Histogram('request_duration_seconds', "View latency.", ('view',), LATENCY_BUCKETS)
+STORAGE_EVICTED_BYTES = Counter('storage_evicted_bytes_total', "Bytes of media evicted to stay under a folder's quota.", ('folder',))
+STORAGE_ORPHANS_REMOVED = Counter('storage_orphans_removed_total', "Leftover partial files and temp dirs deleted, by kind.", ('kind',))
+# Filled in from the database at scrape time
+JOBS = Gauge('jobs', "Queued and running jobs.", ('status', 'profile'))
+DOWNLOADS = Gauge('downloads', "Queued and running downloads.", ('status',))
+STORAGE_BYTES = Gauge('storage_bytes', "Bytes of indexed media per folder.", ('folder',))
+
+
+def spawned(command):
+    """Counts a subprocess spawn under the binary's name (past any nice/ionice prefix)."""
+    names = [Path(str(arg)).name for arg in command]
+    SPAWNS.inc(binary=next((name for name in names if name.startswith('ff')), names[0] if names else ''))
+
+
+def timed(view_name):
+    """View decorator recording its latency in REQUEST_DURATION."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return view(request, *args, **kwargs)
+            finally:
+                REQUEST_DURATION.observe(time.perf_counter() - started, view=view_name)
+        return wrapper
+    return decorator
+
+
+# =========================
+# Store
+# =========================
+
+class MetricsStore:
+    """This process's series in memory, flushed to (and merged from) a shared SQLite file."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pid = None
+        self._initialized = False
+
+    def _reset(self):
+        """Starts over in a new process (including a forked worker, which inherits the parent's state)."""
+        self._pid = os.getpid()
+        self.host = socket.gethostname()
+        self.process = f"{self.host}:{self._pid}:{time.time():.0f}"
+        self._values = {}  # (name, label values) -> value
+        self._updated = {}
+        self._dirty = set()
+        self._local = threading.local()
+        self._flusher = None
+
+    @property
+    def path(self) -> Path:
+        return Path(getattr(settings, 'METRICS_PATH', settings.BASE_DIR / '.cache' / 'metrics.sqlite3'))
+
+    def update(self, key, fn):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            self._values[key] = fn(self._values.get(key))
+            self._updated[key] = time.time()
+            self._dirty.add(key)
+            start = self._flusher is None
+            if start:
+                self._flusher = threading.Thread(target=self._flush_loop, name="metrics-flusher", daemon=True)
+        if start:
+            self._flusher.start()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        # A forked child can't use its parent's connection
+        if conn is None or self._local.pid != os.getpid():
+            if not self._initialized:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if not self._initialized:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS samples ("
+                    " process TEXT NOT NULL, host TEXT NOT NULL, pid INTEGER NOT NULL,"
+                    " name TEXT NOT NULL, labels TEXT NOT NULL, value TEXT NOT NULL, updated REAL NOT NULL,"
+                    " PRIMARY KEY (process, name, labels))"
+                )
+                self._initialized = True
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def flush(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            rows = [
+                (self.process, self.host, self._pid, name, json.dumps(labels), json.dumps(self._values[(name, labels)]),
+                 self._updated[(name, labels)])
+                for name, labels in self._dirty
+            ]
+            dirty, self._dirty = self._dirty, set()
+        if not rows:
+            return
+        conn = self._conn()
+        try:
+            with conn:
+                conn.execute("BEGIN")
+                conn.executemany(
+                    "INSERT INTO samples (process, host, pid, name, labels, value, updated) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(process, name, labels) DO UPDATE SET value = excluded.value, updated = excluded.updated",
+                    rows
+                )
+        except sqlite3.Error as e:
+            print(f"Metrics write failed: {e}")
+            with self._lock:
+                self._dirty |= dirty
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(getattr(settings, 'METRICS_FLUSH_INTERVAL', 5))
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Metrics flush failed: {e}")
+
+    def _retire(self, conn):
+        """Folds the counters and histograms of exited processes on this host into the 'retired' rows."""
+        host = socket.gethostname()
+        dead = [
+            process for process, pid in conn.execute(
+                "SELECT DISTINCT process, pid FROM samples WHERE host = ? AND process != ?", (host, RETIRED)
+            )
+            if not pid_alive(pid)
+        ]
+        if not dead:
+            return
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for process in dead:
+                for name, labels, value in conn.execute(
+                    "SELECT name, labels, value FROM samples WHERE process = ?", (process,)
+                ).fetchall():
+                    metric = REGISTRY.get(name)
+                    if metric is None or metric.kind == 'gauge':
+                        continue
+                    row = conn.execute(
+                        "SELECT value FROM samples WHERE process = ? AND name = ? AND labels = ?", (RETIRED, name, labels)
+                    ).fetchone()
+                    merged = _merge(metric, json.loads(row[0]) if row else None, json.loads(value))
+                    conn.execute(
+                        "INSERT INTO samples (process, host, pid, name, labels, value, updated) VALUES (?, '', 0, ?, ?, ?, ?) "
+                        "ON CONFLICT(process, name, labels) DO UPDATE SET value = excluded.value, updated = excluded.updated",
+                        (RETIRED, name, labels, json.dumps(merged), time.time())
+                    )
+                conn.execute("DELETE FROM samples WHERE process = ?", (process,))
+
+    def collect(self) -> dict:
+        """name -> {label values: value}, merged over every process."""
+        self.flush()
+        conn = self._conn()
+        self._retire(conn)
+        merged = {}
+        newest = {}
+        for name, labels, value, updated in conn.execute("SELECT name, labels, value, updated FROM samples"):
+            metric = REGISTRY.get(name)
+            if metric is None:
+                continue  # Written by another version of the app
+            labels = tuple(json.loads(labels))
+            if len(labels) != len(metric.labels):
+                continue
+            value = json.loads(value)
+            series = merged.setdefault(name, {})
+            if metric.kind == 'gauge':
+                if updated >= newest.get((name, labels), 0):
+                    newest[(name, labels)] = updated
+                    series[labels] = value
+            else:
+                series[labels] = _merge(metric, series.get(labels), value)
+        return merged
+
+
+def _merge(metric, old, value):
+    if old is None:
+        return value
+    if metric.kind == 'histogram':
+        if len(old['b']) != len(value['b']):
+            return value  # Buckets changed between versions
+        return {'b': [a + b for a, b in zip(old['b'], value['b'])], 's': old['s'] + value['s'], 'c': old['c'] + value['c']}
+    return old + value
+
+
+STORE = MetricsStore()
+atexit.register(STORE.flush)
+
+
+# =========================
+# Exposition
+# =========================
+
+def _format(value) -> str:
+    if value == float('inf'):
+        return "+Inf"
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def _labels(names, values, extra=()) -> str:
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _queue_depths(series):
+    from django.db.models import Count
+    from .models import Download, Job
+
+    active = (Job.STATUS_QUEUED, Job.STATUS_RUNNING)
+    jobs = series.setdefault(JOBS.name, {})
+    for status in active:
+        jobs[(status, '')] = 0  # Present even when empty, so alerts see 0 rather than no data
+    for row in Job.objects.filter(status__in=active).values('status', 'profile').annotate(n=Count('id')):
+        jobs.pop((row['status'], ''), None)
+        jobs[(row['status'], row['profile'])] = row['n']
+
+    active = (Download.STATUS_QUEUED, Download.STATUS_RUNNING)
+    downloads = series.setdefault(DOWNLOADS.name, {})
+    for status in active:
+        downloads[(status,)] = 0
+    for row in Download.objects.filter(status__in=active).values('status').annotate(n=Count('id')):
+        downloads[(row['status'],)] = row['n']
+
+
+def _storage_usage(series):
+    from django.db.models import Sum
+    from .models import MediaFile
+
+    usage = series.setdefault(STORAGE_BYTES.name, {})
+    for row in MediaFile.objects.order_by().values('folder').annotate(total=Sum('size')):
+        usage[(row['folder'],)] = row['total'] or 0
+
+
+def render() -> str:
+    """Every metric in the Prometheus text format."""
+    series = STORE.collect()
+    _queue_depths(series)
+    _storage_usage(series)
+    lines = []
+    for name, metric in REGISTRY.items():
+        lines.append(f"# HELP {name} {metric.help}")
+        lines.append(f"# TYPE {name} {metric.kind}")
+        for labels, value in sorted(series.get(name, {}).items()):
+            if metric.kind != 'histogram':
+                lines.append(f"{name}{_labels(metric.labels, labels)} {_format(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip((*metric.buckets, float('inf')), value['b']):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(metric.labels, labels, [('le', _format(bound))])} {cumulative}")
+            lines.append(f"{name}_sum{_labels(metric.labels, labels)} {_format(value['s'])}")
+            lines.append(f"{name}_count{_labels(metric.labels, labels)} {value['c']}")
+    return "\n".join(lines) + "\n"
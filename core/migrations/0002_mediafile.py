@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-17 03:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=1024, unique=True)),
+                ('folder', models.CharField(max_length=64)),
+                ('source', models.CharField(max_length=32)),
+                ('name', models.CharField(max_length=512)),
+                ('extension', models.CharField(blank=True, max_length=16)),
+                ('size', models.BigIntegerField()),
+                ('mtime', models.FloatField()),
+                ('probed', models.BooleanField(default=False)),
+                ('probed_at', models.DateTimeField(blank=True, null=True)),
+                ('duration', models.FloatField(blank=True, null=True)),
+                ('format_name', models.CharField(blank=True, max_length=128)),
+                ('bit_rate', models.BigIntegerField(blank=True, null=True)),
+                ('video_codec', models.CharField(blank=True, max_length=64)),
+                ('audio_codec', models.CharField(blank=True, max_length=64)),
+                ('width', models.IntegerField(blank=True, null=True)),
+                ('height', models.IntegerField(blank=True, null=True)),
+                ('frame_rate', models.FloatField(blank=True, null=True)),
+                ('has_video', models.BooleanField(default=False)),
+                ('has_audio', models.BooleanField(default=False)),
+                ('streams', models.JSONField(blank=True, default=list)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['folder', 'name'],
+                'indexes': [models.Index(fields=['folder', 'name'], name='mediafile_folder_name_idx')],
+            },
+        ),
+    ]
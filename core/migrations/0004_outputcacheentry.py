@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-17 03:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_mediafile_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutputCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('profile', models.CharField(max_length=100)),
+                ('source_fingerprint', models.CharField(max_length=64)),
+                ('ready', models.BooleanField(default=False)),
+                ('outputs', models.JSONField(default=list)),
+                ('refcount', models.PositiveIntegerField(default=1)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(auto_now=True)),
+                ('job', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='core.job')),
+            ],
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:09
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_download'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='download',
+            name='job',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='core.job'),
+        ),
+        migrations.AddField(
+            model_name='download',
+            name='output_path',
+            field=models.CharField(blank=True, max_length=1024),
+        ),
+        migrations.AddField(
+            model_name='download',
+            name='process',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.CreateModel(
+            name='ArchivedVideo',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=512, unique=True)),
+                ('url_key', models.CharField(db_index=True, max_length=512)),
+                ('extractor', models.CharField(max_length=64)),
+                ('video_id', models.CharField(max_length=255)),
+                ('title', models.CharField(blank=True, max_length=512)),
+                ('path', models.CharField(max_length=1024)),
+                ('info', models.JSONField(blank=True, default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('download', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='core.download')),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_download_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProfileStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('profile', models.CharField(max_length=255)),
+                ('cost_class', models.CharField(max_length=16)),
+                ('runs', models.PositiveIntegerField(default=0)),
+                ('cores', models.FloatField(blank=True, null=True)),
+                ('peak_rss_mb', models.FloatField(blank=True, null=True)),
+                ('speed', models.FloatField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('profile', 'cost_class'), name='profilestats_profile_class')],
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_profilestats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TraceSpan',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task_id', models.CharField(db_index=True, max_length=64)),
+                ('name', models.CharField(max_length=128)),
+                ('depth', models.PositiveSmallIntegerField(default=0)),
+                ('start', models.DateTimeField()),
+                ('duration', models.FloatField()),
+                ('attrs', models.JSONField(blank=True, default=dict)),
+                ('process', models.CharField(blank=True, max_length=128)),
+            ],
+            options={
+                'ordering': ['start', 'id'],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_tracespan'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mediafile',
+            name='last_accessed',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
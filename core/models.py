@@ -1,3 +1,245 @@
+import uuid
+
 from django.db import models
 
-# Create your models here.
+
+class Job(models.Model):
+    """A queued background operation (an ffmpeg run), persisted so it survives restarts."""
+
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_COMPLETE = 'complete'
+    STATUS_FAILED = 'failed'
+    STATUS_CANCELLED = 'cancelled'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_COMPLETE, 'Complete'),
+        (STATUS_FAILED, 'Failed'),
+        (STATUS_CANCELLED, 'Cancelled'),
+    ]
+    FINISHED_STATUSES = (STATUS_COMPLETE, STATUS_FAILED, STATUS_CANCELLED)
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    kind = models.CharField(max_length=32, default='ffmpeg')
+    profile = models.CharField(max_length=100, blank=True)
+    command = models.JSONField(default=list, blank=True)
+    input_path = models.CharField(max_length=1024, blank=True)
+    output_path = models.CharField(max_length=1024, blank=True)
+    # Kind-specific options, and whatever the job produced
+    payload = models.JSONField(default=dict, blank=True)
+    result = models.JSONField(default=dict, blank=True)
+
+    priority = models.IntegerField(default=0)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=1)
+    cancel_requested = models.BooleanField(default=False)
+    error = models.TextField(blank=True)
+
+    # "host:pid" of the process running the job, used to recover jobs after a crash
+    worker = models.CharField(max_length=128, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-priority', 'created_at']
+        indexes = [
+            models.Index(fields=['status', '-priority', 'created_at'], name='job_claim_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.profile or self.kind} [{self.status}]"
+
+    @property
+    def is_finished(self):
+        return self.status in self.FINISHED_STATUSES
+
+
+class ProfileStats(models.Model):
+    """What a profile's jobs have cost so far, learned by the scheduler (core/scheduler.py)."""
+
+    profile = models.CharField(max_length=255)
+    # copy / light / heavy / gpu, see scheduler.classify()
+    cost_class = models.CharField(max_length=16)
+    runs = models.PositiveIntegerField(default=0)
+    # Moving averages over recent runs: CPU seconds per wall second (cores kept
+    # busy), peak RSS of the biggest process, and media seconds per wall second
+    cores = models.FloatField(null=True, blank=True)
+    peak_rss_mb = models.FloatField(null=True, blank=True)
+    speed = models.FloatField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['profile', 'cost_class'], name='profilestats_profile_class'),
+        ]
+
+    def __str__(self):
+        return f"{self.profile} ({self.cost_class})"
+
+
+class MediaFile(models.Model):
+    """ffprobe metadata for a file in the media library, keyed by (path, size, mtime)."""
+
+    path = models.CharField(max_length=1024, unique=True)  # relative to MEDIA_ROOT, '/' separated
+    folder = models.CharField(max_length=64)
+    source = models.CharField(max_length=32)
+    name = models.CharField(max_length=512)
+    extension = models.CharField(max_length=16, blank=True)
+    size = models.BigIntegerField()
+    mtime = models.FloatField()
+    # Fast content fingerprint (size + sampled chunks), see library.fingerprint()
+    fingerprint = models.CharField(max_length=64, blank=True, db_index=True)
+
+    probed = models.BooleanField(default=False)
+    probed_at = models.DateTimeField(null=True, blank=True)
+    duration = models.FloatField(null=True, blank=True)
+    format_name = models.CharField(max_length=128, blank=True)
+    bit_rate = models.BigIntegerField(null=True, blank=True)
+    video_codec = models.CharField(max_length=64, blank=True)
+    audio_codec = models.CharField(max_length=64, blank=True)
+    width = models.IntegerField(null=True, blank=True)
+    height = models.IntegerField(null=True, blank=True)
+    frame_rate = models.FloatField(null=True, blank=True)
+    has_video = models.BooleanField(default=False)
+    has_audio = models.BooleanField(default=False)
+    # One entry per stream: index, type, codec, profile, pix_fmt, channels, ...
+    streams = models.JSONField(default=list, blank=True)
+    # Last time the file was served or read by a job, for LRU eviction (see core/storage.py)
+    last_accessed = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['folder', 'name']
+        indexes = [
+            models.Index(fields=['folder', 'name'], name='mediafile_folder_name_idx'),
+        ]
+
+    def __str__(self):
+        return self.path
+
+    @property
+    def resolution(self):
+        if self.width and self.height:
+            return f"{self.width}x{self.height}"
+        return ""
+
+
+class OutputCacheEntry(models.Model):
+    """A processed output, keyed by input fingerprint + fully resolved command."""
+
+    key = models.CharField(max_length=64, unique=True)
+    profile = models.CharField(max_length=100)
+    source_fingerprint = models.CharField(max_length=64)
+    # The producing job; while it runs, identical requests are coalesced onto it
+    job = models.ForeignKey(Job, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    ready = models.BooleanField(default=False)
+    # Output paths relative to MEDIA_ROOT (several for segmenting commands)
+    outputs = models.JSONField(default=list)
+    # Requests holding this output (the original one included); cancelling releases a hold
+    refcount = models.PositiveIntegerField(default=1)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.profile} {self.key[:12]}"
+
+
+class Download(models.Model):
+    """A yt-dlp download, persisted so queued and interrupted downloads survive restarts."""
+
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_COMPLETE = 'complete'
+    STATUS_FAILED = 'failed'
+    STATUS_CANCELLED = 'cancelled'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_COMPLETE, 'Complete'),
+        (STATUS_FAILED, 'Failed'),
+        (STATUS_CANCELLED, 'Cancelled'),
+    ]
+    ACTIVE_STATUSES = (STATUS_QUEUED, STATUS_RUNNING)
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    url = models.URLField(max_length=2048)
+    # Canonical form of the URL (e.g. "youtube:<video id>"), used to spot duplicates
+    key = models.CharField(max_length=512)
+    # Per-host concurrency is limited on this (youtu.be counts as youtube.com)
+    host = models.CharField(max_length=255)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    cancel_requested = models.BooleanField(default=False)
+    error = models.TextField(blank=True)
+    # Profile to queue once the file is complete: {"op": key, "params": {...}}
+    process = models.JSONField(default=dict, blank=True)
+    # The finished file (relative to MEDIA_ROOT) and the job processing it
+    output_path = models.CharField(max_length=1024, blank=True)
+    job = models.ForeignKey(Job, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+
+    # "host:pid" of the process running the download, used to recover it after a crash
+    worker = models.CharField(max_length=128, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at']
+        constraints = [
+            # One queued/running download per URL; duplicates join it
+            models.UniqueConstraint(
+                fields=['key'], condition=models.Q(status__in=['queued', 'running']), name='download_active_key',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'host'], name='download_status_host_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.url} [{self.status}]"
+
+
+class ArchivedVideo(models.Model):
+    """A video that has been downloaded; asking for it again is answered from disk."""
+
+    # "<extractor>:<video id>", e.g. "youtube:dQw4w9WgXcQ" (the Download key for YouTube links)
+    key = models.CharField(max_length=512, unique=True)
+    # The Download key of the URL it was fetched from, for sites keyed by URL
+    url_key = models.CharField(max_length=512, db_index=True)
+    extractor = models.CharField(max_length=64)
+    video_id = models.CharField(max_length=255)
+    title = models.CharField(max_length=512, blank=True)
+    path = models.CharField(max_length=1024)  # relative to MEDIA_ROOT, '/' separated
+    # Selected fields of yt-dlp's info dict (see utils.DOWNLOAD_INFO_FIELDS)
+    info = models.JSONField(default=dict, blank=True)
+    download = models.ForeignKey(Download, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.key} -> {self.path}"
+
+
+class TraceSpan(models.Model):
+    """One timed phase of a job or download (see core/tracing.py)."""
+
+    # The job's or download's id
+    task_id = models.CharField(max_length=64, db_index=True)
+    name = models.CharField(max_length=128)
+    # 0 for the task's phases, 1+ for spans inside them (e.g. an ffmpeg run)
+    depth = models.PositiveSmallIntegerField(default=0)
+    start = models.DateTimeField()
+    duration = models.FloatField()
+    # What the span measured: ffmpeg benchmark figures, outcome, sizes, ...
+    attrs = models.JSONField(default=dict, blank=True)
+    # "host:pid" of the process that recorded it
+    process = models.CharField(max_length=128, blank=True)
+
+    class Meta:
+        ordering = ['start', 'id']
+
+    def __str__(self):
+        return f"{self.task_id} {self.name} {self.duration:.3f}s"
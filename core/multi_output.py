@@ -0,0 +1,181 @@
+"""
+Single-decode multi-output jobs.
+
+Running extract_audio_aac, resize_video and compress_high_quality on the same
+file as three jobs decodes it three times. Here the resolved commands of
+several profiles are fused into one ffmpeg invocation: the input is decoded
+once, a filter_complex splits the decoded video (and audio) once per output
+that re-encodes it, each branch gets that profile's -vf/-af filters, and every
+output keeps the rest of its profile's options:
+
+    ffmpeg -y -i in -filter_complex
+        "[0:v:0]split=2[vs0][vs1];[vs1]scale=1280:720[v1];[0:a:0]asplit=3[as0][as1][as2]"
+        -map [vs0] -map [as0] <compress options> out_compressed.mp4
+        -map [v1]  -map [as1] <resize options>   out_720p.mp4
+        -map [as2]            <audio options>    out.aac
+
+Streams a profile copies are mapped straight from the input.
+"""
+from .chunked import FLAG_OPTIONS
+
+# Global options that may appear before -i without affecting the decode
+GLOBAL_OPTIONS = {'-y', '-n', '-nostdin', '-hide_banner'}
+GLOBAL_VALUE_OPTIONS = {'-v', '-loglevel'}
+VIDEO_FILTER_OPTIONS = ('-vf', '-filter:v')
+AUDIO_FILTER_OPTIONS = ('-af', '-filter:a')
+CODEC_OPTIONS = {'-c', '-codec', '-c:v', '-codec:v', '-vcodec', '-c:a', '-codec:a', '-acodec'}
+
+
+class FusionError(ValueError):
+    pass
+
+
+class OutputSpec:
+    """One profile's output: how its video/audio are fed and its remaining options."""
+
+    def __init__(self, key, path, options, video, audio, vf=None, af=None, passthrough=False):
+        self.key = key
+        self.path = path
+        self.options = options
+        self.video = video  # 'encode', 'copy' or None
+        self.audio = audio
+        self.vf = vf
+        self.af = af
+        self.passthrough = passthrough
+
+
+class OutputOptions:
+    """A profile's output options, sorted into maps, filters, codecs and the rest."""
+
+    def __init__(self):
+        self.maps = []
+        self.kept = []  # Everything not listed below, in order
+        self.vf = None
+        self.af = None
+        self.video_off = False
+        self.audio_off = False
+        self.filter_complex = None
+        self.codecs = {}  # -c / -c:v / -c:a (and aliases) -> value
+
+    @property
+    def video_codec(self):
+        both = self.codecs.get('-c', self.codecs.get('-codec'))
+        return self.codecs.get('-c:v', self.codecs.get('-codec:v', self.codecs.get('-vcodec', both)))
+
+    @property
+    def audio_codec(self):
+        both = self.codecs.get('-c', self.codecs.get('-codec'))
+        return self.codecs.get('-c:a', self.codecs.get('-codec:a', self.codecs.get('-acodec', both)))
+
+
+def parse_options(options) -> OutputOptions:
+    """Sorts the options between `-i <input>` and the output path."""
+    parts = OutputOptions()
+    j = 0
+    while j < len(options):
+        arg = options[j]
+        if arg in FLAG_OPTIONS:
+            parts.video_off = parts.video_off or arg == '-vn'
+            parts.audio_off = parts.audio_off or arg == '-an'
+            if arg not in ('-vn', '-an', '-y', '-n', '-nostdin'):
+                parts.kept.append(arg)
+            j += 1
+            continue
+        value = options[j + 1] if j + 1 < len(options) else ''
+        if arg == '-map':
+            parts.maps += [arg, value]
+        elif arg in ('-filter_complex', '-lavfi'):
+            parts.filter_complex = value
+        elif arg in VIDEO_FILTER_OPTIONS:
+            parts.vf = value
+        elif arg in AUDIO_FILTER_OPTIONS:
+            parts.af = value
+        else:
+            if arg in CODEC_OPTIONS:
+                parts.codecs[arg] = value
+            parts.kept += [arg, value]
+        j += 2
+    return parts
+
+
+def parse_output(key, command, has_video=True, has_audio=True) -> OutputSpec:
+    """Takes one resolved single-profile command apart. Raises FusionError if it can't share a decode."""
+    command = list(command)
+    if command.count('-i') != 1:
+        raise FusionError(f"{key} doesn't have exactly one input.")
+    i = command.index('-i')
+    j = 1
+    while j < i:
+        if command[j] in GLOBAL_OPTIONS:
+            j += 1
+        elif command[j] in GLOBAL_VALUE_OPTIONS:
+            j += 2
+        else:
+            raise FusionError(f"{key} uses input option {command[j]} and needs its own decode.")
+
+    parts = parse_options(command[i + 2:-1])
+    if parts.filter_complex:
+        raise FusionError(f"{key} has its own filtergraph.")
+    maps, kept, vf, af, codecs = parts.maps, parts.kept, parts.vf, parts.af, parts.codecs
+    video_off, audio_off = parts.video_off, parts.audio_off
+
+    both = codecs.get('-c', codecs.get('-codec'))
+    vcodec, acodec = parts.video_codec, parts.audio_codec
+    output = command[-1]
+
+    if both == 'copy' and vcodec == 'copy' and acodec == 'copy' and not vf and not af:
+        # Pure remux: keep the profile's own stream selection
+        return OutputSpec(key, output, maps + kept, None, None, passthrough=True)
+
+    video = None if video_off or not has_video else ('copy' if vcodec == 'copy' else 'encode')
+    audio = None if audio_off or not has_audio else ('copy' if acodec == 'copy' else 'encode')
+    if video is None and audio is None:
+        raise FusionError(f"{key} has no stream to produce from this file.")
+    if not has_video and not video_off and vcodec not in (None, 'copy'):
+        raise FusionError(f"{key} needs a video stream.")
+    return OutputSpec(key, output, kept, video, audio, vf, af)
+
+
+def _branches(specs, kind, source, split, null, filter_attr):
+    """Filtergraph chains feeding every spec that encodes `kind`; returns (chains, spec index -> label)."""
+    users = [n for n, spec in enumerate(specs) if getattr(spec, kind) == 'encode']
+    chains, labels = [], {}
+    if not users:
+        return chains, labels
+    prefix = kind[0]
+    if len(users) == 1:
+        n = users[0]
+        chains.append(f"[{source}]{getattr(specs[n], filter_attr) or null}[{prefix}{n}]")
+        labels[n] = f"[{prefix}{n}]"
+        return chains, labels
+    chains.append(f"[{source}]{split}={len(users)}" + "".join(f"[{prefix}s{n}]" for n in users))
+    for n in users:
+        filters = getattr(specs[n], filter_attr)
+        if filters:
+            chains.append(f"[{prefix}s{n}]{filters}[{prefix}{n}]")
+            labels[n] = f"[{prefix}{n}]"
+        else:
+            labels[n] = f"[{prefix}s{n}]"
+    return chains, labels
+
+
+def build(input_path, specs) -> list:
+    """The fused command for a list of OutputSpecs."""
+    video_chains, video_labels = _branches(specs, 'video', '0:v:0', 'split', 'null', 'vf')
+    audio_chains, audio_labels = _branches(specs, 'audio', '0:a:0', 'asplit', 'anull', 'af')
+    command = ["ffmpeg", "-y", "-i", str(input_path)]
+    if video_chains or audio_chains:
+        command += ["-filter_complex", ";".join(video_chains + audio_chains)]
+
+    for n, spec in enumerate(specs):
+        if not spec.passthrough:
+            if spec.video == 'encode':
+                command += ["-map", video_labels[n]]
+            elif spec.video == 'copy':
+                command += ["-map", "0:v:0"]
+            if spec.audio == 'encode':
+                command += ["-map", audio_labels[n]]
+            elif spec.audio == 'copy':
+                command += ["-map", "0:a:0"]
+        command += [*spec.options, str(spec.path)]
+    return command
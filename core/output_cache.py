@@ -0,0 +1,133 @@
+"""
+Content-addressed cache of processed outputs.
+
+Running the same profile with the same parameters on the same file produces
+the same result, so process_video looks the request up by
+sha256(input fingerprint + resolved command) first:
+
+- a finished entry whose files still exist is returned instantly;
+- an entry whose job is still queued/running is shared (the request gets that
+  job's task id instead of starting a second encode);
+- otherwise a new job is enqueued and recorded under the key.
+
+Each entry counts the requests holding it (refcount). A requester cancelling
+a shared job only releases its hold; the job is cancelled when nobody else
+holds it. Storage eviction skips shared outputs. Entries are dropped when
+their job fails or is cancelled, or when one of their output files is
+deleted (the next identical request encodes it again).
+"""
+import hashlib
+import json
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from .models import Job, OutputCacheEntry
+
+# Placeholders whose values are per-request paths rather than part of the operation
+PATH_PLACEHOLDERS = {'input': '{input}', 'output': '{output}', 'output_pattern': '{output_pattern}'}
+
+
+def cache_key(fingerprint: str, resolved_command: list) -> str:
+    raw = json.dumps([fingerprint, resolved_command], separators=(',', ':'))
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def key_for(fingerprint, compiled, params: dict) -> str | None:
+    """Key for running `compiled` with `params` on the file with `fingerprint`."""
+    if not fingerprint:
+        return None
+    return cache_key(fingerprint, compiled.build(**{**params, **PATH_PLACEHOLDERS}))
+
+
+def _relative(path) -> str:
+    return str(path).replace('\\', '/').removeprefix(str(settings.MEDIA_ROOT).replace('\\', '/') + '/')
+
+
+def _outputs_exist(entry) -> bool:
+    return bool(entry.outputs) and all((settings.MEDIA_ROOT / p).exists() for p in entry.outputs)
+
+
+def lookup(key):
+    """Returns a reusable entry (finished with files present, or still in progress) or None.
+
+    A returned entry has had its refcount bumped for the caller.
+    """
+    if key is None:
+        return None
+    entry = OutputCacheEntry.objects.select_related('job').filter(key=key).first()
+    if entry is None:
+        return None
+
+    usable = (
+        (entry.ready and _outputs_exist(entry))
+        or (not entry.ready and entry.job is not None and not entry.job.is_finished)
+    )
+    if not usable:
+        entry.delete()
+        return None
+    OutputCacheEntry.objects.filter(pk=entry.pk).update(refcount=F('refcount') + 1)
+    return entry
+
+
+def register(key, job: Job, fingerprint: str) -> bool:
+    """Records a newly enqueued job under its key. False if another request got there first."""
+    if key is None:
+        return False
+    try:
+        with transaction.atomic():
+            OutputCacheEntry.objects.create(
+                key=key, profile=job.profile, source_fingerprint=fingerprint, job=job,
+                outputs=[_relative(job.output_path)],
+            )
+        return True
+    except IntegrityError:
+        return False
+
+
+def job_finished(job_id, status: str, outputs=None):
+    """Marks the job's entry ready (recording its actual outputs) or drops it on failure."""
+    entries = OutputCacheEntry.objects.filter(job_id=job_id, ready=False)
+    if status != Job.STATUS_COMPLETE:
+        entries.delete()
+        return
+    if outputs:
+        entries.update(ready=True, outputs=[_relative(p) for p in outputs])
+    else:
+        entries.update(ready=True)
+
+
+def _release(entry) -> int:
+    """Drops one hold on an entry unless it's the last. Returns how many holds remain (0: the last one)."""
+    if entry.refcount > 1 and OutputCacheEntry.objects.filter(pk=entry.pk, refcount__gt=1).update(
+            refcount=F('refcount') - 1):
+        return entry.refcount - 1
+    return 0
+
+
+def release(job_id) -> int:
+    """Releases one requester's hold on a job still running for the cache.
+
+    Returns how many other requesters still wait on it; cancel the job only at 0.
+    """
+    entry = OutputCacheEntry.objects.filter(job_id=job_id, ready=False).first()
+    return _release(entry) if entry is not None else 0
+
+
+def _entries_with(rel_path: str) -> list:
+    candidates = OutputCacheEntry.objects.filter(outputs__icontains=rel_path)
+    return [e for e in candidates if rel_path in e.outputs]
+
+
+def holders(rel_path: str) -> int:
+    """How many requests hold the output file rel_path (0 if it isn't cached)."""
+    return max((e.refcount for e in _entries_with(rel_path)), default=0)
+
+
+def forget_output(rel_path: str) -> int:
+    """Drops the entries with an output file that is being deleted. Returns how many."""
+    entries = _entries_with(rel_path)
+    if entries:
+        OutputCacheEntry.objects.filter(pk__in=[e.pk for e in entries]).delete()
+    return len(entries)
@@ -0,0 +1,268 @@
+"""
+Per-file keyframe / packet index.
+
+Trimming, chunk planning and similar operations need to know where the
+keyframes are. Rather than having ffprobe rescan the file every time, one
+streaming ffprobe pass over the first video stream's packets is stored in a
+compact binary sidecar, named by the file's content fingerprint (like the
+thumbnails), and memory-mapped on load:
+
+    header   magic, packet count n, keyframe count m
+    float64  pts[n]          packet presentation times, sorted
+    int64    pos[n]          byte offset of each packet (-1 if unknown)
+    int64    cum_size[n+1]   running total of packet sizes (cum_size[0] = 0)
+    float64  kf_pts[m]       keyframe times, sorted
+    int64    kf_pos[m]       keyframe byte offsets
+
+Queries are bisections over the mapped arrays, so nothing is parsed or
+copied when an index is opened.
+"""
+import mmap
+import os
+import struct
+import subprocess
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from pathlib import Path
+
+from django.conf import settings
+
+from . import library, metrics
+
+MAGIC = b'HFPIDX01'
+HEADER = struct.Struct('<8sQQ')
+# Open (mapped) indexes kept around, most recently used last
+MAX_OPEN = 32
+
+_open = OrderedDict()
+_lock = threading.Lock()
+_building = {}
+
+
+def index_dir() -> Path:
+    return settings.MEDIA_ROOT / ".index"
+
+
+def index_path(fingerprint: str) -> Path:
+    return index_dir() / fingerprint[:2] / f"{fingerprint}.pkt"
+
+
+class PacketIndex:
+    """Read-only view over an index buffer (an mmap or bytes)."""
+
+    def __init__(self, buffer):
+        magic, n, m = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a packet index")
+        expected = HEADER.size + 8 * (n + n + (n + 1) + m + m)
+        if len(buffer) != expected:
+            raise ValueError("Truncated packet index")
+        self._buffer = buffer
+        view = memoryview(buffer)
+        offset = HEADER.size
+
+        def take(fmt, count):
+            nonlocal offset
+            part = view[offset:offset + 8 * count].cast(fmt)
+            offset += 8 * count
+            return part
+
+        self.pts = take('d', n)
+        self.pos = take('q', n)
+        self.cum_size = take('q', n + 1)
+        self.kf_pts = take('d', m)
+        self.kf_pos = take('q', m)
+
+    def __len__(self):
+        return len(self.pts)
+
+    @property
+    def duration(self) -> float:
+        return self.pts[-1] - self.pts[0] if len(self.pts) else 0.0
+
+    @property
+    def keyframe_times(self) -> list:
+        return self.kf_pts.tolist()
+
+    def keyframe_before(self, t, inclusive=True):
+        """Latest keyframe time <= t (< t if not inclusive), or None."""
+        i = (bisect_right if inclusive else bisect_left)(self.kf_pts, t)
+        return self.kf_pts[i - 1] if i else None
+
+    def keyframe_after(self, t, inclusive=True):
+        """Earliest keyframe time >= t (> t if not inclusive), or None."""
+        i = (bisect_left if inclusive else bisect_right)(self.kf_pts, t)
+        return self.kf_pts[i] if i < len(self.kf_pts) else None
+
+    def keyframe_offset(self, t):
+        """Byte offset of the latest keyframe <= t, or None."""
+        i = bisect_right(self.kf_pts, t)
+        return self.kf_pos[i - 1] if i and self.kf_pos[i - 1] >= 0 else None
+
+    def keyframes_between(self, start, end) -> list:
+        return self.kf_pts[bisect_left(self.kf_pts, start):bisect_right(self.kf_pts, end)].tolist()
+
+    def bytes_between(self, start, end) -> int:
+        """Total size of the packets presented in [start, end)."""
+        i, j = bisect_left(self.pts, start), bisect_left(self.pts, end)
+        return self.cum_size[j] - self.cum_size[i]
+
+    def bitrate(self, start, end) -> float | None:
+        """Average video bitrate (bits/s) over [start, end)."""
+        if end <= start:
+            return None
+        return self.bytes_between(start, end) * 8 / (end - start)
+
+
+# =========================
+# Building
+# =========================
+
+def _float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def scan(path) -> bytes:
+    """One streaming ffprobe pass over the first video stream's packets, serialized."""
+    command = [
+        "ffprobe", "-v", "error", "-select_streams", "v:0",
+        "-show_entries", "packet=pts_time,dts_time,size,pos,flags",
+        "-of", "compact=p=0", str(path)
+    ]
+    packets = []  # (pts, pos, size, keyframe)
+    metrics.spawned(command)
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, bufsize=1 << 16)
+    try:
+        for line in process.stdout:
+            fields = dict(item.partition('=')[::2] for item in line.strip().split('|'))
+            pts = _float(fields.get('pts_time', ''))
+            if pts is None:
+                pts = _float(fields.get('dts_time', ''))
+            if pts is None:
+                pts = packets[-1][0] if packets else 0.0
+            size = int(fields['size']) if fields.get('size', '').isdigit() else 0
+            pos = int(fields['pos']) if fields.get('pos', '').isdigit() else -1
+            packets.append((pts, pos, size, 'K' in fields.get('flags', '')))
+    finally:
+        process.stdout.close()
+        process.wait()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    return serialize(packets)
+
+
+def serialize(packets) -> bytes:
+    packets = sorted(packets, key=lambda p: p[0])
+    pts, pos, cum_size = array('d'), array('q'), array('q', [0])
+    kf_pts, kf_pos = array('d'), array('q')
+    total = 0
+    for t, offset, size, keyframe in packets:
+        pts.append(t)
+        pos.append(offset)
+        total += size
+        cum_size.append(total)
+        if keyframe:
+            kf_pts.append(t)
+            kf_pos.append(offset)
+    parts = [HEADER.pack(MAGIC, len(pts), len(kf_pts))]
+    for arr in (pts, pos, cum_size, kf_pts, kf_pos):
+        if arr.itemsize != 8:
+            raise ValueError("Unexpected array item size")
+        parts.append(arr.tobytes())
+    return b''.join(parts)
+
+
+def _write(path: Path, data: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}")
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _load(path: Path) -> PacketIndex | None:
+    try:
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    try:
+        return PacketIndex(buffer)
+    except (ValueError, struct.error):
+        buffer.close()
+        return None
+
+
+# =========================
+# Lookup
+# =========================
+
+def get_index(path, fingerprint=None) -> PacketIndex | None:
+    """The packet index for a media file, building and storing it on first use.
+
+    Without a fingerprint the file's library entry provides one; files that
+    aren't in the library get an in-memory index that isn't stored.
+    """
+    if fingerprint is None:
+        try:
+            entry = library.index_file(path)
+        except ValueError:  # Not under MEDIA_ROOT
+            entry = None
+        fingerprint = entry.fingerprint if entry is not None else ''
+
+    if fingerprint:
+        with _lock:
+            index = _open.get(fingerprint)
+            if index is not None:
+                _open.move_to_end(fingerprint)
+                return index
+            # One build per file even if several jobs ask at once
+            building = _building.setdefault(fingerprint, threading.Lock())
+        with building:
+            index = _load(index_path(fingerprint))
+            if index is None:
+                index = _build(path, index_path(fingerprint))
+            if index is not None:
+                _remember(fingerprint, index)
+        with _lock:
+            _building.pop(fingerprint, None)
+        return index
+
+    try:
+        return PacketIndex(scan(path))
+    except (subprocess.CalledProcessError, FileNotFoundError, ValueError):
+        return None
+
+
+def _build(path, target: Path) -> PacketIndex | None:
+    try:
+        data = scan(path)
+    except (subprocess.CalledProcessError, FileNotFoundError) as e:
+        print(f"Packet index build failed for {path}: {e}")
+        return None
+    try:
+        _write(target, data)
+    except OSError as e:
+        print(f"Packet index write failed for {path}: {e}")
+        return PacketIndex(data)
+    return _load(target) or PacketIndex(data)
+
+
+def _remember(fingerprint, index):
+    with _lock:
+        _open[fingerprint] = index
+        _open.move_to_end(fingerprint)
+        # Evicted indexes are just dropped: a caller may still be using one,
+        # and the mapping is released when it's garbage collected
+        while len(_open) > MAX_OPEN:
+            _open.popitem(last=False)
+
+
+def keyframe_times(path, fingerprint=None) -> list:
+    index = get_index(path, fingerprint)
+    return index.keyframe_times if index is not None else []
@@ -0,0 +1,301 @@
+"""
+Operation pipelines fused into as few ffmpeg runs as possible.
+
+A pipeline is an ordered list of registry profiles with their parameters,
+e.g. trim -> resize -> compress:
+
+    [{"op": "trim_reencode", "params": {"start": "60", "end": "120"}},
+     {"op": "resize_video", "params": {"width": 1280, "height": 720}},
+     {"op": "compress_ultra"}]
+
+Run naively that's three decode/encode cycles and two intermediate files.
+Here consecutive steps are fused into one stage: trims become input seeks
+(composed when several follow each other), -vf/-af filters are chained in
+order, and only the last step's encoder settings are used. A new stage is
+started only where fusing is impossible: a step with its own filtergraph,
+hardware decoding or other input options, or a trim after a filter that
+changes timing. Intermediate files between stages are lossless (so splitting
+adds no generation loss) and go to tmpfs when it has room.
+"""
+import os
+import re
+import shutil
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+from django.conf import settings
+
+from .ffmpeg import parse_time
+from .multi_output import GLOBAL_OPTIONS, GLOBAL_VALUE_OPTIONS, parse_options
+from .utils import COMMAND_REGISTRY
+
+TRIM_OPTIONS = {'-ss', '-to', '-t'}
+# Filters after which a trim can no longer be turned into an input seek
+TIMING_FILTERS = {
+    'setpts', 'asetpts', 'atempo', 'fps', 'framerate', 'minterpolate', 'trim', 'atrim',
+    'select', 'aselect', 'tpad', 'apad', 'loop', 'aloop', 'reverse', 'areverse',
+}
+# Encoder settings dropped from non-final stages, which write lossless intermediates instead
+ENCODER_OPTIONS = {
+    '-c', '-codec', '-c:v', '-codec:v', '-vcodec', '-c:a', '-codec:a', '-acodec',
+    '-crf', '-qp', '-cq', '-rc', '-preset', '-tune', '-profile:v', '-level',
+    '-b:v', '-maxrate', '-bufsize', '-b:a', '-q:a', '-x264-params', '-x265-params', '-movflags', '-f',
+}
+# Options only valid for the final output's container
+CONTAINER_OPTIONS = {'-movflags', '-f'}
+LOSSLESS_OPTIONS = ['-c:v', 'libx264', '-qp', '0', '-preset', 'ultrafast', '-c:a', 'pcm_s16le']
+INTERMEDIATE_EXT = '.mkv'
+# Lossless intermediates can be many times the size of the source
+INTERMEDIATE_SIZE_FACTOR = 8
+
+
+class PipelineError(ValueError):
+    pass
+
+
+class Step:
+    def __init__(self, key, compiled, params):
+        self.key = key
+        self.compiled = compiled
+        self.params = params
+
+    def resolve(self, input_path, output_path) -> list:
+        return self.compiled.build(**{
+            **self.params, 'input': str(input_path), 'output': str(output_path),
+            'output_pattern': str(output_path),
+        })
+
+
+def _filter_names(chain):
+    return {part.split('=', 1)[0].strip().split(']')[-1] for part in re.split(r'[,;]', chain or '')}
+
+
+class Stage:
+    """Steps fused into one ffmpeg run, or a single step that runs on its own."""
+
+    def __init__(self):
+        self.steps = []
+        self.start = None
+        self.end = None
+        self.vf = []
+        self.af = []
+        self.encoders = []  # (options, maps, copies) of steps with codec settings
+        self.video_off = False
+        self.audio_off = False
+        self.timing_changed = False
+        self.standalone = None  # A step that can't be fused
+
+    def add_trim(self, start, end):
+        """Composes a trim onto the stage's window. False if it can't be (timing changed)."""
+        if self.timing_changed:
+            return False
+        if self.start is None:
+            self.start, self.end = start, end
+            return True
+        offset = self.start
+        self.start = offset + start
+        if end is not None:
+            self.end = min(offset + end, self.end) if self.end is not None else offset + end
+        return True
+
+    def command(self, input_path, output_path, final) -> list:
+        has_filters = bool(self.vf or self.af)
+        encoder = None
+        for options, maps, copies in reversed(self.encoders):
+            # Stream copy can't carry filtered frames; fall back to an earlier encoder
+            if copies and has_filters:
+                continue
+            encoder = (options, maps, copies)
+            break
+        options, maps, copies = encoder or ([], [], False)
+
+        command = ["ffmpeg", "-y"]
+        if self.start:
+            command += ["-ss", f"{self.start:.6f}"]
+        if self.end is not None:
+            command += ["-to", f"{self.end:.6f}"]
+        command += ["-i", str(input_path), *maps]
+        # Filters for a stream a later step drops would have nothing to feed
+        if self.vf and not self.video_off:
+            command += ["-vf", ",".join(self.vf)]
+        if self.af and not self.audio_off:
+            command += ["-af", ",".join(self.af)]
+        if final:
+            command += options
+        elif copies:
+            command += _strip_options(options, CONTAINER_OPTIONS)
+        else:
+            command += [*_strip_options(options, ENCODER_OPTIONS), *LOSSLESS_OPTIONS]
+        if self.video_off:
+            command.append("-vn")
+        if self.audio_off:
+            command.append("-an")
+        return command + [str(output_path)]
+
+
+def _strip_options(options, names) -> list:
+    kept = []
+    j = 0
+    while j < len(options):
+        if options[j] in names:
+            j += 2
+            continue
+        kept.append(options[j])
+        j += 1
+    return kept
+
+
+def _split(command):
+    """(input options, output options) of a resolved single-input command."""
+    if command.count('-i') != 1:
+        return None, None
+    i = command.index('-i')
+    return command[1:i], command[i + 2:-1]
+
+
+def fuse(steps) -> list:
+    """Groups the steps into stages."""
+    if not steps:
+        raise PipelineError("A pipeline needs at least one step.")
+    stages = [Stage()]
+    video_gone = audio_gone = False
+    for n, step in enumerate(steps):
+        stage = stages[-1]
+        command = step.resolve('{input}', '{output}')
+        input_options, output_options = _split(command)
+        parts = parse_options(output_options) if output_options is not None else None
+
+        if parts is not None and video_gone and (parts.vf or parts.video_codec not in (None, 'copy')):
+            raise PipelineError(f"{step.key} needs video, but an earlier step removed it.")
+        if parts is not None and audio_gone and parts.af:
+            raise PipelineError(f"{step.key} needs audio, but an earlier step removed it.")
+
+        # Input options other than trimming (e.g. -hwaccel), segmenting, output-side
+        # seeks and own filtergraphs mean the step runs as its own stage
+        trim = {}
+        fusable = parts is not None and step.compiled.engine == 'ffmpeg' and not parts.filter_complex
+        if fusable:
+            j = 0
+            while j < len(input_options):
+                arg = input_options[j]
+                if arg in GLOBAL_OPTIONS:
+                    j += 1
+                elif arg in GLOBAL_VALUE_OPTIONS:
+                    j += 2
+                elif arg in TRIM_OPTIONS:
+                    trim[arg] = parse_time(input_options[j + 1])
+                    j += 2
+                else:
+                    fusable = False
+                    break
+            kept = parts.kept
+            if any(arg in TRIM_OPTIONS for arg in kept) or 'segment' in kept:
+                fusable = False
+        if not fusable:
+            if 'segment' in command and n != len(steps) - 1:
+                raise PipelineError(f"{step.key} writes several files, so it must be the last step.")
+            if stage.steps:
+                stages.append(Stage())
+            stages[-1].steps.append(step)
+            stages[-1].standalone = step
+            if parts is not None:
+                video_gone = video_gone or parts.video_off
+                audio_gone = audio_gone or parts.audio_off
+            stages.append(Stage())
+            continue
+
+        if stage.standalone is not None:
+            stages.append(Stage())
+            stage = stages[-1]
+        if trim:
+            start = trim.get('-ss') or 0.0
+            end = trim.get('-to')
+            if end is None and trim.get('-t') is not None:
+                end = start + trim['-t']
+            if not stage.add_trim(start, end):
+                stages.append(Stage())
+                stage = stages[-1]
+                stage.add_trim(start, end)
+
+        stage.steps.append(step)
+        if parts.vf:
+            stage.vf.append(parts.vf)
+            stage.timing_changed = stage.timing_changed or bool(_filter_names(parts.vf) & TIMING_FILTERS)
+        if parts.af:
+            stage.af.append(parts.af)
+            stage.timing_changed = stage.timing_changed or bool(_filter_names(parts.af) & TIMING_FILTERS)
+        if parts.codecs:
+            copies = 'copy' in (parts.video_codec, parts.audio_codec)
+            stage.encoders.append((parts.kept, parts.maps, copies))
+        stage.video_off = stage.video_off or parts.video_off
+        stage.audio_off = stage.audio_off or parts.audio_off
+        video_gone = video_gone or parts.video_off
+        audio_gone = audio_gone or parts.audio_off
+
+    return [stage for stage in stages if stage.steps]
+
+
+def load_steps(data) -> list:
+    """Steps from a pipeline declaration: [{"op": profile key, "params": {...}}, ...]."""
+    if not isinstance(data, list) or not data:
+        raise PipelineError("A pipeline needs at least one step.")
+    steps = []
+    for n, item in enumerate(data, 1):
+        if not isinstance(item, dict):
+            raise PipelineError(f"Step {n} must be an object.")
+        key = item.get('op')
+        compiled = COMMAND_REGISTRY.get(key) if isinstance(key, str) else None
+        if compiled is None:
+            raise PipelineError(f"Step {n}: unknown operation {key!r}.")
+        params = item.get('params') or {}
+        if not isinstance(params, dict):
+            raise PipelineError(f"Step {n}: params must be an object.")
+        missing = [p for p in compiled.parameters if params.get(p) in (None, "")]
+        if missing:
+            raise PipelineError(f"Step {n} ({key}) is missing {', '.join(missing)}.")
+        steps.append(Step(key, compiled, {k: str(v) for k, v in params.items()}))
+    return steps
+
+
+def plan(steps, input_path, output_path, tmp_dir) -> list:
+    """The ffmpeg commands that run the pipeline, in order."""
+    stages = fuse(steps)
+    commands = []
+    current = input_path
+    for n, stage in enumerate(stages):
+        final = n == len(stages) - 1
+        target = output_path if final else Path(tmp_dir) / f"stage_{n}{INTERMEDIATE_EXT}"
+        if stage.standalone is not None:
+            command = stage.standalone.resolve(current, target)
+            if not final:
+                i = command.index('-i')
+                command = [*command[:i + 2], *_strip_options(command[i + 2:-1], ENCODER_OPTIONS), *LOSSLESS_OPTIONS, str(target)]
+        else:
+            command = stage.command(current, target, final)
+        commands.append(command)
+        current = target
+    return commands
+
+
+@contextmanager
+def intermediate_dir(output_path, source_size, stages):
+    """Directory for intermediates: tmpfs when it has room, else a hidden dir beside the output."""
+    output = Path(output_path)
+    needed = source_size * INTERMEDIATE_SIZE_FACTOR * max(min(stages - 1, 2), 0)
+    tmpfs = getattr(settings, 'PIPELINE_TMPFS', '/dev/shm')
+    base = None
+    if needed and tmpfs and os.path.isdir(tmpfs):
+        try:
+            if shutil.disk_usage(tmpfs).free > needed:
+                base = tmpfs
+        except OSError:
+            pass
+    if base is None:
+        path = tempfile.mkdtemp(prefix=f".{output.stem}.pipeline-", dir=output.parent)
+    else:
+        path = tempfile.mkdtemp(prefix="hyperframe-pipeline-", dir=base)
+    try:
+        yield Path(path)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,281 @@
+"""
+Progress store shared by every web/worker process.
+
+PROGRESS_CACHE (core/globals.py) used to be a plain dict, which only the
+process that ran a task could see and which never shrank. The stores here keep
+the same dict-style API (store[task_id] = {...}, store.get(task_id)) but:
+
+- SQLiteProgressStore keeps entries in a WAL-mode SQLite file every process
+  can read, and batches frequent updates (yt-dlp calls its hook many times a
+  second) into periodic writes. Finished states are written immediately.
+- Finished tasks are evicted after a TTL and the total number of entries is
+  capped, so a long-running server doesn't grow without bound.
+"""
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from django.conf import settings
+
+FINISHED_STATUSES = {'complete', 'error', 'cancelled'}
+
+DEFAULTS = {
+    'BACKEND': 'sqlite',
+    'PATH': None,
+    # Seconds a finished task stays visible to pollers
+    'TTL': 3600,
+    # Unfinished tasks nobody has updated for this long are dropped too
+    'STALE_TTL': 24 * 3600,
+    'MAX_ENTRIES': 10000,
+    # Seconds between batched writes of in-flight progress
+    'FLUSH_INTERVAL': 0.5,
+}
+
+
+def _is_finished(data) -> bool:
+    return isinstance(data, dict) and data.get('status') in FINISHED_STATUSES
+
+
+class BaseProgressStore:
+    """Dict-style access on top of get()/set()."""
+
+    def get(self, task_id, default=None):
+        raise NotImplementedError
+
+    def set(self, task_id, data):
+        raise NotImplementedError
+
+    def delete(self, task_id):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def __getitem__(self, task_id):
+        data = self.get(task_id)
+        if data is None:
+            raise KeyError(task_id)
+        return data
+
+    def __setitem__(self, task_id, data):
+        self.set(task_id, data)
+
+    def __delitem__(self, task_id):
+        self.delete(task_id)
+
+    def __contains__(self, task_id):
+        return self.get(task_id) is not None
+
+
+class MemoryProgressStore(BaseProgressStore):
+    """Single-process store (the old behaviour) with TTL eviction and a size cap."""
+
+    def __init__(self, ttl=3600, stale_ttl=24 * 3600, max_entries=10000, **kwargs):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._data = OrderedDict()  # task_id -> (data, updated), oldest first
+        self._lock = threading.Lock()
+        self._last_evict = 0.0
+
+    def get(self, task_id, default=None):
+        with self._lock:
+            entry = self._data.get(task_id)
+        if entry is None or self._expired(entry, time.time()):
+            return default
+        return entry[0]
+
+    def set(self, task_id, data):
+        now = time.time()
+        with self._lock:
+            self._data[task_id] = (data, now)
+            self._data.move_to_end(task_id)
+            self._evict(now)
+
+    def delete(self, task_id):
+        with self._lock:
+            self._data.pop(task_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def _expired(self, entry, now):
+        data, updated = entry
+        return now - updated > (self.ttl if _is_finished(data) else self.stale_ttl)
+
+    def _evict(self, now):
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+        if now - self._last_evict < 10:
+            return
+        self._last_evict = now
+        # Entries are in update order, so expired ones are at the front
+        for task_id in list(self._data):
+            entry = self._data[task_id]
+            if now - entry[1] <= self.ttl:
+                break
+            if self._expired(entry, now):
+                del self._data[task_id]
+
+
+class SQLiteProgressStore(BaseProgressStore):
+    """Cross-process store backed by a WAL-mode SQLite file, with batched writes."""
+
+    def __init__(self, path, ttl=3600, stale_ttl=24 * 3600, max_entries=10000, flush_interval=0.5, **kwargs):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending = {}  # task_id -> (json, finished, updated) waiting for the next flush
+        self._last_flush = 0.0
+        self._last_evict = 0.0
+        self._flusher = None
+        self._initialized = False
+
+    # ---- connection ----
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if not self._initialized:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if not self._initialized:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS progress ("
+                    " task_id TEXT PRIMARY KEY, data TEXT NOT NULL,"
+                    " finished INTEGER NOT NULL DEFAULT 0, updated REAL NOT NULL)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS progress_updated ON progress (updated)")
+                self._initialized = True
+            self._local.conn = conn
+        return conn
+
+    # ---- API ----
+
+    def get(self, task_id, default=None):
+        with self._lock:
+            pending = self._pending.get(task_id)
+        if pending is not None:
+            return json.loads(pending[0])
+        row = self._conn().execute(
+            "SELECT data, finished, updated FROM progress WHERE task_id = ?", (task_id,)
+        ).fetchone()
+        if row is None:
+            return default
+        data, finished, updated = row
+        if time.time() - updated > (self.ttl if finished else self.stale_ttl):
+            return default
+        return json.loads(data)
+
+    def set(self, task_id, data):
+        now = time.time()
+        finished = _is_finished(data)
+        with self._lock:
+            self._pending[task_id] = (json.dumps(data), finished, now)
+            due = finished or now - self._last_flush >= self.flush_interval
+        if due:
+            self.flush()
+        else:
+            self._ensure_flusher()
+
+    def delete(self, task_id):
+        with self._lock:
+            self._pending.pop(task_id, None)
+        self._conn().execute("DELETE FROM progress WHERE task_id = ?", (task_id,))
+
+    def clear(self):
+        with self._lock:
+            self._pending.clear()
+        self._conn().execute("DELETE FROM progress")
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.time()
+        if not pending:
+            return
+        conn = self._conn()
+        try:
+            with conn:
+                conn.execute("BEGIN")
+                conn.executemany(
+                    "INSERT INTO progress (task_id, data, finished, updated) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(task_id) DO UPDATE SET data = excluded.data, "
+                    "finished = excluded.finished, updated = excluded.updated "
+                    # A batch another thread swapped out earlier can commit after this one
+                    "WHERE excluded.updated >= progress.updated",
+                    [(task_id, data, int(finished), updated) for task_id, (data, finished, updated) in pending.items()]
+                )
+        except sqlite3.Error as e:
+            print(f"Progress store write failed: {e}")
+            # Put the updates back unless something newer arrived meanwhile
+            with self._lock:
+                for task_id, entry in pending.items():
+                    self._pending.setdefault(task_id, entry)
+            self._ensure_flusher()
+            return
+        if self._last_flush - self._last_evict > 60:
+            self._evict()
+
+    def _evict(self):
+        now = time.time()
+        self._last_evict = now
+        conn = self._conn()
+        conn.execute(
+            "DELETE FROM progress WHERE (finished = 1 AND updated < ?) OR updated < ?",
+            (now - self.ttl, now - self.stale_ttl)
+        )
+        conn.execute(
+            "DELETE FROM progress WHERE task_id IN ("
+            " SELECT task_id FROM progress ORDER BY updated DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+
+    def _ensure_flusher(self):
+        """Background thread so a last buffered update is written even if no more arrive."""
+        if self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, name="progress-flusher", daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Progress store flush failed: {e}")
+
+
+def get_progress_store() -> BaseProgressStore:
+    """Builds the store configured by settings.PROGRESS_STORE."""
+    options = {**DEFAULTS, **getattr(settings, 'PROGRESS_STORE', {})}
+    kwargs = {
+        'ttl': options['TTL'],
+        'stale_ttl': options['STALE_TTL'],
+        'max_entries': options['MAX_ENTRIES'],
+        'flush_interval': options['FLUSH_INTERVAL'],
+    }
+    if options['BACKEND'] == 'memory':
+        return MemoryProgressStore(**kwargs)
+    if options['BACKEND'] == 'sqlite':
+        path = options['PATH'] or settings.BASE_DIR / '.cache' / 'progress.sqlite3'
+        return SQLiteProgressStore(path, **kwargs)
+    raise ValueError(f"Unknown progress store backend: {options['BACKEND']}")
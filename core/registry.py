@@ -0,0 +1,153 @@
+"""
+Command registry.
+
+Templates are compiled once into a pre-parsed form (which arguments need
+formatting, which parameters they take). Custom commands are re-read only when
+custom_commands.json changes on disk.
+"""
+import json
+import os
+import re
+import tempfile
+import threading
+from pathlib import Path
+
+from .capabilities import get_capabilities
+from .system import FileLock
+
+PLACEHOLDER_RE = re.compile(r"\{([a-zA-Z0-9_]+)\}")
+
+# Placeholders filled in by the app rather than the user
+INTERNAL_PARAMS = {'input', 'output', 'output_pattern'}
+
+
+class CompiledCommand:
+    """A command template parsed once, ready to be filled in."""
+
+    def __init__(self, key, config):
+        self.key = key
+        self.config = config
+        self.description = config.get('description', '')
+        self.template = list(config['command'])
+        # Job handler that runs it; 'ffmpeg' runs the template as-is
+        self.engine = config.get('engine', 'ffmpeg')
+
+        # (arg, needs_format) pairs; literal args are passed through untouched
+        self._parts = [(arg, '{' in arg or '}' in arg) for arg in self.template]
+
+        placeholders = []
+        for arg, needs_format in self._parts:
+            if needs_format:
+                for name in PLACEHOLDER_RE.findall(arg):
+                    if name not in placeholders:
+                        placeholders.append(name)
+        self.placeholders = placeholders
+        self.parameters = [p for p in placeholders if p not in INTERNAL_PARAMS]
+        self.requires_gpu = "gpu" in key.lower() or "cuda" in str(self.template).lower()
+
+    def build(self, **kwargs) -> list:
+        return [arg.format(**kwargs) if needs_format else arg for arg, needs_format in self._parts]
+
+
+class CommandRegistry:
+    """Base + custom commands, compiled and cached."""
+
+    def __init__(self, base_commands, custom_path):
+        self.base_commands = base_commands
+        self.custom_path = Path(custom_path)
+        self._lock = threading.RLock()
+        self._custom_mtime = None
+        self._custom = {}
+        self._compiled = {}
+        self._state = None  # (custom mtime, gpu available) the cache was built for
+
+    # ---- custom commands file ----
+
+    def _file_mtime(self):
+        try:
+            return os.stat(self.custom_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _read_custom(self):
+        if not self.custom_path.exists():
+            return {}
+        try:
+            with open(self.custom_path, 'r') as f:
+                return json.load(f)
+        except (json.JSONDecodeError, IOError):
+            return {}
+
+    def load_custom(self) -> dict:
+        """Custom commands, re-read only when the file's mtime changed."""
+        mtime = self._file_mtime()
+        if mtime != self._custom_mtime:
+            with self._lock:
+                if mtime != self._custom_mtime:
+                    self._custom = self._read_custom()
+                    self._custom_mtime = mtime
+        return self._custom
+
+    def save_custom(self, key, command_list, description, target=None):
+        """Adds/replaces a custom command with an atomic, locked write."""
+        with self._lock, self._file_lock():
+            # Re-read under the lock so concurrent adds don't drop each other
+            custom = self._read_custom()
+            custom[key] = {
+                "command": command_list,
+                "description": description
+            }
+            if target:
+                custom[key]["target"] = target
+            fd, tmp_path = tempfile.mkstemp(dir=self.custom_path.parent, prefix=".custom_commands.", suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(custom, f, indent=4)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.custom_path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+            self._custom_mtime = None
+            self._state = None
+
+    def _file_lock(self):
+        return FileLock(self.custom_path.with_name(self.custom_path.name + ".lock"))
+
+    # ---- compiled view ----
+
+    def compiled(self) -> dict:
+        """key -> CompiledCommand, with GPU commands filtered out if there's no GPU."""
+        custom = self.load_custom()
+        gpu = get_capabilities().has_nvidia_gpu
+        state = (self._custom_mtime, gpu)
+        if state != self._state:
+            with self._lock:
+                commands = dict(self.base_commands)
+                commands.update(custom)
+                compiled = {}
+                for key, config in commands.items():
+                    try:
+                        cmd = CompiledCommand(key, config)
+                    except (KeyError, TypeError):
+                        continue  # Malformed custom entry
+                    # Filter GPU commands if no GPU to avoid users crashing the app
+                    if cmd.requires_gpu and not gpu:
+                        continue
+                    compiled[key] = cmd
+                self._compiled = compiled
+                self._state = state
+        return self._compiled
+
+    def get(self, key):
+        return self.compiled().get(key)
+
+    def commands(self) -> dict:
+        """key -> raw config dict (the shape get_all_commands() has always returned)."""
+        return {key: cmd.config for key, cmd in self.compiled().items()}
+
+    def params_map(self) -> dict:
+        return {key: cmd.parameters for key, cmd in self.compiled().items()}
+
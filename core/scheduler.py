@@ -0,0 +1,375 @@
+"""
+Resource-aware job scheduling.
+
+Profiles differ a lot in cost: one compress_ultra (libx265) job keeps every
+core busy, a remux_copy job barely uses one. Every job is put in a cost class:
+
+- copy: stream copy only, bound by disk
+- light: libx264 at fast presets, audio encodes, simple filters
+- heavy: libx265/AV1/VP9, slow presets, filters such as minterpolate
+- gpu: hardware encoders and decoders (NVENC, QSV, VAAPI, ...)
+
+A profile can set its class with "cost" in its config. Each class starts
+with a default number of cores and amount of memory. After every successful
+run, the estimate is replaced by what the job really used: CPU time and peak
+RSS come from wait4() and are kept per profile in models.ProfileStats.
+
+Before a worker claims a job, admit() checks the estimate against:
+- the cores the pool has already handed out
+- the CPU that other processes are using, from /proc/stat
+- MemAvailable
+
+The job is admitted only if it fits. Its grant says:
+- how many threads ffmpeg gets (the free cores, up to the estimate)
+- the nice level and ionice level it runs at
+
+Heavy encoders scale sublinearly, so two heavy jobs with half the machine each
+finish sooner than one after the other with all of it: while jobs are waiting,
+none is given more than an even share of the cores. When a job doesn't fit,
+a smaller one behind it can run instead, unless the bigger one has waited
+longer than SCHEDULER_STARVATION_WAIT.
+
+The budget is per process (each WorkerPool). Load from other processes only
+shows up through the live CPU reading.
+"""
+import math
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import F
+
+from .models import ProfileStats
+from .utils import COMMAND_REGISTRY
+
+COST_CLASSES = ('copy', 'light', 'heavy', 'gpu')
+
+# Cores a job of each class is expected to keep busy until runs have been measured
+# (heavy: as many as the machine has, up to SCHEDULER_MAX_THREADS)
+DEFAULT_CORES = {'copy': 0.5, 'light': 2.0, 'heavy': None, 'gpu': 1.0}
+# The least a job is started with when the machine is partly busy
+MIN_CORES = {'copy': 0.25, 'light': 1.0, 'heavy': 2.0, 'gpu': 0.5}
+# Peak memory (MiB) assumed until runs have been measured
+DEFAULT_RSS_MB = {'copy': 100, 'light': 400, 'heavy': 1500, 'gpu': 600}
+DEFAULT_NICE = {'copy': 0, 'light': 5, 'heavy': 10, 'gpu': 0}
+# Best-effort I/O priority, 0 (highest) to 7
+DEFAULT_IONICE = {'copy': 4, 'light': 5, 'heavy': 7, 'gpu': 4}
+
+HEAVY_ENCODERS = {'libx265', 'libaom-av1', 'libsvtav1', 'librav1e', 'libvpx-vp9', 'libvpx'}
+HEAVY_FILTERS = {'minterpolate', 'nlmeans', 'bm3d', 'vidstabdetect', 'vidstabtransform', 'deshake', 'dnn_processing'}
+SLOW_PRESETS = {'slow', 'slower', 'veryslow', 'placebo'}
+GPU_SUFFIXES = ('_nvenc', '_qsv', '_vaapi', '_amf', '_videotoolbox', '_v4l2m2m')
+CODEC_OPTIONS = {'-c', '-codec', '-c:v', '-codec:v', '-vcodec', '-c:a', '-codec:a', '-acodec'}
+FILTER_OPTIONS = {'-vf', '-af', '-filter:v', '-filter:a', '-filter_complex', '-lavfi'}
+
+# Moving-average weight of the latest run
+LEARNING_RATE = 0.3
+# A job that used at least this share of its threads was limited by them, not by the work
+SATURATED = 0.8
+# How long learned estimates are cached before being re-read from the database
+STATS_TTL = 30.0
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def classify(command, compiled=None) -> str:
+    """Cost class of a command (or of the profile, if it declares one)."""
+    declared = compiled.config.get('cost') if compiled is not None else None
+    if declared in COST_CLASSES:
+        return declared
+    codecs, filters, presets = [], set(), set()
+    for arg, value in zip(command, command[1:]):
+        if arg in CODEC_OPTIONS:
+            codecs.append(value)
+        elif arg in FILTER_OPTIONS:
+            filters |= {part.split('=', 1)[0].strip().split(']')[-1] for part in value.replace(';', ',').split(',')}
+        elif arg == '-preset':
+            presets.add(value)
+    if '-hwaccel' in command or any(c.endswith(GPU_SUFFIXES) for c in codecs) or (compiled is not None and compiled.requires_gpu):
+        return 'gpu'
+    if codecs and all(c == 'copy' for c in codecs) and not filters:
+        return 'copy'
+    if set(codecs) & HEAVY_ENCODERS or filters & HEAVY_FILTERS or presets & SLOW_PRESETS:
+        return 'heavy'
+    return 'light'
+
+
+# How jobs running several profiles join their keys in Job.profile
+PROFILE_SEPARATORS = {'pipeline': '|', 'multi': '+'}
+
+
+def classify_job(job) -> str:
+    """Cost class of a job: a pipeline or multi-output job counts as its costliest profile."""
+    classes = [classify(job.command, COMMAND_REGISTRY.get(job.profile))]
+    separator = PROFILE_SEPARATORS.get(job.kind)
+    for key in job.profile.split(separator) if separator else []:
+        compiled = COMMAND_REGISTRY.get(key)
+        if compiled is not None:
+            classes.append(classify(compiled.template, compiled))
+    return max(classes, key=lambda c: (_default_cores(c), c == 'heavy'))
+
+
+def _default_cores(cost_class) -> float:
+    cores = DEFAULT_CORES[cost_class]
+    if cores is None:
+        return float(min(capacity(), _setting('SCHEDULER_MAX_THREADS', 16)))
+    return cores
+
+
+def capacity() -> float:
+    """Cores the scheduler may fill."""
+    return float(_setting('SCHEDULER_CAPACITY', None) or os.cpu_count() or 1)
+
+
+# =========================
+# Live resources
+# =========================
+
+_cpu_lock = threading.Lock()
+_cpu_sample = None  # (time, busy jiffies, total jiffies)
+_cpu_busy = None
+
+
+def busy_cores():
+    """Cores in use machine-wide since the last reading (None where /proc/stat is missing)."""
+    global _cpu_sample, _cpu_busy
+    with _cpu_lock:
+        now = time.monotonic()
+        if _cpu_sample is not None and now - _cpu_sample[0] < 1.0:
+            return _cpu_busy
+        try:
+            with open('/proc/stat') as f:
+                fields = [int(v) for v in f.readline().split()[1:]]
+        except (OSError, ValueError):
+            load = os.getloadavg()[0] if hasattr(os, 'getloadavg') else None
+            return load
+        # user nice system idle iowait irq softirq steal ...
+        idle = fields[3] + (fields[4] if len(fields) > 4 else 0)
+        total = sum(fields[:8])
+        if _cpu_sample is not None and total > _cpu_sample[2]:
+            busy = (total - idle) - _cpu_sample[1]
+            _cpu_busy = busy / (total - _cpu_sample[2]) * (os.cpu_count() or 1)
+        _cpu_sample = (now, total - idle, total)
+        return _cpu_busy
+
+
+def available_memory_mb():
+    """MemAvailable in MiB, or None where /proc/meminfo is missing."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+# =========================
+# Admission
+# =========================
+
+class Estimate:
+    def __init__(self, cost_class, cores, rss_mb, learned=False):
+        self.cost_class = cost_class
+        self.cores = cores
+        self.rss_mb = rss_mb
+        self.learned = learned
+
+
+class Grant:
+    """What a job was admitted with."""
+
+    def __init__(self, job_id, profile, cost_class, cores, threads, nice, ionice):
+        self.job_id = job_id
+        self.profile = profile
+        self.cost_class = cost_class
+        self.cores = cores
+        self.threads = threads
+        self.nice = nice
+        self.ionice = ionice
+        self.started = time.monotonic()
+
+    def as_dict(self):
+        return {'class': self.cost_class, 'threads': self.threads, 'nice': self.nice, 'ionice': self.ionice}
+
+
+class Scheduler:
+    """Admits jobs while the machine has room for them."""
+
+    def __init__(self, workers=None):
+        # Most jobs that can run at once (the pool's size)
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._running = {}  # job id -> Grant
+        self._stats = {}    # (profile, class) -> (read at, ProfileStats or None)
+
+    def _learned(self, profile, cost_class):
+        cached = self._stats.get((profile, cost_class))
+        if cached is None or time.monotonic() - cached[0] > STATS_TTL:
+            stats = ProfileStats.objects.filter(profile=profile, cost_class=cost_class).first()
+            cached = (time.monotonic(), stats)
+            self._stats[(profile, cost_class)] = cached
+        return cached[1]
+
+    def estimate(self, job) -> Estimate:
+        cost_class = classify_job(job)
+        stats = self._learned(job.profile or job.kind, cost_class)
+        if stats is not None and stats.runs and stats.cores:
+            return Estimate(cost_class, stats.cores, stats.peak_rss_mb or DEFAULT_RSS_MB[cost_class], learned=True)
+        return Estimate(cost_class, _default_cores(cost_class), DEFAULT_RSS_MB[cost_class])
+
+    def admit(self, job, waiting=1):
+        """(grant, None) if the job can start now, else (None, reason).
+
+        waiting is how many jobs are queued (this one included). While others
+        wait, a job gets no more than an even share of the machine.
+        """
+        est = self.estimate(job)
+        with self._lock:
+            running = list(self._running.values())
+            total = capacity()
+            used = sum(g.cores for g in running)
+            free = total - used
+            contenders = len(running) + max(waiting, 1)
+            if self.workers:
+                contenders = min(contenders, self.workers)
+            share = max(total / contenders, MIN_CORES[est.cost_class])
+            if running:
+                # Our own jobs are part of the machine's load; whatever is left over is someone else's
+                busy = busy_cores()
+                if busy is not None:
+                    free -= max(busy - used, 0)
+                minimum = min(MIN_CORES[est.cost_class], est.cores)
+                if est.cost_class == 'gpu' and sum(g.cost_class == 'gpu' for g in running) >= _setting('SCHEDULER_GPU_SLOTS', 2):
+                    return None, "waiting for a free GPU slot"
+                if free < minimum:
+                    return None, f"waiting for CPU ({est.cost_class} job needs ~{minimum:g} cores, {max(free, 0):.1f} free)"
+                memory = available_memory_mb()
+                if memory is not None and est.rss_mb > memory - _setting('SCHEDULER_MEMORY_RESERVE_MB', 512):
+                    return None, f"waiting for memory (needs ~{est.rss_mb:.0f} MB, {memory:.0f} MB available)"
+                cores = min(est.cores, free, share)
+            else:
+                # Always run something, even on a busy machine
+                cores = min(est.cores, share)
+
+            # Interactive jobs (e.g. transcoding an upload as it arrives) aren't deprioritised
+            interactive = job.priority > 0
+            grant = Grant(
+                job_id=str(job.pk),
+                profile=job.profile or job.kind,
+                cost_class=est.cost_class,
+                cores=cores,
+                threads=max(1, min(math.ceil(cores), _setting('SCHEDULER_MAX_THREADS', 16))),
+                nice=0 if interactive else _setting('SCHEDULER_NICE', DEFAULT_NICE).get(est.cost_class, 0),
+                ionice=DEFAULT_IONICE['copy'] if interactive else _setting('SCHEDULER_IONICE', DEFAULT_IONICE).get(est.cost_class, 4),
+            )
+            self._running[grant.job_id] = grant
+            return grant, None
+
+    def release(self, grant, usage=None, media_seconds=None, learn=True):
+        """Frees a grant; successful runs update the profile's learned cost."""
+        with self._lock:
+            self._running.pop(grant.job_id, None)
+        if not learn or not usage or not usage.get('cpu'):
+            return
+        wall = time.monotonic() - grant.started
+        if wall <= 0:
+            return
+        cores = usage['cpu'] / wall
+        rss_mb = usage['max_rss_kb'] / 1024
+        speed = media_seconds / wall if media_seconds else None
+        stats, _ = ProfileStats.objects.get_or_create(profile=grant.profile, cost_class=grant.cost_class)
+        if stats.runs and stats.cores:
+            if cores >= grant.threads * SATURATED:
+                # It used all it was given and might have used more: don't learn a smaller number
+                cores = max(cores, stats.cores)
+            else:
+                cores = stats.cores + (cores - stats.cores) * LEARNING_RATE
+            rss_mb = stats.peak_rss_mb + (rss_mb - stats.peak_rss_mb) * LEARNING_RATE if stats.peak_rss_mb else rss_mb
+            if speed is not None and stats.speed:
+                speed = stats.speed + (speed - stats.speed) * LEARNING_RATE
+        ProfileStats.objects.filter(pk=stats.pk).update(
+            runs=F('runs') + 1, cores=round(cores, 3), peak_rss_mb=round(rss_mb, 1),
+            speed=round(speed, 3) if speed is not None else stats.speed,
+        )
+        self._stats.pop((grant.profile, grant.cost_class), None)
+
+    def running(self) -> list:
+        with self._lock:
+            return list(self._running.values())
+
+
+# =========================
+# Running processes
+# =========================
+
+_priority_tools = {}
+
+
+def _tool(name):
+    if name not in _priority_tools:
+        _priority_tools[name] = shutil.which(name)
+    return _priority_tools[name]
+
+
+def prepare(command, grant, outputs=None, threads=True) -> list:
+    """The command to spawn for a grant: thread options for ffmpeg, wrapped in nice/ionice."""
+    command = list(command)
+    if grant is None:
+        return command
+    if threads and grant.cost_class != 'copy' and command and command[0] == 'ffmpeg' and '-threads' not in command:
+        n = str(grant.threads)
+        targets = [str(o) for o in (outputs or [command[-1]]) if str(o) in command] or [command[-1]]
+        # -threads is an output option: set it for every output
+        for target in targets:
+            i = len(command) - 1 - command[::-1].index(target)
+            command[i:i] = ['-threads', n]
+        if any(arg in FILTER_OPTIONS for arg in command):
+            command[1:1] = ['-filter_threads', n]
+        # libx265 runs its own thread pools and ignores -threads
+        if 'libx265' in command:
+            if '-x265-params' in command:
+                i = command.index('-x265-params') + 1
+                if 'pools=' not in command[i]:
+                    command[i] = f"{command[i]}:pools={n}"
+            else:
+                i = command.index('libx265') + 1
+                command[i:i] = ['-x265-params', f"pools={n}"]
+    prefix = []
+    # Level 4 is what the kernel derives for nice 0 anyway
+    if grant.ionice not in (None, 4) and _tool('ionice'):
+        prefix += [_tool('ionice'), '-c', '2', '-n', str(grant.ionice)]
+    if grant.nice and _tool('nice'):
+        prefix += [_tool('nice'), '-n', str(grant.nice)]
+    return prefix + command
+
+
+def reap(process, timeout=None):
+    """Popen.wait() that also returns the process's resource usage.
+
+    Returns {'cpu': user + system seconds, 'max_rss_kb': peak RSS}, or None
+    where wait4() isn't available. Raises subprocess.TimeoutExpired like wait().
+    """
+    if not hasattr(os, 'wait4'):
+        process.wait(timeout)
+        return None
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        try:
+            pid, status, usage = os.wait4(process.pid, 0 if deadline is None else os.WNOHANG)
+        except ChildProcessError:
+            # Reaped elsewhere (e.g. Popen.poll() from another thread)
+            process.wait()
+            return None
+        if pid:
+            process.returncode = os.waitstatus_to_exitcode(status)
+            return {'cpu': usage.ru_utime + usage.ru_stime, 'max_rss_kb': usage.ru_maxrss}
+        if time.monotonic() >= deadline:
+            raise subprocess.TimeoutExpired(process.args, timeout)
+        time.sleep(0.05)
@@ -0,0 +1,149 @@
+"""
+Frame-accurate trimming that only re-encodes the partial GOPs at the edges.
+
+For a cut [start, end) with keyframes k1 (first at/after start) and k2 (last
+at/before end):
+
+    start ... k1     re-encoded (head, partial GOP)
+    k1 ... k2        stream-copied (whole GOPs, untouched)
+    k2 ... end       re-encoded (tail, partial GOP)
+
+The pieces are written as MPEG-TS (parameter sets in-band, so the encoder's
+SPS/PPS and the source's can follow each other) and joined with the concat
+demuxer. Audio is cut sample-accurately from the original in the final mux,
+so it has no seams. The head/tail are encoded with the source's codec, pixel
+format and profile at high quality so the joins can be copied.
+
+Sources we can't match (codecs other than H.264/HEVC, no keyframe inside the
+range) fall back to the profile's plain re-encode command.
+"""
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+
+from .ffmpeg import parse_time
+from . import metrics, packet_index
+
+# Source codec -> encoder and the args that keep its output concat-compatible
+ENCODERS = {
+    'h264': ['-c:v', 'libx264', '-preset', 'medium', '-crf', '16'],
+    'hevc': ['-c:v', 'libx265', '-preset', 'medium', '-crf', '18'],
+}
+H264_PROFILES = {'baseline': 'baseline', 'constrained baseline': 'baseline', 'main': 'main', 'high': 'high'}
+# Cuts closer than this to a keyframe need no head/tail piece
+EPSILON = 0.001
+
+
+def cut_points(command):
+    """(start, end) in seconds from a trim command's -ss/-to arguments."""
+    start = end = None
+    for i, arg in enumerate(command[:-1]):
+        if arg == '-ss':
+            start = parse_time(command[i + 1])
+        elif arg == '-to':
+            end = parse_time(command[i + 1])
+    return start or 0.0, end
+
+
+def plan(path, start, end, duration=None):
+    """(k1, k2) keyframes bounding the copyable middle, or None if there's nothing to copy."""
+    if end is None or end <= start:
+        return None
+    end = min(end, duration) if duration else end
+    index = packet_index.get_index(path)
+    if index is None:
+        return None
+    k1 = index.keyframe_after(start - EPSILON)
+    k2 = index.keyframe_before(end + EPSILON)
+    if k1 is None or k2 is None or k2 <= k1:
+        return None
+    return k1, k2
+
+
+def encoder_args(entry) -> list | None:
+    """Encoder settings matching the source's video stream, or None if unsupported."""
+    stream = next((s for s in entry.streams if s.get('type') == 'video' and not s.get('attached_pic')), None)
+    if stream is None or stream.get('codec') not in ENCODERS:
+        return None
+    args = list(ENCODERS[stream['codec']])
+    if stream.get('pix_fmt'):
+        args += ['-pix_fmt', stream['pix_fmt']]
+    profile = H264_PROFILES.get(str(stream.get('profile', '')).lower())
+    if stream['codec'] == 'h264' and profile:
+        args += ['-profile:v', profile]
+    return args
+
+
+def trim(input_path, output_path, start, end, entry, ctx=None, audio_args=None) -> dict | None:
+    """Runs a smart trim. Returns stats, or None if the source needs a full re-encode."""
+    if entry is None or not entry.has_video:
+        return None
+    encode = encoder_args(entry)
+    if encode is None:
+        return None
+    end = min(end, entry.duration) if end is not None and entry.duration else end
+    bounds = plan(input_path, start, end, entry.duration)
+    if bounds is None:
+        return None
+    k1, k2 = bounds
+    input_path = str(input_path)
+    output = Path(output_path)
+    audio_args = audio_args or ['-c:a', 'aac', '-b:a', '192k']
+
+    def run(command, percent, msg):
+        if ctx is not None:
+            ctx.progress(status='processing', percent=percent, msg=msg)
+            ctx.run(command, stdin=subprocess.DEVNULL)
+        else:
+            metrics.spawned(command)
+            subprocess.run(command, stdin=subprocess.DEVNULL, check=True)
+
+    tmp_dir = Path(tempfile.mkdtemp(prefix=f".{output.stem}.trim-", dir=output.parent))
+    try:
+        pieces = []
+        if k1 - start > EPSILON:
+            head = tmp_dir / "head.ts"
+            run([
+                "ffmpeg", "-y", "-v", "error", "-ss", f"{start:.6f}", "-i", input_path,
+                "-t", f"{k1 - start - EPSILON:.6f}", "-map", "0:v:0", *encode,
+                "-fps_mode", "passthrough", "-an", "-f", "mpegts", str(head)
+            ], 5, f"Re-encoding head ({k1 - start:.2f}s)...")
+            pieces.append(head)
+
+        middle = tmp_dir / "middle.ts"
+        # Seeking a hair past k1 makes the copy start exactly on it (a copy seek
+        # lands on the keyframe at or before the position)
+        run([
+            "ffmpeg", "-y", "-v", "error", "-ss", f"{k1 + EPSILON:.6f}", "-i", input_path,
+            "-t", f"{k2 - k1 - EPSILON:.6f}", "-map", "0:v:0", "-c", "copy", "-an",
+            "-f", "mpegts", str(middle)
+        ], 30, f"Copying {k2 - k1:.1f}s of whole GOPs...")
+        pieces.append(middle)
+
+        if end - k2 > EPSILON:
+            tail = tmp_dir / "tail.ts"
+            # A decoding seek drops frames before the position, so stay just under k2
+            run([
+                "ffmpeg", "-y", "-v", "error", "-ss", f"{max(k2 - EPSILON, 0):.6f}", "-i", input_path,
+                "-t", f"{end - k2:.6f}", "-map", "0:v:0", *encode,
+                "-fps_mode", "passthrough", "-an", "-f", "mpegts", str(tail)
+            ], 60, f"Re-encoding tail ({end - k2:.2f}s)...")
+            pieces.append(tail)
+
+        concat_list = tmp_dir / "concat.txt"
+        concat_list.write_text("".join(f"file '{p.name}'\n" for p in pieces))
+        run([
+            "ffmpeg", "-y", "-v", "error",
+            "-f", "concat", "-safe", "0", "-i", str(concat_list),
+            "-ss", f"{start:.6f}", "-to", f"{end:.6f}", "-i", input_path,
+            "-map", "0:v:0", "-map", "1:a:0?", "-c:v", "copy", *audio_args,
+            "-movflags", "+faststart", str(output)
+        ], 90, "Joining...")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return {
+        'reencoded': round((k1 - start) + (end - k2), 3),
+        'copied': round(k2 - k1, 3),
+    }
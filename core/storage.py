@@ -0,0 +1,341 @@
+"""
+Output staging and media storage limits.
+
+Outputs used to be written in place, so a failed or interrupted ffmpeg run
+left a truncated file that the library listed like any other, and
+media/download only ever grew.
+
+- Staging sends a job's outputs to a hidden .partial-<job id> directory
+  beside each output. When the job succeeds, the files are renamed into
+  place with os.replace, which is atomic within a filesystem, so the library
+  never sees a half-written file. A failed run deletes the directory.
+  Segment patterns keep their names, so playlists still point at their
+  segments.
+- MediaFile.last_accessed records when a file was last served or read by a
+  job (touch()).
+- STORAGE_QUOTAS (off unless configured) caps the bytes of indexed files in
+  a media folder. enforce_quota() evicts the least recently used files until
+  the folder fits. It skips files that queued or running jobs read, outputs
+  several requests share, and files used in the last STORAGE_MIN_IDLE
+  seconds.
+- A janitor thread (Janitor) enforces the quotas every
+  STORAGE_SWEEP_INTERVAL seconds and after each finished job. It also
+  deletes what crashed runs leave behind, once untouched for
+  STORAGE_ORPHAN_AGE seconds:
+  - .partial directories of jobs that aren't running
+  - chunk, trim and pipeline temp dirs
+  - yt-dlp .part files
+  - stale upload sessions
+"""
+import os
+import re
+import shutil
+import threading
+import time
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import close_old_connections, connection
+from django.db.models import F, Q, Sum
+from django.utils import timezone
+
+from . import library, metrics, output_cache, uploads
+from .models import Job, MediaFile
+
+PARTIAL_PREFIX = ".partial-"
+# Temp dirs made beside an output by chunked.encode, smart_trim.trim and pipeline.intermediate_dir
+TEMP_DIR_RE = re.compile(r"^\..+\.(chunks|trim|pipeline)-")
+# What yt-dlp leaves while (or after failing at) downloading a file
+PART_FILE_RE = re.compile(r"\.(part|ytdl)$|\.part-Frag\d+")
+# Seconds between recorded accesses of the same file (per process)
+ACCESS_RESOLUTION = 60
+
+_touched = {}  # relative path -> time.monotonic() of the last recorded access
+_touch_lock = threading.Lock()
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+# =========================
+# Atomic outputs
+# =========================
+
+class Staging:
+    """Redirects a job's outputs into hidden directories until the job succeeds."""
+
+    def __init__(self, job: Job):
+        self.job = job
+        self.dirs = {}  # output folder -> its staging directory
+
+    def _staged(self, path) -> str:
+        path = Path(path)
+        staging = self.dirs.setdefault(path.parent, path.parent / f"{PARTIAL_PREFIX}{self.job.pk}")
+        return str(staging / path.name)
+
+    def apply(self):
+        """Points the job's command, output_path and payload outputs at staging paths (in memory only)."""
+        job = self.job
+        finals = [str(o) for o in job.payload.get('outputs') or []]
+        if job.output_path:
+            finals.append(str(job.output_path))
+        mapping = {final: self._staged(final) for final in finals}
+        if not mapping:
+            return
+        job.command = [mapping.get(arg, arg) if isinstance(arg, str) else arg for arg in job.command or []]
+        job.output_path = mapping.get(job.output_path, job.output_path)
+        if job.payload.get('outputs'):
+            job.payload = {**job.payload, 'outputs': [mapping[str(o)] for o in job.payload['outputs']]}
+        for staging in self.dirs.values():
+            # Whatever an earlier attempt left is started over
+            shutil.rmtree(staging, ignore_errors=True)
+            staging.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def final_path(path) -> str:
+        path = Path(path)
+        if path.parent.name.startswith(PARTIAL_PREFIX):
+            return str(path.parent.parent / path.name)
+        return str(path)
+
+    def commit(self, result: dict) -> dict:
+        """Renames the finished files into place. Returns result with the final paths."""
+        for folder, staging in self.dirs.items():
+            if not staging.is_dir():
+                continue
+            # Subdirectories are a handler's own temp dirs, not outputs
+            for f in sorted(staging.iterdir()):
+                if f.is_file() and not f.name.startswith('.'):
+                    os.replace(f, folder / f.name)
+            shutil.rmtree(staging, ignore_errors=True)
+        result = dict(result)
+        if result.get('output'):
+            result['output'] = self.final_path(result['output'])
+        if result.get('outputs'):
+            result['outputs'] = [self.final_path(o) for o in result['outputs']]
+        return result
+
+    def discard(self):
+        for staging in self.dirs.values():
+            shutil.rmtree(staging, ignore_errors=True)
+
+
+# =========================
+# Access tracking & quotas
+# =========================
+
+def touch(path):
+    """Records that a library file was used (an absolute path, or one relative to MEDIA_ROOT)."""
+    path = Path(path)
+    try:
+        rel = library.relative_path(path) if path.is_absolute() else path.as_posix()
+    except ValueError:
+        return  # Not in the library
+    now = time.monotonic()
+    with _touch_lock:
+        if rel in _touched and now - _touched[rel] < ACCESS_RESOLUTION:
+            return
+        if len(_touched) > 10000:
+            _touched.clear()
+        _touched[rel] = now
+    MediaFile.objects.filter(path=rel).update(last_accessed=timezone.now())
+
+
+def folder_usage(folder: str) -> int:
+    """Bytes of indexed files in a media folder."""
+    return MediaFile.objects.filter(folder=folder).aggregate(total=Sum('size'))['total'] or 0
+
+
+def _pending_inputs() -> set:
+    """Relative paths of files that queued or running jobs read."""
+    inputs = set()
+    active = Job.objects.filter(status__in=(Job.STATUS_QUEUED, Job.STATUS_RUNNING))
+    for input_path in active.values_list('input_path', flat=True):
+        try:
+            inputs.add(library.relative_path(input_path))
+        except ValueError:
+            pass
+    return inputs
+
+
+def evict(entry: MediaFile) -> int:
+    """Deletes a library file with its index and output-cache entries. Returns the bytes freed."""
+    try:
+        (settings.MEDIA_ROOT / entry.path).unlink()
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"Couldn't evict {entry.path}: {e}")
+        return 0
+    output_cache.forget_output(entry.path)
+    entry.delete()
+    library.invalidate(entry.folder)
+    metrics.STORAGE_EVICTED_BYTES.inc(entry.size, folder=entry.folder)
+    return entry.size
+
+
+def enforce_quota(folder: str, quota: int) -> int:
+    """Evicts the least recently used files until a folder fits in quota bytes. Returns the bytes freed."""
+    used = folder_usage(folder)
+    if used <= quota:
+        return 0
+    protected = _pending_inputs()
+    idle_before = timezone.now() - timedelta(seconds=_setting('STORAGE_MIN_IDLE', 600))
+    # Files never accessed since last_accessed was added go first, oldest first
+    candidates = (
+        MediaFile.objects.filter(folder=folder)
+        .filter(Q(last_accessed__isnull=True) | Q(last_accessed__lt=idle_before))
+        .order_by(F('last_accessed').asc(nulls_first=True), 'mtime')
+        .only('id', 'path', 'folder', 'size')
+    )
+    freed = 0
+    for entry in candidates.iterator():
+        if used - freed <= quota:
+            break
+        # Outputs shared by several requests (core/output_cache.py) are kept
+        if entry.path not in protected and output_cache.holders(entry.path) <= 1:
+            freed += evict(entry)
+    if used - freed > quota:
+        print(f"Storage: {folder} is over its quota by {used - freed - quota} bytes; the rest is in use")
+    return freed
+
+
+# =========================
+# Orphan cleanup
+# =========================
+
+def _orphan_kind(path: Path, running: set, stale_before: float) -> str | None:
+    """Why path is left over from a crashed or failed run ('partial', 'temp', 'part'), or None."""
+    name = path.name
+    partial = name.startswith(PARTIAL_PREFIX)
+    if partial and (not path.is_dir() or name[len(PARTIAL_PREFIX):] in running):
+        return None
+    if partial or TEMP_DIR_RE.match(name) or PART_FILE_RE.search(name):
+        try:
+            if path.stat().st_mtime >= stale_before:
+                # Possibly still being written (yt-dlp resumes .part files), or the
+                # staging dir of a job claimed since `running` was read
+                return None
+        except OSError:
+            return None
+        if partial:
+            return 'partial'
+        return 'temp' if path.is_dir() else 'part'
+    return None
+
+
+def _job_running(job_id: str) -> bool:
+    try:
+        return Job.objects.filter(pk=job_id, status=Job.STATUS_RUNNING).exists()
+    except ValidationError:
+        return False  # Not a job id
+
+
+def cleanup_orphans() -> int:
+    """Deletes partial outputs, temp dirs and .part files nothing is working on. Returns how many."""
+    running = {str(pk) for pk in Job.objects.filter(status=Job.STATUS_RUNNING).values_list('pk', flat=True)}
+    stale_before = time.time() - _setting('STORAGE_ORPHAN_AGE', 24 * 3600)
+    removed = 0
+    for folder, _source in library.MEDIA_FOLDERS:
+        root = settings.MEDIA_ROOT / folder
+        if not root.is_dir():
+            continue
+        for path in root.iterdir():
+            kind = _orphan_kind(path, running, stale_before)
+            if kind is None:
+                continue
+            # A retried job reuses its staging dir, so check again right before deleting it
+            if kind == 'partial' and _job_running(path.name[len(PARTIAL_PREFIX):]):
+                continue
+            try:
+                if path.is_dir():
+                    shutil.rmtree(path)
+                else:
+                    path.unlink()
+            except OSError as e:
+                print(f"Couldn't remove {path}: {e}")
+                continue
+            metrics.STORAGE_ORPHANS_REMOVED.inc(kind=kind)
+            removed += 1
+    return removed + uploads.cleanup_stale()
+
+
+def sweep() -> tuple:
+    """One cleanup pass over every media folder. Returns (orphans removed, bytes evicted)."""
+    removed = cleanup_orphans()
+    quotas = {folder: quota for folder, quota in _setting('STORAGE_QUOTAS', {}).items() if quota}
+    freed = 0
+    if quotas:
+        # Outputs written since the last sweep count against the quota too
+        library.rescan()
+        for folder, quota in quotas.items():
+            freed += enforce_quota(folder, quota)
+    return removed, freed
+
+
+# =========================
+# Janitor
+# =========================
+
+class Janitor:
+    """A thread running sweep() every interval seconds, or sooner when woken."""
+
+    def __init__(self, interval=300.0):
+        self.interval = interval
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name="storage-janitor", daemon=True)
+        self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self, wait=True):
+        self._stopping.set()
+        self._wake.set()
+        if wait and self._thread is not None:
+            self._thread.join()
+
+    def _loop(self):
+        try:
+            while not self._stopping.is_set():
+                close_old_connections()
+                try:
+                    removed, freed = sweep()
+                    if removed or freed:
+                        print(f"Storage: removed {removed} orphaned file(s), evicted {freed} bytes")
+                except Exception as e:
+                    print(f"Storage janitor error: {e}")
+                self._wake.wait(self.interval)
+                self._wake.clear()
+        finally:
+            connection.close()
+
+
+_janitor = None
+_janitor_lock = threading.Lock()
+
+
+def ensure_janitor(force=False):
+    """Starts this process's janitor once. Unless forced, only where the job workers run."""
+    global _janitor
+    if _janitor is not None or not (force or _setting('JOB_WORKERS_IN_PROCESS', True)):
+        return _janitor
+    with _janitor_lock:
+        if _janitor is None:
+            janitor = Janitor(_setting('STORAGE_SWEEP_INTERVAL', 300))
+            janitor.start()
+            _janitor = janitor
+    return _janitor
+
+
+def wake():
+    """Runs a sweep soon, e.g. after a job added outputs."""
+    if _janitor is not None:
+        _janitor.wake()
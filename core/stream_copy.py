@@ -0,0 +1,171 @@
+"""
+Stream-copy planning.
+
+A profile can declare what its output streams look like ("target"). When the
+source's streams already meet it, re-encoding them only costs time and
+quality, so the stream is copied instead:
+
+    "target": {
+        "video": {"codec": "h264", "pix_fmt": "yuv420p", "profile": ["high", "main"], "max_level": 41},
+        "audio": {"codec": "aac"},
+    }
+
+plan() compares the target with the source's probed streams and rewrites the
+resolved command one stream at a time: a stream that meets its target is
+copied, the others keep the profile's encoder. Profiles that copy (remux) work
+the other way round: a stream that doesn't meet the target, or that the
+output container can't hold, is encoded with the target's "encode" options.
+
+Target keys match the ffprobe fields stored on MediaFile.streams. Plain keys
+take a value or a list of accepted values; max_* keys are upper bounds (levels
+are ffprobe's numbers, e.g. 41 for H.264 level 4.1).
+"""
+from pathlib import Path
+
+from django.conf import settings
+
+from .multi_output import GLOBAL_OPTIONS, GLOBAL_VALUE_OPTIONS, parse_options
+
+# Encoder settings that mean nothing once a stream is copied
+VIDEO_ENCODER_OPTIONS = {
+    '-c:v', '-codec:v', '-vcodec', '-preset', '-crf', '-qp', '-cq', '-rc', '-tune',
+    '-profile:v', '-level', '-level:v', '-pix_fmt', '-b:v', '-maxrate', '-bufsize',
+    '-x264-params', '-x265-params', '-g', '-bf',
+}
+AUDIO_ENCODER_OPTIONS = {'-c:a', '-codec:a', '-acodec', '-b:a', '-q:a', '-aq', '-ar', '-ac', '-profile:a'}
+BOTH_CODEC_OPTIONS = {'-c', '-codec'}
+
+# Codecs each output container can take as-is (None: anything)
+CONTAINER_CODECS = {
+    '.mp4': {'h264', 'hevc', 'av1', 'vp9', 'mpeg4', 'aac', 'mp3', 'ac3', 'eac3', 'opus', 'flac', 'alac'},
+    '.m4a': {'aac', 'alac', 'mp3'},
+    '.mov': {'h264', 'hevc', 'mpeg4', 'prores', 'mjpeg', 'aac', 'mp3', 'alac', 'pcm_s16le', 'pcm_s24le'},
+    '.webm': {'vp8', 'vp9', 'av1', 'opus', 'vorbis'},
+    '.aac': {'aac'},
+    '.mp3': {'mp3'},
+    '.wav': {'pcm_s16le', 'pcm_s24le', 'pcm_s32le', 'pcm_f32le', 'pcm_u8'},
+    '.mkv': None,
+}
+
+
+def _stream(entry, kind):
+    """The source stream a profile's default mapping picks for `kind`."""
+    for stream in entry.streams or []:
+        if stream.get('type') == kind and not stream.get('attached_pic'):
+            return stream
+    return None
+
+
+def mismatch(spec, stream) -> str | None:
+    """Why a source stream doesn't meet a target spec, or None if it does."""
+    for key, wanted in spec.items():
+        if key == 'encode':
+            continue
+        if key.startswith('max_'):
+            field = key[4:]
+            value = stream.get(field)
+            if value is None:
+                return f"{field} unknown"
+            try:
+                if float(value) > float(wanted):
+                    return f"{field} {value} > {wanted}"
+            except (TypeError, ValueError):
+                return f"{field} {value!r} not comparable"
+            continue
+        accepted = wanted if isinstance(wanted, list) else [wanted]
+        value = stream.get(key)
+        if str(value if value is not None else '').lower() not in {str(a).lower() for a in accepted}:
+            return f"{key} {value or 'unknown'} not {'/'.join(str(a) for a in accepted)}"
+    return None
+
+
+def _rewrite(options, kind, codec_args):
+    """Output options with one stream's codec settings replaced by codec_args."""
+    drop = VIDEO_ENCODER_OPTIONS if kind == 'video' else AUDIO_ENCODER_OPTIONS
+    other = '-c:a' if kind == 'video' else '-c:v'
+    kept = []
+    j = 0
+    while j < len(options):
+        arg = options[j]
+        if arg in drop:
+            j += 2
+            continue
+        if arg in BOTH_CODEC_OPTIONS and j + 1 < len(options):
+            # "-c X" also sets the other stream's codec; keep that part
+            kept += [other, options[j + 1]]
+            j += 2
+            continue
+        kept.append(arg)
+        j += 1
+    return kept + list(codec_args)
+
+
+def plan(compiled, command, entry):
+    """(command, decision) for a resolved command on a source.
+
+    decision maps 'video'/'audio' to 'copy' or 'encode' plus a 'reasons' dict,
+    or is None when the profile declares no target or the source is unknown.
+    """
+    target = compiled.config.get('target') if compiled is not None else None
+    if not target or not getattr(settings, 'STREAM_COPY_PLANNER', True):
+        return command, None
+    if entry is None or not entry.probed or command.count('-i') != 1:
+        return command, None
+
+    i = command.index('-i')
+    # Input seeks would turn a copy into a keyframe-aligned cut
+    j = 1
+    while j < i:
+        if command[j] in GLOBAL_OPTIONS:
+            j += 1
+        elif command[j] in GLOBAL_VALUE_OPTIONS:
+            j += 2
+        else:
+            return command, None
+
+    options = command[i + 2:-1]
+    parts = parse_options(options)
+    if parts.filter_complex:
+        return command, None
+    container = CONTAINER_CODECS.get(Path(command[-1]).suffix.lower())
+
+    decision, reasons = {}, {}
+    for kind in ('video', 'audio'):
+        spec = target.get(kind)
+        off = parts.video_off if kind == 'video' else parts.audio_off
+        stream = _stream(entry, kind)
+        if spec is None or off or stream is None:
+            continue
+        codec = parts.video_codec if kind == 'video' else parts.audio_codec
+        filtered = parts.vf if kind == 'video' else parts.af
+        copying = codec == 'copy'
+
+        reason = "filtered" if filtered else mismatch(spec, stream)
+        if reason is None and container is not None and stream.get('codec') not in container:
+            reason = f"{stream.get('codec')} can't go in {Path(command[-1]).suffix}"
+
+        if reason is None:
+            decision[kind] = 'copy'
+            if not copying:
+                options = _rewrite(options, kind, ['-c:v' if kind == 'video' else '-c:a', 'copy'])
+                reasons[kind] = f"source {stream.get('codec')} already meets the target"
+        elif copying and spec.get('encode'):
+            decision[kind] = 'encode'
+            options = _rewrite(options, kind, spec['encode'])
+            reasons[kind] = reason
+        else:
+            decision[kind] = 'copy' if copying else 'encode'
+            reasons[kind] = reason
+
+    if not decision:
+        return command, None
+    decision['reasons'] = reasons
+    return [*command[:i + 2], *options, command[-1]], decision
+
+
+def describe(decision) -> str:
+    """Short summary for progress messages, e.g. "copying video, encoding audio"."""
+    if not decision:
+        return ""
+    actions = [f"{'copying' if decision[k] == 'copy' else 'encoding'} {k}" for k in ('video', 'audio') if k in decision]
+    return ", ".join(actions)
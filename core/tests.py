@@ -1,3 +1,760 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.middleware.csrf import get_token
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils.http import http_date
+
+from . import chunked, jobs, media, output_cache, packet_index, pipeline, scheduler, storage, stream_copy, views
+from .capabilities import FFmpegCapabilities
+from .downloads import canonical
+from .ffmpeg import ProgressParser, expected_duration, parse_time
+from .models import Job, MediaFile, OutputCacheEntry
+from .progress import SQLiteProgressStore
+from .registry import CommandRegistry, CompiledCommand
+from .storage import PARTIAL_PREFIX, Staging
+from .utils import BASE_FFMPEG_COMMANDS
+
+
+def _compiled(key, **config):
+    """A base profile, or a made-up one when config is given."""
+    return CompiledCommand(key, config or BASE_FFMPEG_COMMANDS[key])
+
+
+# =========================
+# ffmpeg progress & time helpers
+# =========================
+
+class ParseTimeTests(SimpleTestCase):
+    def test_formats(self):
+        self.assertEqual(parse_time("90"), 90)
+        self.assertEqual(parse_time("1:30"), 90)
+        self.assertEqual(parse_time("00:01:30.5"), 90.5)
+        self.assertEqual(parse_time("1500ms"), 1.5)
+        self.assertEqual(parse_time("2500000us"), 2.5)
+        self.assertEqual(parse_time("12s"), 12)
+
+    def test_invalid(self):
+        for value in (None, "", "  ", "abc", "1:xx"):
+            self.assertIsNone(parse_time(value), value)
+
+
+class ExpectedDurationTests(SimpleTestCase):
+    def command(self, *options):
+        return ["ffmpeg", "-y", *options, "-i", "in.mp4", "out.mp4"]
+
+    def test_whole_input(self):
+        self.assertEqual(expected_duration(self.command(), 100.0), 100.0)
+        self.assertIsNone(expected_duration(self.command(), None))
+
+    def test_trims(self):
+        self.assertEqual(expected_duration(self.command("-ss", "10", "-to", "40"), 100.0), 30)
+        self.assertEqual(expected_duration(self.command("-ss", "10", "-t", "5"), 100.0), 5)
+        self.assertEqual(expected_duration(self.command("-ss", "1:00"), 100.0), 40)
+        self.assertEqual(expected_duration(self.command("-ss", "10", "-to", "40"), None), 30)
+
+    def test_clamped_to_input(self):
+        self.assertEqual(expected_duration(self.command("-ss", "90", "-t", "50"), 100.0), 10)
+        self.assertIsNone(expected_duration(self.command("-ss", "200"), 100.0))
+
+
+class ProgressParserTests(SimpleTestCase):
+    def feed(self, parser, block):
+        snapshot = None
+        for line in block.strip().splitlines():
+            snapshot = parser.feed(line)
+        return snapshot
+
+    def test_block_snapshot(self):
+        parser = ProgressParser(duration=10.0)
+        self.assertIsNone(parser.feed("out_time_us=5000000"))
+        self.assertIsNone(parser.feed("not a key value line"))
+        snapshot = self.feed(parser, "fps=29.97\nspeed=2.0x\ntotal_size=1000\nprogress=continue")
+        self.assertEqual(snapshot['percent'], 50.0)
+        self.assertEqual(snapshot['fps'], 30.0)
+        self.assertEqual(snapshot['speed'], 2.0)
+        self.assertEqual(snapshot['size'], 1000)
+        self.assertEqual(snapshot['out_time'], 5.0)
+        self.assertEqual(snapshot['eta'], "2s")
+
+    def test_end_and_unknown_duration(self):
+        parser = ProgressParser()
+        snapshot = self.feed(parser, "out_time_ms=3000000\nspeed=N/A\nprogress=continue")
+        self.assertEqual(snapshot['percent'], 0.0)
+        self.assertIsNone(snapshot['speed'])
+        self.assertEqual(snapshot['eta'], "...")
+        snapshot = self.feed(parser, "out_time_us=4000000\nprogress=end")
+        self.assertEqual(snapshot['percent'], 100.0)
+        self.assertEqual(snapshot['eta'], "0s")
+
+    def test_percent_below_100_until_end(self):
+        parser = ProgressParser(duration=10.0)
+        snapshot = self.feed(parser, "out_time_us=12000000\nprogress=continue")
+        self.assertEqual(snapshot['percent'], 99.9)
+
+
+# =========================
+# Progress store
+# =========================
+
+class SQLiteProgressStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.dir, ignore_errors=True)
+        self.store = SQLiteProgressStore(self.dir / "progress.sqlite3", flush_interval=3600)
+
+    def test_finished_states_are_written_at_once(self):
+        self.store.flush()  # Starts the flush interval
+        self.store['t'] = {'status': 'processing', 'percent': 10}
+        other = SQLiteProgressStore(self.store.path)
+        self.assertIsNone(other.get('t'))
+        self.assertEqual(self.store['t']['percent'], 10)
+        self.store['t'] = {'status': 'complete'}
+        self.assertEqual(other.get('t'), {'status': 'complete'})
+
+    def test_older_batch_doesnt_overwrite_a_newer_state(self):
+        # A batch the flusher thread swapped out before the final state, committed after it
+        stale = {'t': (json.dumps({'status': 'processing'}), False, time.time() - 1)}
+        self.store['t'] = {'status': 'complete'}
+        self.store._pending = stale
+        self.store.flush()
+        self.assertEqual(self.store.get('t'), {'status': 'complete'})
+
+
+# =========================
+# Output cache
+# =========================
+
+class OutputCacheTests(TestCase):
+    def job(self, name="out.mp4"):
+        return Job.objects.create(output_path=str(settings.MEDIA_ROOT / "download" / name))
+
+    def test_lost_race_enqueues_nothing(self):
+        self.assertTrue(output_cache.register("k", self.job(), "fp"))
+        jobs_before = Job.objects.count()
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.assertIsNone(views._enqueue_cached("k", "fp", ["ffmpeg"], profile="p"))
+        self.assertEqual(Job.objects.count(), jobs_before)
+        self.assertEqual(callbacks, [])
+
+    def test_winner_is_registered_before_workers_are_woken(self):
+        with mock.patch.object(jobs, '_queued') as queued, self.captureOnCommitCallbacks(execute=True):
+            job = views._enqueue_cached("k", "fp", ["ffmpeg"], profile="p", output_path="x.mp4")
+            self.assertTrue(OutputCacheEntry.objects.filter(key="k", job=job).exists())
+            queued.assert_not_called()
+        queued.assert_called_once_with(job)
+
+    def test_cancel_releases_one_hold(self):
+        job = self.job()
+        output_cache.register("k", job, "fp")
+        self.assertIsNotNone(output_cache.lookup("k"))
+        self.assertEqual(output_cache.release(job.pk), 1)
+        self.assertEqual(output_cache.release(job.pk), 0)
+
+    def test_deleting_a_shared_output_drops_its_entry(self):
+        job = self.job("shared.mp4")
+        output_cache.register("k", job, "fp")
+        output_cache.lookup("k")
+        self.assertEqual(output_cache.holders("download/shared.mp4"), 2)
+        self.assertEqual(output_cache.forget_output("download/shared.mp4"), 1)
+        self.assertFalse(OutputCacheEntry.objects.exists())
+
+
+# =========================
+# Chunked encoding
+# =========================
+
+class ChunkedPlanningTests(SimpleTestCase):
+    def test_parse_command(self):
+        parsed = chunked.parse_command([
+            "ffmpeg", "-y", "-i", "in.mp4", "-map", "0", "-c:v", "libx264", "-crf", "23",
+            "-c:a", "aac", "-b:a", "128k", "-movflags", "+faststart", "out.mp4",
+        ])
+        self.assertEqual(parsed.input_path, "in.mp4")
+        self.assertEqual(parsed.output_path, "out.mp4")
+        self.assertEqual(parsed.video_options, ["-c:v", "libx264", "-crf", "23"])
+        self.assertEqual(parsed.audio_options, ["-c:a", "aac", "-b:a", "128k"])
+        self.assertEqual(parsed.container_options, ["-movflags", "+faststart"])
+        self.assertTrue(parsed.audio)
+
+    def test_parse_command_shared_codec_and_no_audio(self):
+        parsed = chunked.parse_command(["ffmpeg", "-i", "in.mp4", "-an", "-c", "libx265", "out.mp4"])
+        self.assertEqual(parsed.video_options, ["-c:v", "libx265"])
+        self.assertFalse(parsed.audio)
+
+    def test_unchunkable_commands(self):
+        for command in (
+            ["ffmpeg", "-i", "in.mp4", "-c", "copy", "out.mp4"],
+            ["ffmpeg", "-i", "in.mp4", "-c:a", "aac", "out.mp4"],
+            ["ffmpeg", "-ss", "5", "-i", "in.mp4", "-c:v", "libx264", "out.mp4"],
+            ["ffmpeg", "-i", "a.mp4", "-i", "b.mp4", "-c:v", "libx264", "out.mp4"],
+            ["ffmpeg", "-i", "in.mp4", "-c:v", "libx264", "-f", "segment", "out_%03d.mp4"],
+        ):
+            self.assertIsNone(chunked.parse_command(command), command)
+
+    def test_plan_splits(self):
+        keyframes = [float(t) for t in range(0, 100, 2)]
+        self.assertEqual(chunked.plan_splits(keyframes, 100.0, 4), [24.0, 50.0, 74.0])
+        self.assertEqual(chunked.plan_splits(keyframes, 100.0, 1), [])
+        self.assertEqual(chunked.plan_splits(keyframes, None, 4), [])
+
+    def test_plan_splits_keeps_chunks_long_enough(self):
+        self.assertEqual(chunked.plan_splits([0.0, 5.0, 50.0, 55.0, 95.0], 100.0, 4), [50.0])
+
+    @override_settings(CHUNKED_ENCODE_WORKERS=None, CHUNKED_ENCODE_MIN_DURATION=300)
+    def test_should_chunk(self):
+        command = ["ffmpeg", "-i", "in.mp4", "-c:v", "libx264", "out.mp4"]
+        self.assertTrue(chunked.should_chunk(command, 600, cores=32))
+        # One chunk worker would only add the split and concat
+        self.assertFalse(chunked.should_chunk(command, 600, cores=8))
+        self.assertFalse(chunked.should_chunk(command, 60, cores=32))
+        self.assertFalse(chunked.should_chunk(["ffmpeg", "-i", "in.mp4", "-c", "copy", "out.mp4"], 600, cores=32))
+
+
+# =========================
+# Packet index
+# =========================
+
+class PacketIndexTests(SimpleTestCase):
+    def setUp(self):
+        # (pts, byte offset, size, keyframe), deliberately out of order
+        packets = [(t / 2, 1000 + t * 100, 100, t % 4 == 0) for t in range(20)]
+        self.index = packet_index.PacketIndex(packet_index.serialize(reversed(packets)))
+
+    def test_layout(self):
+        self.assertEqual(len(self.index), 20)
+        self.assertEqual(self.index.duration, 9.5)
+        self.assertEqual(self.index.keyframe_times, [0.0, 2.0, 4.0, 6.0, 8.0])
+
+    def test_keyframe_queries(self):
+        self.assertEqual(self.index.keyframe_before(3.0), 2.0)
+        self.assertEqual(self.index.keyframe_before(4.0), 4.0)
+        self.assertEqual(self.index.keyframe_before(4.0, inclusive=False), 2.0)
+        self.assertIsNone(self.index.keyframe_before(0.0, inclusive=False))
+        self.assertEqual(self.index.keyframe_after(4.0), 4.0)
+        self.assertEqual(self.index.keyframe_after(4.0, inclusive=False), 6.0)
+        self.assertIsNone(self.index.keyframe_after(8.5))
+        self.assertEqual(self.index.keyframe_offset(5.0), 1800)
+        self.assertEqual(self.index.keyframes_between(1.0, 6.0), [2.0, 4.0, 6.0])
+
+    def test_byte_queries(self):
+        self.assertEqual(self.index.bytes_between(0.0, 1.0), 200)
+        self.assertEqual(self.index.bytes_between(2.0, 100.0), 1600)
+        self.assertEqual(self.index.bitrate(0.0, 1.0), 1600)
+        self.assertIsNone(self.index.bitrate(1.0, 1.0))
+
+    def test_rejects_bad_buffers(self):
+        data = packet_index.serialize([(0.0, 0, 10, True)])
+        with self.assertRaises(ValueError):
+            packet_index.PacketIndex(data[:-8])
+        with self.assertRaises(ValueError):
+            packet_index.PacketIndex(b'NOTINDEX' + data[8:])
+
+
+# =========================
+# Pipelines
+# =========================
+
+class PipelineTests(SimpleTestCase):
+    def steps(self, *specs):
+        return [pipeline.Step(key, _compiled(key), params) for key, params in specs]
+
+    def test_fuses_trim_resize_compress(self):
+        steps = self.steps(
+            ("trim_reencode", {"start": "60", "end": "120"}),
+            ("resize_video", {"width": "1280", "height": "720"}),
+            ("compress_ultra", {}),
+        )
+        self.assertEqual(len(pipeline.fuse(steps)), 1)
+        [command] = pipeline.plan(steps, "in.mp4", "out.mp4", "/tmp")
+        self.assertEqual(command[:8], ["ffmpeg", "-y", "-ss", "60.000000", "-to", "120.000000", "-i", "in.mp4"])
+        self.assertIn("scale=1280:720:flags=lanczos", command)
+        # Only the last step's encoder is used
+        self.assertIn("libx265", command)
+        self.assertNotIn("libx264", command)
+        self.assertEqual(command[-1], "out.mp4")
+
+    def test_composes_trims(self):
+        steps = self.steps(("trim_reencode", {"start": "60", "end": "120"}), ("trim_reencode", {"start": "10", "end": "20"}))
+        [stage] = pipeline.fuse(steps)
+        self.assertEqual((stage.start, stage.end), (70, 80))
+
+    def test_trim_after_timing_filter_starts_a_stage(self):
+        speed = _compiled("speed", command=["ffmpeg", "-i", "{input}", "-vf", "setpts=0.5*PTS", "-c:v", "libx264", "{output}"])
+        steps = [pipeline.Step("speed", speed, {}), *self.steps(("trim_reencode", {"start": "1", "end": "2"}))]
+        self.assertEqual(len(pipeline.fuse(steps)), 2)
+
+    def test_standalone_step_writes_lossless_intermediate(self):
+        graph = _compiled("graph", command=["ffmpeg", "-i", "{input}", "-filter_complex", "[0:v]hflip[v]", "-map", "[v]", "-c:v", "libx264", "{output}"])
+        steps = [pipeline.Step("graph", graph, {}), *self.steps(("compress_ultra", {}))]
+        first, second = pipeline.plan(steps, "in.mp4", "out.mp4", "/tmp/work")
+        intermediate = str(Path("/tmp/work") / f"stage_0{pipeline.INTERMEDIATE_EXT}")
+        self.assertEqual(first[-1], intermediate)
+        self.assertEqual(first[first.index("-i") + 2:-1], ["-filter_complex", "[0:v]hflip[v]", "-map", "[v]", *pipeline.LOSSLESS_OPTIONS])
+        self.assertEqual(second[second.index("-i") + 1], intermediate)
+        self.assertEqual(second[-1], "out.mp4")
+
+    def test_rejects_video_step_after_video_removed(self):
+        steps = self.steps(("extract_audio_aac", {}), ("resize_video", {"width": "640", "height": "360"}))
+        with self.assertRaises(pipeline.PipelineError):
+            pipeline.fuse(steps)
+
+    def test_load_steps_validation(self):
+        for data in ([], [1], [{"op": "no_such_op"}], [{"op": ["trim_reencode"]}],
+                     [{"op": "trim_reencode", "params": {"start": "1"}}],
+                     [{"op": "trim_reencode", "params": "start=1"}]):
+            with self.assertRaises(pipeline.PipelineError, msg=data):
+                pipeline.load_steps(data)
+        [step] = pipeline.load_steps([{"op": "trim_reencode", "params": {"start": 1, "end": 2}}])
+        self.assertEqual(step.params, {"start": "1", "end": "2"})
+
+
+# =========================
+# Stream-copy planning
+# =========================
+
+H264_VIDEO = {'type': 'video', 'codec': 'h264', 'pix_fmt': 'yuv420p', 'profile': 'High', 'level': 40}
+AAC_AUDIO = {'type': 'audio', 'codec': 'aac', 'profile': 'LC'}
+
+
+class StreamCopyTests(SimpleTestCase):
+    def source(self, *streams):
+        return MediaFile(path="upload/in.mp4", size=1, mtime=0, probed=True, streams=list(streams))
+
+    def test_mismatch(self):
+        spec = BASE_FFMPEG_COMMANDS["base_best_quality"]["target"]["video"]
+        self.assertIsNone(stream_copy.mismatch(spec, H264_VIDEO))
+        self.assertEqual(stream_copy.mismatch(spec, {**H264_VIDEO, 'level': 51}), "level 51 > 41")
+        self.assertEqual(stream_copy.mismatch(spec, {**H264_VIDEO, 'codec': 'hevc'}), "codec hevc not h264")
+        self.assertEqual(stream_copy.mismatch(spec, {**H264_VIDEO, 'level': None}), "level unknown")
+        self.assertIsNone(stream_copy.mismatch({'encode': ['-c:v', 'libx264']}, {}))
+
+    def test_copies_streams_that_meet_the_target(self):
+        compiled = _compiled("base_best_quality")
+        command = compiled.build(input="in.mp4", output="out.mp4")
+        planned, decision = stream_copy.plan(compiled, command, self.source(H264_VIDEO, AAC_AUDIO))
+        self.assertEqual((decision['video'], decision['audio']), ('copy', 'copy'))
+        self.assertEqual(planned[-1], "out.mp4")
+        self.assertIn("-c:v", planned)
+        self.assertEqual(planned[planned.index("-c:v") + 1], "copy")
+        self.assertNotIn("libx264", planned)
+        self.assertNotIn("-crf", planned)
+
+    def test_encodes_streams_that_dont(self):
+        compiled = _compiled("base_best_quality")
+        command = compiled.build(input="in.mp4", output="out.mp4")
+        planned, decision = stream_copy.plan(compiled, command, self.source({**H264_VIDEO, 'codec': 'hevc'}, AAC_AUDIO))
+        self.assertEqual((decision['video'], decision['audio']), ('encode', 'copy'))
+        self.assertIn("libx264", planned)
+        self.assertEqual(decision['reasons']['video'], "codec hevc not h264")
+
+    def test_remux_encodes_what_the_container_cant_hold(self):
+        compiled = _compiled("remux_copy")
+        command = compiled.build(input="in.mkv", output="out.mp4")
+        source = self.source(H264_VIDEO, {'type': 'audio', 'codec': 'vorbis'})
+        planned, decision = stream_copy.plan(compiled, command, source)
+        self.assertEqual((decision['video'], decision['audio']), ('copy', 'encode'))
+        self.assertEqual(planned[planned.index("-c:a") + 1], "aac")
+
+    def test_no_plan(self):
+        compiled = _compiled("base_best_quality")
+        command = compiled.build(input="in.mp4", output="out.mp4")
+        source = self.source(H264_VIDEO, AAC_AUDIO)
+        self.assertIsNone(stream_copy.plan(compiled, command, None)[1])
+        self.assertIsNone(stream_copy.plan(_compiled("resize_video"), command, source)[1])
+        seek = ["ffmpeg", "-ss", "5", *command[1:]]
+        self.assertEqual(stream_copy.plan(compiled, seek, source), (seek, None))
+        with override_settings(STREAM_COPY_PLANNER=False):
+            self.assertIsNone(stream_copy.plan(compiled, command, source)[1])
+
+
+# =========================
+# Uploads
+# =========================
+
+class UploadCsrfTests(TestCase):
+    def setUp(self):
+        self.root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        media_root = override_settings(MEDIA_ROOT=self.root)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        self.client = Client(enforce_csrf_checks=True)
+        request = RequestFactory().get('/')
+        self.token = get_token(request)
+        self.client.cookies['csrftoken'] = request.META['CSRF_COOKIE']
+
+    def upload(self, data=None, **headers):
+        data = {'file': SimpleUploadedFile("clip.mp4", b"x" * 1000), **(data or {})}
+        return self.client.post('/upload/?process=remux_copy', data, **headers)
+
+    def uploaded_files(self):
+        folder = self.root / "local_videos"
+        return sorted(p.name for p in folder.iterdir() if p.is_file()) if folder.is_dir() else []
+
+    def test_header_token_is_checked_before_the_body_is_read(self):
+        response = self.upload(HTTP_X_CSRFTOKEN="x" * 64)
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse((self.root / "local_videos").exists())
+        self.assertFalse(Job.objects.exists())
+
+    def test_rejected_body_token_leaves_nothing_behind(self):
+        response = self.upload({'csrfmiddlewaretoken': "x" * 64})
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.uploaded_files(), [])
+        self.assertFalse(Job.objects.exists())
+
+    def test_genuine_uploads_queue_their_job(self):
+        for data, headers in (({'csrfmiddlewaretoken': self.token}, {}), ({}, {'HTTP_X_CSRFTOKEN': self.token})):
+            response = self.upload(data, HTTP_X_REQUESTED_WITH='XMLHttpRequest', **headers)
+            self.assertEqual(response.status_code, 200)
+            job = Job.objects.get(pk=response.json()['task_id'])
+            self.assertEqual((job.kind, job.profile), ('upload_stream', 'remux_copy'))
+
+
+# =========================
+# Media delivery
+# =========================
+
+class MediaRangeTests(SimpleTestCase):
+    def test_parse_range(self):
+        self.assertIsNone(media.parse_range(None, 1000))
+        self.assertIsNone(media.parse_range("bytes=-", 1000))
+        self.assertIsNone(media.parse_range("bytes=0-1,5-6", 1000))
+        self.assertIsNone(media.parse_range("items=0-1", 1000))
+        self.assertEqual(media.parse_range("bytes=0-99", 1000), (0, 99))
+        self.assertEqual(media.parse_range("bytes=500-", 1000), (500, 999))
+        self.assertEqual(media.parse_range("bytes=-100", 1000), (900, 999))
+        self.assertEqual(media.parse_range("bytes=-5000", 1000), (0, 999))
+        self.assertEqual(media.parse_range("bytes=0-5000", 1000), (0, 999))
+
+    def test_unsatisfiable(self):
+        for header in ("bytes=1000-", "bytes=-0", "bytes=5-4"):
+            with self.assertRaises(media.RangeNotSatisfiable, msg=header):
+                media.parse_range(header, 1000)
+
+    def test_not_modified(self):
+        factory = RequestFactory()
+        etag, mtime = '"3e8-1"', 1_700_000_000
+        self.assertTrue(media.not_modified(factory.get('/', HTTP_IF_NONE_MATCH=etag), etag, mtime))
+        self.assertTrue(media.not_modified(factory.get('/', HTTP_IF_NONE_MATCH=f'"x", W/{etag}'), etag, mtime))
+        self.assertTrue(media.not_modified(factory.get('/', HTTP_IF_NONE_MATCH='*'), etag, mtime))
+        self.assertFalse(media.not_modified(factory.get('/', HTTP_IF_NONE_MATCH='"other"'), etag, mtime))
+        self.assertTrue(media.not_modified(factory.get('/', HTTP_IF_MODIFIED_SINCE=http_date(mtime)), etag, mtime))
+        self.assertFalse(media.not_modified(factory.get('/', HTTP_IF_MODIFIED_SINCE=http_date(mtime - 60)), etag, mtime))
+        # If-None-Match wins over If-Modified-Since
+        request = factory.get('/', HTTP_IF_NONE_MATCH='"other"', HTTP_IF_MODIFIED_SINCE=http_date(mtime))
+        self.assertFalse(media.not_modified(request, etag, mtime))
+        self.assertFalse(media.not_modified(factory.post('/', HTTP_IF_NONE_MATCH=etag), etag, mtime))
+
+
+# =========================
+# Downloads
+# =========================
+
+class CanonicalUrlTests(SimpleTestCase):
+    def test_youtube_spellings(self):
+        for url in (
+            "https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=42",
+            "https://youtu.be/dQw4w9WgXcQ?si=abc",
+            "http://m.youtube.com/shorts/dQw4w9WgXcQ",
+            "https://youtube.com/embed/dQw4w9WgXcQ",
+            " https://music.youtube.com/watch?list=x&v=dQw4w9WgXcQ ",
+        ):
+            self.assertEqual(canonical(url), ("youtube:dQw4w9WgXcQ", "youtube.com"), url)
+
+    def test_other_urls(self):
+        key, host = canonical("https://Example.com/a?b=2&a=1")
+        self.assertEqual(host, "example.com")
+        self.assertEqual(key, canonical("https://example.com/a?a=1&b=2#frag")[0])
+        self.assertNotEqual(key, canonical("https://example.com/b?a=1&b=2")[0])
+        # A YouTube URL without a video id isn't collapsed
+        self.assertEqual(canonical("https://www.youtube.com/feed/trending")[0], "https://www.youtube.com/feed/trending")
+
+    def test_long_urls_are_hashed(self):
+        key, _ = canonical("https://example.com/?q=" + "x" * 1000)
+        self.assertTrue(key.startswith("sha256:"))
+        self.assertLessEqual(len(key), 500)
+
+
+# =========================
+# Scheduling
+# =========================
+
+class ClassifyTests(SimpleTestCase):
+    def test_classify(self):
+        self.assertEqual(scheduler.classify(["ffmpeg", "-i", "in", "-c", "copy", "out"]), 'copy')
+        self.assertEqual(scheduler.classify(["ffmpeg", "-i", "in", "-c:v", "libx264", "-preset", "fast", "out"]), 'light')
+        self.assertEqual(scheduler.classify(["ffmpeg", "-i", "in", "-c:v", "libx264", "-preset", "veryslow", "out"]), 'heavy')
+        self.assertEqual(scheduler.classify(["ffmpeg", "-i", "in", "-c:v", "libx265", "out"]), 'heavy')
+        self.assertEqual(scheduler.classify(["ffmpeg", "-i", "in", "-vf", "minterpolate=fps=60", "-c:v", "libx264", "out"]), 'heavy')
+        self.assertEqual(scheduler.classify(["ffmpeg", "-i", "in", "-c:v", "h264_nvenc", "out"]), 'gpu')
+        self.assertEqual(scheduler.classify(["ffmpeg", "-i", "in", "-c", "copy", "-vf", "scale=1:1", "out"]), 'light')
+        declared = _compiled("x", command=["ffmpeg", "-i", "{input}", "-c:v", "libx265", "{output}"], cost='light')
+        self.assertEqual(scheduler.classify(declared.template, declared), 'light')
+
+    def test_classify_job_uses_costliest_profile(self):
+        command = ["ffmpeg", "-i", "in", "-c", "copy", "out"]
+        for kind, profile in (('multi', 'remux_copy+compress_ultra'), ('pipeline', 'remux_copy|compress_ultra')):
+            self.assertEqual(scheduler.classify_job(Job(kind=kind, profile=profile, command=command)), 'heavy', kind)
+        self.assertEqual(scheduler.classify_job(Job(kind='ffmpeg', profile='remux_copy', command=command)), 'copy')
+
+
+@override_settings(SCHEDULER_CAPACITY=8, SCHEDULER_MAX_THREADS=16, SCHEDULER_MEMORY_RESERVE_MB=512)
+class AdmitTests(TestCase):
+    HEAVY = ["ffmpeg", "-i", "in", "-c:v", "libx265", "out"]
+
+    def setUp(self):
+        patches = [
+            mock.patch.object(scheduler, 'busy_cores', return_value=0.0),
+            mock.patch.object(scheduler, 'available_memory_mb', return_value=64000.0),
+        ]
+        self.busy, self.memory = [p.start() for p in patches]
+        for p in patches:
+            self.addCleanup(p.stop)
+        self.scheduler = scheduler.Scheduler(workers=4)
+
+    def job(self, command=HEAVY, priority=0):
+        return Job(pk=uuid.uuid4(), kind='ffmpeg', profile='test', command=command, priority=priority)
+
+    def test_waiting_jobs_share_the_machine(self):
+        first, reason = self.scheduler.admit(self.job(), waiting=2)
+        self.assertIsNone(reason)
+        self.assertEqual((first.cost_class, first.cores, first.threads), ('heavy', 4.0, 4))
+        self.assertEqual(first.nice, scheduler.DEFAULT_NICE['heavy'])
+        second, _ = self.scheduler.admit(self.job(), waiting=1)
+        self.assertEqual(second.cores, 4.0)
+        third, reason = self.scheduler.admit(self.job(), waiting=1)
+        self.assertIsNone(third)
+        self.assertIn("waiting for CPU", reason)
+        self.scheduler.release(first)
+        self.assertIsNotNone(self.scheduler.admit(self.job(), waiting=1)[0])
+
+    def test_first_job_always_runs(self):
+        self.busy.return_value = 8.0
+        self.memory.return_value = 10.0
+        grant, reason = self.scheduler.admit(self.job())
+        self.assertIsNone(reason)
+        self.assertEqual(grant.cores, 8.0)
+
+    def test_outside_load_and_memory(self):
+        light = ["ffmpeg", "-i", "in", "-c:v", "libx264", "out"]
+        self.scheduler.admit(self.job(light))
+        self.busy.return_value = 7.5  # 2 cores are ours
+        grant, reason = self.scheduler.admit(self.job(light))
+        self.assertIsNone(grant)
+        self.assertIn("waiting for CPU", reason)
+        self.busy.return_value = 2.0
+        self.memory.return_value = 600.0
+        grant, reason = self.scheduler.admit(self.job(light))
+        self.assertIsNone(grant)
+        self.assertIn("waiting for memory", reason)
+
+    def test_interactive_jobs_arent_deprioritised(self):
+        grant, _ = self.scheduler.admit(self.job(priority=1))
+        self.assertEqual((grant.nice, grant.ionice), (0, scheduler.DEFAULT_IONICE['copy']))
+
+
+# =========================
+# Staging
+# =========================
+
+class StagingTests(SimpleTestCase):
+    def setUp(self):
+        self.dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.dir, ignore_errors=True)
+
+    def job(self, **fields):
+        output = str(self.dir / "out.mp4")
+        return Job(pk=uuid.uuid4(), command=["ffmpeg", "-i", "in.mp4", output], output_path=output, **fields)
+
+    def test_apply_and_commit(self):
+        job = self.job()
+        final = job.output_path
+        staging = Staging(job)
+        staging.apply()
+        staged_dir = self.dir / f"{PARTIAL_PREFIX}{job.pk}"
+        self.assertEqual(job.output_path, str(staged_dir / "out.mp4"))
+        self.assertEqual(job.command[-1], job.output_path)
+        self.assertTrue(staged_dir.is_dir())
+
+        Path(job.output_path).write_bytes(b"data")
+        (staged_dir / ".handler-temp").mkdir()
+        result = staging.commit({'output': job.output_path})
+        self.assertEqual(result, {'output': final})
+        self.assertEqual(Path(final).read_bytes(), b"data")
+        self.assertFalse(staged_dir.exists())
+
+    def test_segment_outputs(self):
+        pattern = str(self.dir / "seg_%03d.mp4")
+        job = self.job(payload={'outputs': [pattern]})
+        job.command = ["ffmpeg", "-i", "in.mp4", "-f", "segment", pattern]
+        job.output_path = ""
+        staging = Staging(job)
+        staging.apply()
+        staged_pattern = job.payload['outputs'][0]
+        self.assertEqual(job.command[-1], staged_pattern)
+        for n in range(2):
+            Path(staged_pattern % n).write_bytes(b"x")
+        result = staging.commit({'outputs': [staged_pattern]})
+        self.assertEqual(result['outputs'], [pattern])
+        self.assertEqual(sorted(p.name for p in self.dir.iterdir()), ["seg_000.mp4", "seg_001.mp4"])
+
+    def test_apply_starts_over_and_discard_cleans_up(self):
+        job = self.job()
+        leftover = self.dir / f"{PARTIAL_PREFIX}{job.pk}" / "out.mp4"
+        leftover.parent.mkdir()
+        leftover.write_bytes(b"half")
+        staging = Staging(job)
+        staging.apply()
+        self.assertFalse(leftover.exists())
+        staging.discard()
+        self.assertEqual(list(self.dir.iterdir()), [])
+
+
+@override_settings(STORAGE_ORPHAN_AGE=3600)
+class OrphanCleanupTests(TestCase):
+    def setUp(self):
+        self.root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        media_root = override_settings(MEDIA_ROOT=self.root)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        (self.root / "download").mkdir()
+
+    def partial(self, job_id, age):
+        path = self.root / "download" / f"{PARTIAL_PREFIX}{job_id}"
+        path.mkdir()
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_partial_dirs(self):
+        crashed = self.partial(uuid.uuid4(), age=7200)
+        running = Job.objects.create(status=Job.STATUS_RUNNING)
+        busy = self.partial(running.pk, age=7200)
+        # Staged by a job claimed after the sweep read which jobs run
+        fresh = self.partial(uuid.uuid4(), age=0)
+        self.assertEqual(storage.cleanup_orphans(), 1)
+        self.assertFalse(crashed.exists())
+        self.assertTrue(busy.exists())
+        self.assertTrue(fresh.exists())
+
+    def test_rechecks_the_job_before_deleting(self):
+        job = Job.objects.create(status=Job.STATUS_RUNNING)
+        path = self.partial(job.pk, age=7200)
+        with mock.patch.object(storage, '_orphan_kind', return_value='partial'):
+            storage.cleanup_orphans()
+        self.assertTrue(path.exists())
+
+
+# =========================
+# Library API
+# =========================
+
+class LibraryApiTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch('core.library.rescan')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for n, size in enumerate([500, 100, 300, 100, 200]):
+            MediaFile.objects.create(
+                path=f"download/clip{n}.mp4", folder="download", source="Processed", name=f"clip{n}.mp4",
+                extension=".mp4", size=size, mtime=n, duration=n * 10.0 if n % 2 else None,
+            )
+
+    def pages(self, **params):
+        names, cursor = [], None
+        while True:
+            query = {**params, 'limit': 2}
+            if cursor:
+                query['cursor'] = cursor
+            data = self.client.get('/api/library/', query).json()
+            self.assertLessEqual(len(data['results']), 2)
+            names += [r['name'] for r in data['results']]
+            cursor = data['next_cursor']
+            if not cursor:
+                return names
+
+    def test_cursor_paging(self):
+        expected = list(MediaFile.objects.order_by('size', 'id').values_list('name', flat=True))
+        self.assertEqual(self.pages(sort='size'), expected)
+        self.assertEqual(self.pages(sort='-size'), list(MediaFile.objects.order_by('-size', '-id').values_list('name', flat=True)))
+        self.assertEqual(self.pages(sort='newest'), [f"clip{n}.mp4" for n in range(4, -1, -1)])
+        # Unprobed files have no duration to page by
+        self.assertEqual(self.pages(sort='duration'), ["clip1.mp4", "clip3.mp4"])
+
+    def test_filters(self):
+        data = self.client.get('/api/library/', {'max_size': 200, 'q': 'CLIP'}).json()
+        self.assertEqual(sorted(r['name'] for r in data['results']), ["clip1.mp4", "clip3.mp4", "clip4.mp4"])
+
+    def test_bad_requests(self):
+        self.assertEqual(self.client.get('/api/library/', {'sort': 'random'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/library/', {'cursor': '!!!'}).status_code, 400)
+
+    def test_etag_changes_on_delete(self):
+        etag = self.client.get('/api/library/')['ETag']
+        self.assertEqual(self.client.get('/api/library/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        MediaFile.objects.filter(name="clip0.mp4").delete()
+        self.assertEqual(self.client.get('/api/library/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+# =========================
+# Command registry
+# =========================
+
+class CommandRegistryTests(SimpleTestCase):
+    def setUp(self):
+        self.dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.dir, ignore_errors=True)
+        self.path = self.dir / "custom_commands.json"
+        patcher = mock.patch('core.registry.get_capabilities', return_value=FFmpegCapabilities())
+        self.capabilities = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.registry = CommandRegistry({
+            "copy": {"command": ["ffmpeg", "-i", "{input}", "-c", "copy", "{output}"], "description": "Copy"},
+            "scale_gpu": {"command": ["ffmpeg", "-hwaccel", "cuda", "-i", "{input}", "{output}"], "description": "GPU"},
+        }, self.path)
+
+    def write(self, data, mtime_ns):
+        self.path.write_text(json.dumps(data))
+        os.utime(self.path, ns=(mtime_ns, mtime_ns))
+
+    def test_compiles_templates(self):
+        self.write({"crop": {"command": ["ffmpeg", "-i", "{input}", "-vf", "crop={w}:{h}", "{output}"]}}, 10**18)
+        crop = self.registry.get("crop")
+        self.assertEqual(crop.parameters, ["w", "h"])
+        self.assertEqual(crop.build(input="a", output="b", w=1, h=2), ["ffmpeg", "-i", "a", "-vf", "crop=1:2", "b"])
+        self.assertEqual(self.registry.params_map()["copy"], [])
+
+    def test_gpu_commands_need_a_gpu(self):
+        self.assertIsNone(self.registry.get("scale_gpu"))
+        self.capabilities.return_value = FFmpegCapabilities(hwaccels=["cuda"], encoders=["h264_nvenc"])
+        self.assertIsNotNone(self.registry.get("scale_gpu"))
+
+    def test_reloads_when_the_file_changes(self):
+        self.write({"one": {"command": ["ffmpeg", "-i", "{input}", "{output}"]}}, 10**18)
+        self.assertIsNotNone(self.registry.get("one"))
+        self.write({"two": {"command": ["ffmpeg", "-i", "{input}", "{output}"]}, "bad": {"description": "no command"}}, 10**18 + 1)
+        self.assertIsNone(self.registry.get("one"))
+        self.assertIsNotNone(self.registry.get("two"))
+        # Malformed entries are skipped
+        self.assertIsNone(self.registry.get("bad"))
+
+    def test_save_custom(self):
+        self.write({"one": {"command": ["ffmpeg", "-i", "{input}", "{output}"]}}, 10**18)
+        self.registry.get("one")
+        self.registry.save_custom("two", ["ffmpeg", "-i", "{input}", "-an", "{output}"], "No audio", {"audio": None})
+        self.assertEqual(set(json.loads(self.path.read_text())), {"one", "two"})
+        self.assertEqual(self.registry.get("two").description, "No audio")
+        self.assertEqual(self.registry.get("two").config["target"], {"audio": None})
+        self.assertIsNotNone(self.registry.get("one"))
+        self.assertEqual([p.name for p in self.dir.iterdir() if p.name.endswith(".tmp")], [])
@@ -0,0 +1,135 @@
+"""
+Poster frames and seek-preview sprite sheets for library videos.
+
+Images are cached under MEDIA_ROOT/.thumbs, named by the source's content
+fingerprint, so they never need invalidating and can be served with
+far-future cache headers. Only keyframes are decoded (-skip_frame nokey),
+and generation runs in a small bounded pool so a bulk import can't saturate
+the machine.
+"""
+import json
+import os
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from django.conf import settings
+
+from . import metrics
+
+POSTER_WIDTH = 320
+SPRITE_COLUMNS = 5
+SPRITE_ROWS = 5
+SPRITE_TILE_WIDTH = 160
+
+_executor = None
+_executor_lock = threading.Lock()
+_in_flight = set()
+# Sources ffmpeg couldn't thumbnail; not retried until the process restarts
+_failed = set()
+
+
+def thumbs_dir() -> Path:
+    return settings.MEDIA_ROOT / ".thumbs"
+
+
+def thumb_path(fingerprint: str, kind: str) -> Path:
+    """kind: 'poster' (jpg), 'sprite' (jpg) or 'sprite.json' (tile layout)."""
+    ext = "" if kind.endswith(".json") else ".jpg"
+    return thumbs_dir() / fingerprint[:2] / f"{fingerprint}_{kind}{ext}"
+
+
+def has_thumbnails(fingerprint: str) -> bool:
+    return bool(fingerprint) and thumb_path(fingerprint, "poster").exists()
+
+
+# =========================
+# Generation
+# =========================
+
+def _run_ffmpeg(command):
+    metrics.spawned(command)
+    subprocess.run(command, capture_output=True, check=True)
+
+
+def generate_poster(source: Path, fingerprint: str, duration=None):
+    out = thumb_path(fingerprint, "poster")
+    tmp = out.with_name(f".{out.name}")
+    # Seek to ~10% in to skip black intros; with -skip_frame nokey only keyframes are decoded
+    seek = min(duration * 0.1, 30) if duration else 0
+    _run_ffmpeg([
+        "ffmpeg", "-y", "-v", "error", "-threads", "1",
+        "-skip_frame", "nokey", "-ss", f"{seek:.3f}", "-i", str(source),
+        "-frames:v", "1", "-vf", f"scale={POSTER_WIDTH}:-2", "-q:v", "4",
+        "-f", "image2", str(tmp)
+    ])
+    os.replace(tmp, out)
+
+
+def generate_sprite(source: Path, fingerprint: str, duration):
+    """A SPRITE_COLUMNS x SPRITE_ROWS grid of frames spread evenly over the video."""
+    tiles = SPRITE_COLUMNS * SPRITE_ROWS
+    interval = max(duration / tiles, 0.5)
+    out = thumb_path(fingerprint, "sprite")
+    tmp = out.with_name(f".{out.name}")
+    _run_ffmpeg([
+        "ffmpeg", "-y", "-v", "error", "-threads", "1",
+        "-skip_frame", "nokey", "-i", str(source),
+        "-vf", (
+            f"select='isnan(prev_selected_t)+gte(t-prev_selected_t\\,{interval:.3f})',"
+            f"scale={SPRITE_TILE_WIDTH}:-2,tile={SPRITE_COLUMNS}x{SPRITE_ROWS}"
+        ),
+        "-fps_mode", "vfr", "-frames:v", "1", "-q:v", "5",
+        "-f", "image2", str(tmp)
+    ])
+    os.replace(tmp, out)
+    with open(thumb_path(fingerprint, "sprite.json"), "w") as f:
+        json.dump({"columns": SPRITE_COLUMNS, "rows": SPRITE_ROWS, "interval": interval}, f)
+
+
+def generate(source, fingerprint: str, duration=None):
+    source = Path(source)
+    thumb_path(fingerprint, "poster").parent.mkdir(parents=True, exist_ok=True)
+    if not thumb_path(fingerprint, "poster").exists():
+        generate_poster(source, fingerprint, duration)
+    if duration and not thumb_path(fingerprint, "sprite").exists():
+        generate_sprite(source, fingerprint, duration)
+
+
+# =========================
+# Bounded background pool
+# =========================
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, "THUMBNAIL_WORKERS", 2),
+                    thread_name_prefix="thumbnails",
+                )
+    return _executor
+
+
+def schedule(source, fingerprint: str, duration=None):
+    """Queues thumbnail generation for a video unless it's cached or already queued."""
+    if not fingerprint or fingerprint in _failed or has_thumbnails(fingerprint):
+        return
+    with _executor_lock:
+        if fingerprint in _in_flight:
+            return
+        _in_flight.add(fingerprint)
+
+    def run():
+        try:
+            generate(source, fingerprint, duration)
+        except (subprocess.CalledProcessError, FileNotFoundError, OSError) as e:
+            print(f"Thumbnail generation failed for {source}: {e}")
+            _failed.add(fingerprint)
+        finally:
+            with _executor_lock:
+                _in_flight.discard(fingerprint)
+
+    _get_executor().submit(run)
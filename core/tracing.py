@@ -0,0 +1,166 @@
+"""
+Per-task phase tracing.
+
+A Trace collects timed spans in memory while a request, job or download runs,
+and writes them in one batch to models.TraceSpan under the task's id:
+
+    trace = Trace()
+    trace.phase('probe')            # sequential phases of the task (depth 0)
+    ...
+    trace.phase('encode')
+    with trace.span('ffmpeg') as attrs:   # nested inside the current phase
+        ...
+        attrs['cpu'] = 1.2
+    trace.save(job.id)
+
+process_video's request phases and the job's phases go into the same trace,
+since the job id is the task id. GET /jobs/<id>/trace/ returns it as JSON.
+
+Storage is bounded: a trace keeps at most TRACE_SPANS_PER_TASK spans per
+batch, and the oldest rows are dropped once there are more than
+TRACE_MAX_SPANS in total.
+"""
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from django.conf import settings
+
+from .models import TraceSpan
+
+# Seconds between checks for spans over TRACE_MAX_SPANS
+PRUNE_INTERVAL = 60
+
+_last_prune = 0.0
+
+
+def _enabled() -> bool:
+    return getattr(settings, 'TRACING_ENABLED', True)
+
+
+class Trace:
+    """Spans recorded by one process for one task."""
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+        self._phase = None
+        self._open = 0  # spans currently open below the phase
+
+    def _new(self, name, depth, attrs) -> dict:
+        return {'name': name, 'depth': depth, 'start': time.time(), 'started': time.perf_counter(),
+                'duration': None, 'attrs': attrs}
+
+    def phase(self, name, **attrs) -> dict:
+        """Ends the current phase and starts the next. Returns its attrs, to add to."""
+        with self._lock:
+            self._close_phase()
+            self._phase = self._new(name, 0, attrs)
+            self.spans.append(self._phase)
+        return attrs
+
+    def _close_phase(self):
+        if self._phase is not None:
+            self._phase['duration'] = time.perf_counter() - self._phase['started']
+            self._phase = None
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """Times a block inside the current phase; the yielded attrs dict is stored with it."""
+        with self._lock:
+            record = self._new(name, self._open + (1 if self._phase else 0), attrs)
+            self.spans.append(record)
+            self._open += 1
+        try:
+            yield attrs
+        except BaseException as e:
+            attrs.setdefault('error', str(e) or type(e).__name__)
+            raise
+        finally:
+            with self._lock:
+                record['duration'] = time.perf_counter() - record['started']
+                self._open -= 1
+
+    def add(self, name, start: datetime, end: datetime, **attrs):
+        """Records a phase that happened elsewhere, e.g. the time a job spent queued."""
+        with self._lock:
+            self.spans.append({'name': name, 'depth': 0, 'start': start.timestamp(), 'started': None,
+                               'duration': max((end - start).total_seconds(), 0.0), 'attrs': attrs})
+
+    def save(self, task_id, **attrs):
+        """Ends the current phase and writes the spans. attrs (the outcome) go on a final 'end' mark."""
+        with self._lock:
+            self._close_phase()
+            if attrs:
+                self.spans.append({'name': 'end', 'depth': 0, 'start': time.time(), 'started': None,
+                                   'duration': 0.0, 'attrs': attrs})
+            spans, self.spans = self.spans, []
+        if not task_id or not spans or not _enabled():
+            return
+        now = time.perf_counter()
+        process = f"{socket.gethostname()}:{os.getpid()}"
+        limit = getattr(settings, 'TRACE_SPANS_PER_TASK', 200)
+        rows = [
+            TraceSpan(
+                task_id=str(task_id), name=s['name'][:128], depth=s['depth'],
+                start=datetime.fromtimestamp(s['start'], timezone.utc),
+                # Spans still open (e.g. left by an exception in a helper thread) end now
+                duration=s['duration'] if s['duration'] is not None else now - s['started'],
+                attrs=s['attrs'], process=process,
+            )
+            for s in spans[:limit]
+        ]
+        if len(spans) > limit:
+            rows[-1].attrs = {**rows[-1].attrs, 'truncated': len(spans) - limit}
+        try:
+            TraceSpan.objects.bulk_create(rows)
+            _prune()
+        except Exception as e:
+            print(f"Saving trace {task_id} failed: {e}")
+
+
+def _prune():
+    global _last_prune
+    now = time.monotonic()
+    if now - _last_prune < PRUNE_INTERVAL:
+        return
+    _last_prune = now
+    keep = getattr(settings, 'TRACE_MAX_SPANS', 50000)
+    cutoff = list(TraceSpan.objects.order_by('-id').values_list('id', flat=True)[keep:keep + 1])
+    if cutoff:
+        TraceSpan.objects.filter(id__lte=cutoff[0]).delete()
+
+
+def get_trace(task_id) -> dict | None:
+    """A task's spans as JSON-friendly dicts, with the time spent in each phase, or None."""
+    spans = list(TraceSpan.objects.filter(task_id=str(task_id)))
+    if not spans:
+        return None
+    phases = {}
+    for s in spans:
+        if s.depth == 0 and s.name != 'end':
+            phases[s.name] = round(phases.get(s.name, 0.0) + s.duration, 4)
+    first = spans[0].start
+    end = max(s.start.timestamp() + s.duration for s in spans)
+    return {
+        'task_id': str(task_id),
+        'start': first.isoformat(),
+        'duration': round(end - first.timestamp(), 4),
+        'phases': phases,
+        # The last run's outcome (a retried job has one 'end' per attempt)
+        'outcome': next((s.attrs for s in reversed(spans) if s.name == 'end'), None),
+        'spans': [
+            {
+                'name': s.name,
+                'depth': s.depth,
+                'offset': round((s.start - first).total_seconds(), 4),
+                'duration': round(s.duration, 4),
+                'attrs': s.attrs,
+                'process': s.process,
+            }
+            for s in spans
+        ],
+    }
@@ -0,0 +1,444 @@
+"""
+Uploads written once, straight into the media folder.
+
+Django spools large uploads to a temporary file, and upload_video used to copy
+that file into local_videos, so every upload hit the disk twice. Now:
+
+- StreamingUploadHandler (installed for the upload view only) writes the file
+  part of the request body directly to a hidden .part file next to its final
+  location, hashing it as it goes. Finishing is a same-filesystem rename.
+- Resumable sessions (api/uploads/) take a file in chunks. Each chunk says
+  which offset it starts at. After a dropped connection the client asks for
+  the current offset and carries on from there.
+- An upload can name a profile to run as soon as it starts. The job reads the
+  .part file as it grows and pipes it into ffmpeg's stdin (follow()), so the
+  transcode finishes shortly after the upload does.
+
+A session is a .part file plus a .json sidecar in local_videos/.uploads/.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+
+from . import library
+from .system import FileLock
+from .utils import clean_name
+
+UPLOAD_FOLDER = "local_videos"
+CHUNK_SIZE = 1 << 20
+# Chunk size suggested to resumable clients
+CLIENT_CHUNK_SIZE = 8 << 20
+# What ffmpeg reads when a job follows an upload
+PIPE_INPUT = "pipe:0"
+# Jobs following an upload start ahead of the queue so the transcode keeps pace with it
+JOB_PRIORITY = 10
+ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+STATUS_UPLOADING = 'uploading'
+STATUS_COMPLETE = 'complete'
+STATUS_ABORTED = 'aborted'
+
+# upload id -> (offset, running sha256) for sessions written by this process
+_hashers = {}
+_hashers_lock = threading.Lock()
+
+
+class UploadError(ValueError):
+    pass
+
+
+class UploadIncomplete(UploadError):
+    """Nothing arrived for a while; the client may still resume the upload."""
+
+
+class OffsetMismatch(UploadError):
+    def __init__(self, offset):
+        super().__init__(f"Upload is at byte {offset}.")
+        self.offset = offset
+
+
+def sessions_dir() -> Path:
+    return settings.MEDIA_ROOT / UPLOAD_FOLDER / ".uploads"
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+class UploadSession:
+    """One upload in progress (or recently finished)."""
+
+    def __init__(self, upload_id, meta):
+        self.id = upload_id
+        self.meta = meta
+
+    @property
+    def part_path(self) -> Path:
+        return sessions_dir() / f"{self.id}.part"
+
+    @property
+    def meta_path(self) -> Path:
+        return sessions_dir() / f"{self.id}.json"
+
+    @property
+    def path(self) -> Path:
+        """Where the finished file goes."""
+        return settings.MEDIA_ROOT / self.meta['path']
+
+    @property
+    def status(self) -> str:
+        return self.meta['status']
+
+    @property
+    def size(self) -> int | None:
+        return self.meta.get('size')
+
+    @property
+    def offset(self) -> int:
+        if self.status == STATUS_COMPLETE:
+            return self.meta.get('received', 0)
+        try:
+            return self.part_path.stat().st_size
+        except OSError:
+            return 0
+
+    # ---- lifecycle ----
+
+    @classmethod
+    def create(cls, name, size=None, sha256=None) -> 'UploadSession':
+        name = clean_name(Path(name or '').name)
+        if Path(name).suffix.lower() not in library.VALID_EXTENSIONS or not Path(name).stem:
+            raise UploadError(f"Unsupported file type: {name or '(no name)'}")
+        if size is not None and (not isinstance(size, int) or size < 0):
+            raise UploadError("size must be a byte count.")
+        max_size = _setting('UPLOAD_MAX_SIZE', None)
+        if size is not None and max_size and size > max_size:
+            raise UploadError(f"File is larger than the {max_size} byte limit.")
+        if sha256 is not None and not re.fullmatch(r"[0-9a-fA-F]{64}", str(sha256)):
+            raise UploadError("sha256 must be a hex digest.")
+
+        cleanup_stale()
+        session = cls(uuid.uuid4().hex, {
+            'name': name,
+            'path': f"{UPLOAD_FOLDER}/{name}",
+            'size': size,
+            'expected_sha256': sha256.lower() if sha256 else None,
+            'sha256': None,
+            'status': STATUS_UPLOADING,
+            'job': None,
+            'created': time.time(),
+            'updated': time.time(),
+        })
+        sessions_dir().mkdir(parents=True, exist_ok=True)
+        session.part_path.touch()
+        session.save()
+        return session
+
+    @classmethod
+    def get(cls, upload_id) -> 'UploadSession | None':
+        if not ID_RE.match(str(upload_id)):
+            return None
+        try:
+            with open(sessions_dir() / f"{upload_id}.json") as f:
+                return cls(upload_id, json.load(f))
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def reload(self):
+        fresh = UploadSession.get(self.id)
+        if fresh is not None:
+            self.meta = fresh.meta
+        return self
+
+    def save(self):
+        self.meta['updated'] = time.time()
+        tmp = self.meta_path.with_name(f".{self.meta_path.name}.{os.getpid()}.{threading.get_ident()}")
+        with open(tmp, 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(tmp, self.meta_path)
+
+    def _lock(self):
+        return FileLock(self.part_path.with_suffix('.lock'))
+
+    # ---- writing ----
+
+    def _hasher(self, offset):
+        """A sha256 of the first `offset` bytes, carried over from the last write when possible."""
+        with _hashers_lock:
+            known = _hashers.pop(self.id, None)
+        if known is not None and known[0] == offset:
+            return known[1]
+        # Written by another process (or before a restart): hash what's there
+        hasher = hashlib.sha256()
+        with open(self.part_path, 'rb') as f:
+            remaining = offset
+            while remaining:
+                data = f.read(min(CHUNK_SIZE, remaining))
+                if not data:
+                    break
+                hasher.update(data)
+                remaining -= len(data)
+        return hasher
+
+    def append(self, chunks, offset=None) -> int:
+        """Writes chunks at the end of the upload; returns the new offset.
+
+        With an offset, it must match what has been received so far
+        (OffsetMismatch carries the actual one so the client can resume).
+        """
+        with self._lock():
+            self.reload()
+            if self.status != STATUS_UPLOADING:
+                raise UploadError(f"Upload is {self.status}.")
+            current = self.offset
+            if offset is not None and offset != current:
+                raise OffsetMismatch(current)
+            hasher = self._hasher(current)
+            written = current
+            try:
+                with open(self.part_path, 'ab') as f:
+                    for chunk in chunks:
+                        if self.size is not None and written + len(chunk) > self.size:
+                            raise UploadError("More data than the declared size.")
+                        f.write(chunk)
+                        hasher.update(chunk)
+                        written += len(chunk)
+            finally:
+                # If a write failed part way the file won't be `written` bytes long,
+                # and the next write rehashes it
+                self._remember_hash(written, hasher)
+                self.save()
+            return written
+
+    def _remember_hash(self, offset, hasher):
+        with _hashers_lock:
+            _hashers[self.id] = (offset, hasher)
+
+    def finish(self) -> Path:
+        """Moves the finished upload into place and indexes it. Returns the final path."""
+        with self._lock():
+            self.reload()
+            if self.status == STATUS_COMPLETE:
+                return self.path
+            if self.status != STATUS_UPLOADING:
+                raise UploadError(f"Upload is {self.status}.")
+            received = self.offset
+            if self.size is not None and received != self.size:
+                raise OffsetMismatch(received)
+            digest = self._hasher(received).hexdigest()
+            expected = self.meta.get('expected_sha256')
+            if expected and expected != digest:
+                self._discard()
+                raise UploadError("Checksum mismatch; the upload was discarded.")
+
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(self.part_path, self.path)
+            self.meta.update(status=STATUS_COMPLETE, sha256=digest, received=received)
+            self.save()
+        library.invalidate(UPLOAD_FOLDER)
+        library.index_file(self.path)
+        return self.path
+
+    def abort(self):
+        with self._lock():
+            self.reload()
+            if self.status == STATUS_UPLOADING:
+                self._discard()
+
+    def _discard(self):
+        with _hashers_lock:
+            _hashers.pop(self.id, None)
+        self.part_path.unlink(missing_ok=True)
+        self.meta['status'] = STATUS_ABORTED
+        self.save()
+
+    def as_dict(self) -> dict:
+        return {
+            'upload_id': self.id,
+            'name': self.meta['name'],
+            'path': self.meta['path'],
+            'size': self.size,
+            'offset': self.offset,
+            'status': self.status,
+            'sha256': self.meta.get('sha256'),
+            'task_id': self.meta.get('job'),
+        }
+
+
+def cleanup_stale(max_age=None) -> int:
+    """Deletes sessions (and their partial data) untouched for UPLOAD_SESSION_TTL seconds."""
+    max_age = max_age if max_age is not None else _setting('UPLOAD_SESSION_TTL', 24 * 3600)
+    root = sessions_dir()
+    if not root.is_dir():
+        return 0
+    removed = 0
+    cutoff = time.time() - max_age
+    for meta_path in root.glob("*.json"):
+        session = UploadSession.get(meta_path.stem)
+        if session is None or session.meta.get('updated', 0) >= cutoff:
+            continue
+        session.part_path.unlink(missing_ok=True)
+        session.part_path.with_suffix('.lock').unlink(missing_ok=True)
+        meta_path.unlink(missing_ok=True)
+        removed += 1
+    return removed
+
+
+# =========================
+# Streaming multipart uploads
+# =========================
+
+class StreamedUploadedFile(UploadedFile):
+    """A file part that was written straight into an upload session."""
+
+    def __init__(self, session, size, content_type=None, charset=None):
+        super().__init__(open(session.part_path, 'rb'), session.meta['name'], content_type, size, charset)
+        self.session = session
+
+    def finish(self) -> Path:
+        self.close()
+        return self.session.finish()
+
+
+class StreamingUploadHandler(FileUploadHandler):
+    """Writes the uploaded file into an UploadSession instead of spooling it."""
+
+    chunk_size = CHUNK_SIZE
+
+    def __init__(self, request=None, on_start=None):
+        super().__init__(request)
+        self.session = None
+        self.file = None
+        self.hasher = None
+        # Called with the session once the file part starts (e.g. to queue a job)
+        self.on_start = on_start
+
+    def new_file(self, field_name, file_name, content_type, content_length, charset=None, content_type_extra=None):
+        super().new_file(field_name, file_name, content_type, content_length, charset, content_type_extra)
+        try:
+            self.session = UploadSession.create(file_name, size=content_length)
+        except UploadError as e:
+            print(f"Upload rejected: {e}")
+            self.session = None
+        if self.session is not None:
+            # The session is new and only this request writes it, so the file is
+            # held open for the whole upload rather than going through append()
+            self.file = open(self.session.part_path, 'ab')
+            self.hasher = hashlib.sha256()
+            if self.on_start is not None:
+                self.on_start(self.session)
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.file is not None:
+            self.file.write(raw_data)
+            # Flushed so a job following the upload sees the data
+            self.file.flush()
+            self.hasher.update(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        if self.session is None:
+            return None
+        self.file.close()
+        self.session._remember_hash(file_size, self.hasher)
+        self.session.save()
+        return StreamedUploadedFile(self.session, file_size, self.content_type, self.charset)
+
+    def upload_interrupted(self):
+        if self.file is not None:
+            self.file.close()
+        if self.session is not None:
+            self.session.abort()
+
+
+# =========================
+# Following an upload
+# =========================
+
+class Follower:
+    """Iterates over an upload's bytes as they arrive; .error says why it stopped early."""
+
+    def __init__(self, session: UploadSession):
+        self.session = session
+        self.error = None
+
+    def __iter__(self):
+        try:
+            yield from follow(self.session)
+        except UploadError as e:
+            self.error = e
+            raise
+
+
+def follow(session: UploadSession, poll=0.25):
+    """Yields an upload's bytes as they arrive, until it completes.
+
+    Raises UploadError if it's aborted or nothing arrives for
+    UPLOAD_PIPE_STALL seconds.
+    """
+    stall = _setting('UPLOAD_PIPE_STALL', 30)
+    try:
+        f = open(session.part_path, 'rb')
+    except FileNotFoundError:
+        session.reload()
+        if session.status != STATUS_COMPLETE:
+            raise UploadError(f"Upload is {session.status}.")
+        f = open(session.path, 'rb')
+    # Once opened the file can be renamed into place without disturbing the reader
+    with f:
+        idle_since = time.monotonic()
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if data:
+                idle_since = time.monotonic()
+                yield data
+                continue
+            session.reload()
+            if session.status == STATUS_COMPLETE:
+                while True:
+                    data = f.read(CHUNK_SIZE)
+                    if not data:
+                        return
+                    yield data
+            if session.status == STATUS_ABORTED:
+                raise UploadError("Upload was aborted.")
+            if time.monotonic() - idle_since > stall:
+                raise UploadError("Upload stalled.")
+            time.sleep(poll)
+
+
+def wait_until_complete(session: UploadSession, heartbeat, poll=1.0) -> Path:
+    """Blocks while the upload is still arriving (calling heartbeat() meanwhile); returns its path.
+
+    Raises UploadError if it's aborted or its session is gone, and
+    UploadIncomplete if nothing arrives for UPLOAD_PIPE_STALL seconds, so an
+    abandoned upload doesn't hold a job worker.
+    """
+    stall = _setting('UPLOAD_PIPE_STALL', 30)
+    offset, idle_since = None, time.monotonic()
+    while True:
+        # A fresh read: reload() keeps the old meta once cleanup_stale has deleted it
+        current = UploadSession.get(session.id)
+        if current is None:
+            raise UploadError(f"Upload {session.id} is gone.")
+        if current.status == STATUS_COMPLETE:
+            return current.path
+        if current.status == STATUS_ABORTED:
+            raise UploadError(f"Upload {session.id} was aborted.")
+        now = time.monotonic()
+        if current.offset != offset:
+            offset, idle_since = current.offset, now
+        elif now - idle_since > stall:
+            raise UploadIncomplete(f"Upload {session.id} stalled; it will be processed once it finishes.")
+        heartbeat()
+        time.sleep(poll)
@@ -5,8 +5,17 @@ urlpatterns = [
     path('', views.index, name='index'),
     path('download/', views.download_video, name='download_video'),
     path('upload/', views.upload_video, name='upload_video'),
+    path('api/uploads/', views.uploads_api, name='uploads_api'),
+    path('api/uploads/<str:upload_id>/', views.upload_session, name='upload_session'),
     path('process/', views.process_video, name='process_video'),
+    path('api/pipeline/', views.pipeline_api, name='pipeline_api'),
     path('delete/', views.delete_video, name='delete_video'),
     path('add-command/', views.add_custom_command, name='add_custom_command'),
     path('get-progress/<str:task_id>/', views.get_progress, name='get_progress'),
+    path('api/library/', views.library_api, name='library_api'),
+    path('thumbs/<str:fingerprint>/<str:kind>', views.thumbnail, name='thumbnail'),
+    path('progress-stream/', views.progress_stream, name='progress_stream'),
+    path('jobs/<str:task_id>/cancel/', views.cancel_job, name='cancel_job'),
+    path('jobs/<str:task_id>/trace/', views.job_trace, name='job_trace'),
+    path('metrics', views.metrics_view, name='metrics'),
 ]
@@ -1,10 +1,14 @@
-import subprocess
 import re
 from pathlib import Path
 from django.conf import settings
 
 import json
 import os
+import time
+
+from .capabilities import get_capabilities
+from .registry import CommandRegistry, PLACEHOLDER_RE, INTERNAL_PARAMS
+from .library import command_defaults, index_file
 
 # =========================
 # FFmpeg Commands
@@ -18,6 +22,11 @@ BASE_FFMPEG_COMMANDS = {
             "-profile:v", "high", "-level", "4.1", "-c:a", "aac", "-b:a", "192k",
             "-movflags", "+faststart", "{output}"
         ],
+        # Sources already in this shape are stream-copied (core/stream_copy.py)
+        "target": {
+            "video": {"codec": "h264", "pix_fmt": "yuv420p", "profile": ["High", "Main", "Constrained Baseline"], "max_level": 41},
+            "audio": {"codec": "aac", "profile": "LC"}
+        },
         "description": "Visually lossless video + high quality AAC audio"
     },
     "trim_reencode": {
@@ -35,6 +44,16 @@ BASE_FFMPEG_COMMANDS = {
         ],
         "description": "Fast trim without quality loss (keyframe based)"
     },
+    "trim_smart": {
+        # Run by core/smart_trim.py; the command is the fallback for sources it can't handle
+        "engine": "smart_trim",
+        "command": [
+            "ffmpeg", "-y", "-ss", "{start}", "-to", "{end}", "-i", "{input}",
+            "-c:v", "libx264", "-preset", "fast", "-crf", "18", "-c:a", "aac",
+            "-b:a", "192k", "-movflags", "+faststart", "{output}"
+        ],
+        "description": "Frame-accurate trim that only re-encodes the edges (near copy speed)"
+    },
     "split_segments": {
         "command": [
             "ffmpeg", "-y", "-i", "{input}", "-map", "0", "-c", "copy",
@@ -61,12 +80,14 @@ BASE_FFMPEG_COMMANDS = {
         "command": [
             "ffmpeg", "-y", "-i", "{input}", "-vn", "-c:a", "pcm_s16le", "{output}"
         ],
+        "target": {"audio": {"codec": "pcm_s16le"}},
         "description": "Extract lossless WAV audio"
     },
     "extract_audio_aac": {
         "command": [
             "ffmpeg", "-y", "-i", "{input}", "-vn", "-c:a", "aac", "-b:a", "192k", "{output}"
         ],
+        "target": {"audio": {"codec": "aac"}},
         "description": "Extract high-quality AAC audio"
     },
     "extract_video_only": {
@@ -74,6 +95,7 @@ BASE_FFMPEG_COMMANDS = {
             "ffmpeg", "-y", "-i", "{input}", "-an", "-c:v", "libx264",
             "-preset", "fast", "-crf", "23", "{output}"
         ],
+        "target": {"video": {"codec": "h264", "pix_fmt": "yuv420p"}},
         "description": "Extract video stream only"
     },
     "resize_video": {
@@ -88,6 +110,11 @@ BASE_FFMPEG_COMMANDS = {
         "command": [
             "ffmpeg", "-y", "-i", "{input}", "-c", "copy", "{output}"
         ],
+        # Streams the output container can't hold are encoded instead of failing the remux
+        "target": {
+            "video": {"encode": ["-c:v", "libx264", "-preset", "medium", "-crf", "20", "-pix_fmt", "yuv420p"]},
+            "audio": {"encode": ["-c:a", "aac", "-b:a", "192k"]}
+        },
         "description": "Change container format without re-encoding"
     },
 
@@ -165,84 +192,50 @@ BASE_FFMPEG_COMMANDS = {
     }
 }
 
+def _custom_commands_path() -> Path:
+    return Path(getattr(settings, "CUSTOM_COMMANDS_FILE", settings.BASE_DIR / "custom_commands.json"))
+
+COMMAND_REGISTRY = CommandRegistry(BASE_FFMPEG_COMMANDS, _custom_commands_path())
+
 def load_custom_commands():
-    """Load custom commands from the JSON file."""
-    custom_file_path = Path("custom_commands.json")
-    if not custom_file_path.exists():
-        return {}
-    try:
-        with open(custom_file_path, 'r') as f:
-            return json.load(f)
-    except (json.JSONDecodeError, IOError):
-        return {}
+    """Load custom commands from the JSON file (re-read only when it changes)."""
+    return COMMAND_REGISTRY.load_custom()
 
 def has_nvidia_gpu() -> bool:
-    """Checks if NVIDIA GPU (CUDA) is available for FFmpeg."""
-    try:
-        # Check for hardware acceleration support
-        result = subprocess.run(["ffmpeg", "-v", "error", "-hwaccels"], capture_output=True, text=True)
-        if "cuda" not in result.stdout:
-             return False
-        
-        # Double check by listing encoders (sometimes hwaccel is listed but encoder lib missing)
-        result_enc = subprocess.run(["ffmpeg", "-v", "error", "-encoders"], capture_output=True, text=True)
-        return "nvenc" in result_enc.stdout
-    except FileNotFoundError:
-        return False
+    """Checks if NVIDIA GPU (CUDA) is available for FFmpeg (cached probe)."""
+    return get_capabilities().has_nvidia_gpu
 
 def get_all_commands():
     """Merge base and custom commands, filtering GPU ones if not available."""
-    commands = BASE_FFMPEG_COMMANDS.copy()
-    commands.update(load_custom_commands())
-    
-    # Filter GPU commands if no GPU
-    if not has_nvidia_gpu():
-        # Filter out keys containing 'gpu' or descriptions mentioning 'GPU'
-        # to avoid users crashing the app
-        filtered_commands = {}
-        for k, v in commands.items():
-            if "gpu" not in k.lower() and "cuda" not in str(v.get("command", "")).lower():
-                 filtered_commands[k] = v
-        return filtered_commands
-        
-    return commands
+    return COMMAND_REGISTRY.commands()
 
-def save_custom_command(key, command_list, description):
+def validate_command(command_list) -> list:
+    """Returns a list of encoders/filters/etc. the command needs but ffmpeg lacks."""
+    return get_capabilities().validate_command(command_list)
+
+def save_custom_command(key, command_list, description, target=None):
     """Save a new custom command to the JSON file."""
-    custom_commands = load_custom_commands()
-    custom_commands[key] = {
-        "command": command_list,
-        "description": description
-    }
-    with open("custom_commands.json", 'w') as f:
-        json.dump(custom_commands, f, indent=4)
+    COMMAND_REGISTRY.save_custom(key, command_list, description, target)
 
 def extract_parameters(command_list):
     """Extracts required parameters e.g. {width} from a command list."""
     params = set()
     for arg in command_list:
-        # Find all {var} patterns
-        matches = re.findall(r"\{([a-zA-Z0-9_]+)\}", arg)
-        for m in matches:
-            if m not in ['input', 'output', 'output_pattern']: # Ignore standard internal vars
+        for m in PLACEHOLDER_RE.findall(arg):
+            if m not in INTERNAL_PARAMS: # Ignore standard internal vars
                 params.add(m)
     return list(params)
 
 def get_command_params_map():
     """Returns a map of command_key -> list of params."""
-    all_cmds = get_all_commands()
-    mapping = {}
-    for key, val in all_cmds.items():
-        mapping[key] = extract_parameters(val['command'])
-    return mapping
+    return COMMAND_REGISTRY.params_map()
 
 def build_command(profile: str, **kwargs) -> list:
     """Build an FFmpeg command from a profile."""
-    all_commands = get_all_commands()
-    if profile not in all_commands:
+    compiled = COMMAND_REGISTRY.get(profile)
+    if compiled is None:
         raise ValueError(f"Unknown profile: {profile}")
-    template = all_commands[profile]["command"]
-    return [arg.format(**kwargs) for arg in template]
+    return compiled.build(**kwargs)
 
 
 # =========================
@@ -250,16 +243,9 @@ def build_command(profile: str, **kwargs) -> list:
 # =========================
 
 def has_video_stream(file_path: Path) -> bool:
-    """Checks if a file has a video stream using ffprobe."""
-    command = [
-        "ffprobe", "-v", "error", "-select_streams", "v:0",
-        "-show_entries", "stream=codec_type", "-of", "csv=p=0", str(file_path)
-    ]
-    try:
-        result = subprocess.run(command, capture_output=True, text=True, check=True)
-        return result.stdout.strip() == "video"
-    except (subprocess.CalledProcessError, FileNotFoundError):
-        return False
+    """Checks if a file has a video stream (ffprobe result cached in the library index)."""
+    entry = index_file(file_path)
+    return bool(entry and entry.has_video)
 
 
 # =========================
@@ -268,13 +254,48 @@ def has_video_stream(file_path: Path) -> bool:
 
 import yt_dlp
 from .globals import PROGRESS_CACHE
+from . import metrics
 
-def download_youtube_video(youtube_url: str, task_id: str = None) -> str | None:
-    """Downloads a YouTube video to MEDIA_ROOT/yt_videos using yt_dlp library."""
+# Fields of yt-dlp's info dict kept with a download
+DOWNLOAD_INFO_FIELDS = (
+    'id', 'extractor_key', 'title', 'uploader', 'channel', 'upload_date', 'duration', 'webpage_url',
+    'format_id', 'ext', 'width', 'height', 'fps', 'vcodec', 'acodec', 'filesize_approx',
+)
+
+def download_youtube_video(youtube_url: str, task_id: str = None, on_progress=None, trace=None) -> dict | None:
+    """Downloads a YouTube video to MEDIA_ROOT/yt_videos using yt_dlp library.
+
+    Returns {'path': the final (merged) file, 'info': metadata from yt-dlp's
+    info dict}, or None if it failed. on_progress(d) is called with every
+    yt-dlp progress update; raising yt_dlp.utils.DownloadCancelled from it
+    stops the download (the .part files are kept, so it can be resumed).
+    trace (a tracing.Trace) gets the extract, download and post-processing phases.
+    """
     yt_video_folder = settings.MEDIA_ROOT / "yt_videos"
     yt_video_folder.mkdir(parents=True, exist_ok=True)
 
+    # file -> bytes seen so far, to turn yt-dlp's running totals into increments.
+    # The first report only sets the mark, so a resumed .part isn't counted again.
+    counted = {}
+    if trace:
+        trace.phase('extract')
+
     def progress_hook(d):
+        if on_progress:
+            on_progress(d)
+        if d['status'] == 'downloading':
+            extractor = (d.get('info_dict') or {}).get('extractor_key', '')
+            if trace and d.get('filename') not in counted:
+                # One phase per format file (video, then audio)
+                trace.phase('download', format=(d.get('info_dict') or {}).get('format_id'),
+                            file=Path(d.get('filename') or '').name)
+            downloaded = d.get('downloaded_bytes') or 0
+            delta = downloaded - counted.setdefault(d.get('filename'), downloaded)
+            if delta > 0:
+                counted[d.get('filename')] = downloaded
+                metrics.DOWNLOAD_BYTES.inc(delta, extractor=extractor)
+            if d.get('speed'):
+                metrics.DOWNLOAD_SPEED.set(d['speed'], extractor=extractor)
         if not task_id:
             return
             
@@ -290,31 +311,53 @@ def download_youtube_video(youtube_url: str, task_id: str = None) -> str | None:
             except:
                 pass
         elif d['status'] == 'finished':
+            # One format is done; with bestvideo+bestaudio the other one (and the merge) may follow
             PROGRESS_CACHE[task_id] = {
-                'status': 'complete',
+                'status': 'processing',
                 'percent': 100,
                 'eta': '0s',
-                'msg': 'Download Complete! Processing...'
+                'msg': 'Download finished, merging...'
             }
 
+    def postprocessor_hook(d):
+        if trace and d['status'] == 'started':
+            trace.phase('postprocess', postprocessor=d.get('postprocessor'))
+
+    # yt-dlp calls post_hooks with the final path, after merging and any post-processing
+    final_paths = []
+
     ydl_opts = {
         'format': 'bestvideo+bestaudio/best',
         'outtmpl': f"{yt_video_folder}/%(title)s.%(ext)s",
         'restrictfilenames': True,
         'progress_hooks': [progress_hook],
+        'postprocessor_hooks': [postprocessor_hook],
+        'post_hooks': [final_paths.append],
         'noplaylist': True,
+        # DASH/HLS fragments are fetched in parallel; .part files left by an
+        # interrupted download are continued rather than started over
+        'concurrent_fragment_downloads': getattr(settings, 'DOWNLOAD_FRAGMENTS', 4),
+        'continuedl': True,
+        'retries': 10,
+        'fragment_retries': 10,
     }
 
     try:
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([youtube_url])
-        
-        # Determine filename (simplistic approach compatible with previous logic)
-        files = list(yt_video_folder.glob("*"))
-        if not files:
+            info = ydl.extract_info(youtube_url, download=True)
+        if info and info.get('_type') == 'playlist':
+            info = next((entry for entry in info.get('entries') or [] if entry), None)
+        if not info or not final_paths or not Path(final_paths[-1]).is_file():
             return None
-        return "Success" # Return string to indicate success
+
+        # Give the file the name processing would rename it to, so the path stays valid
+        if trace:
+            trace.phase('clean_filename')
+        path = clean_filename(Path(final_paths[-1]))
+        return {'path': path, 'info': {field: info.get(field) for field in DOWNLOAD_INFO_FIELDS}}
         
+    except yt_dlp.utils.DownloadCancelled:
+        raise
     except Exception as e:
         print(f"Error: {e}")
         if task_id:
@@ -324,13 +367,46 @@ def download_youtube_video(youtube_url: str, task_id: str = None) -> str | None:
             }
         return None
 
+def output_extension(cmd_key: str) -> str:
+    """Extension of the file a profile writes."""
+    ext = ".mp4"
+    if "audio_wav" in cmd_key: ext = ".wav"
+    elif "audio_aac" in cmd_key: ext = ".aac"
+    return ext
+
+def command_kwargs(cmd_key: str, input_value, stem: str, source=None, values=None, timestamp=None):
+    """Placeholder values for running a profile: (kwargs, output path, job payload).
+
+    The output goes to MEDIA_ROOT/download as <stem>_<profile>_<timestamp><ext>.
+    values holds the requester's parameters; ones left empty fall back to the
+    source's (library.command_defaults).
+    """
+    compiled = COMMAND_REGISTRY.get(cmd_key)
+    output_folder = settings.MEDIA_ROOT / "download"
+    output_folder.mkdir(parents=True, exist_ok=True)
+    timestamp = timestamp or int(time.time())
+    output_path = output_folder / f"{stem}_{cmd_key}_{timestamp}{output_extension(cmd_key)}"
+
+    defaults = command_defaults(source)
+    values = values or {}
+    kwargs = {'input': str(input_value), 'output': str(output_path)}
+    for param in compiled.parameters if compiled else []:
+        kwargs[param] = values.get(param) or defaults.get(param, "")
+
+    payload = {}
+    if cmd_key == "split_segments":
+        kwargs["output_pattern"] = str(output_folder / f"{stem}_{timestamp}_%03d.mp4")
+        payload["outputs"] = [kwargs["output_pattern"]]
+    return kwargs, output_path, payload
+
+def clean_name(file_name: str) -> str:
+    """The name clean_filename() gives a file."""
+    path = Path(file_name)
+    return re.sub(r"[_\[\]\(\)]", "", path.stem).replace(" ", "_") + path.suffix
+
 def clean_filename(file_path: Path) -> Path:
     """Cleans a filename and renames the file."""
-    file_stem = file_path.stem
-    file_ext = file_path.suffix
-    
-    clean_name = re.sub(r"[_\[\]\(\)]", "", file_stem).replace(" ", "_")
-    new_path = file_path.parent / f"{clean_name}{file_ext}"
+    new_path = file_path.parent / clean_name(file_path.name)
     
     if new_path != file_path:
         file_path.rename(new_path)
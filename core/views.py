@@ -6,43 +6,56 @@ import shutil
 import time
 
 from .forms import YouTubeDownloadForm, VideoUploadForm, ProcessVideoForm, AddCommandForm
-from .utils import download_youtube_video, build_command, clean_filename, has_video_stream, get_all_commands, save_custom_command
-import subprocess
+from .utils import build_command, clean_filename, command_kwargs, output_extension, has_video_stream, get_all_commands, save_custom_command, validate_command, COMMAND_REGISTRY
+from .models import MediaFile
+from . import (
+    library, media, metrics, multi_output, output_cache, pipeline, storage, stream_copy, thumbnails, tracing, uploads,
+)
 import shlex
 
-def get_media_files():
-    """Helper to list files in media directories."""
-    files = []
-    
-    # helper to add files
-    def add_files(folder_name, source_type):
-        path = settings.MEDIA_ROOT / folder_name
-        path.mkdir(parents=True, exist_ok=True)
-        valid_extensions = {'.mp4', '.mkv', '.avi', '.webm', '.mov', '.flv', '.wav', '.mp3', '.aac', '.m4a'}
-        for f in path.iterdir():
-            if f.is_file() and f.suffix.lower() in valid_extensions:
-                files.append({
-                    'name': f.name,
-                    'path': str(f.relative_to(settings.MEDIA_ROOT)).replace('\\', '/'), # relative path for display/selection
-                    'full_path': str(f),
-                    'source': source_type,
-                    'size': f"{f.stat().st_size / (1024*1024):.2f} MB"
-                })
-    
-    add_files("yt_videos", "YouTube")
-    add_files("local_videos", "Local")
-    add_files("download", "Processed")
-    
-    return files
+def media_file_dict(entry):
+    """JSON-friendly view of a library index entry."""
+    return {
+        'name': entry.name,
+        'path': entry.path, # relative path for display/selection
+        'source': entry.source,
+        'extension': entry.extension,
+        'size_bytes': entry.size,
+        'size': f"{entry.size / (1024*1024):.2f} MB",
+        'mtime': entry.mtime,
+        'duration': entry.duration,
+        'resolution': entry.resolution,
+        'video_codec': entry.video_codec,
+        'audio_codec': entry.audio_codec,
+        'thumbnail': f"/thumbs/{entry.fingerprint}/poster.jpg" if entry.has_video and entry.fingerprint else None,
+        'sprite': f"/thumbs/{entry.fingerprint}/sprite.jpg" if entry.has_video and entry.duration and entry.fingerprint else None,
+        'sprite_grid': [thumbnails.SPRITE_COLUMNS, thumbnails.SPRITE_ROWS],
+    }
 
+# Library API sort orders: ?sort=<key> -> model field ('-' = descending)
+LIBRARY_SORTS = {
+    'name': 'name', '-name': '-name',
+    'size': 'size', '-size': '-size',
+    'newest': '-mtime', 'oldest': 'mtime',
+    'duration': 'duration', '-duration': '-duration',
+}
+LIBRARY_PAGE_SIZE = 50
+LIBRARY_MAX_PAGE_SIZE = 200
+
+@metrics.timed('index')
 def index(request):
-    files = get_media_files()
-    
+    # The media library is loaded lazily from library_api, so the page cost
+    # doesn't grow with the number of files.
     yt_form = YouTubeDownloadForm()
     upload_form = VideoUploadForm()
     process_form = ProcessVideoForm()
     
     add_command_form = AddCommandForm()
+
+    # Jobs and downloads queued or interrupted before a restart carry on once the app is used
+    jobs.ensure_worker_pool()
+    downloads.ensure_manager()
+    storage.ensure_janitor()
     
     all_commands = get_all_commands()
 
@@ -60,7 +73,6 @@ def index(request):
     command_params = get_command_params_map()
 
     context = {
-        'files': files,
         'yt_form': yt_form,
         'upload_form': upload_form,
         'process_form': process_form,
@@ -68,165 +80,517 @@ def index(request):
         'ffmpeg_commands': all_commands, # Keep for JS lookup if needed
         'operations_list': operations_list,
         'command_params': command_params,
+        # Progress can be pushed over SSE only when served by the ASGI app
+        'use_sse': isinstance(request, ASGIRequest),
     }
     return render(request, 'core/index.html', context)
 
-from django.http import JsonResponse
-import threading
+from django.http import JsonResponse, StreamingHttpResponse, FileResponse, Http404, HttpResponse, QueryDict
+from django.middleware.csrf import CsrfViewMiddleware
+from django.utils.datastructures import MultiValueDict
+from django.utils.crypto import constant_time_compare
+from django.db import transaction
+from django.db.models import Count, Max, Q
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.views.decorators.http import condition
+from django.core.handlers.asgi import ASGIRequest
+from asgiref.sync import sync_to_async
+import asyncio
+import base64
+import binascii
+import hashlib
+import json
+import re
 import uuid
+from django.core.exceptions import ValidationError
 from .globals import PROGRESS_CACHE
+from .models import Download, Job
+from . import downloads, jobs
+from .jobs import enqueue
 
+# Server-Sent Events progress stream
+SSE_INTERVAL = 0.5    # seconds between checks for changes
+SSE_KEEPALIVE = 15    # seconds of silence before a keepalive comment
+SSE_MAX_TASKS = 50
+SSE_UNKNOWN_POLLS = 20  # checks (10s) before an id that is no job or download is dropped
+SSE_MAX_LIFETIME = 3600  # seconds before the stream ends; EventSource reconnects by itself
+
+def task_progress(task_id):
+    """Progress dict for a download task or job."""
+    progress = PROGRESS_CACHE.get(task_id)
+    if progress is None:
+        # Evicted from the progress store: fall back to the job's or download's row
+        try:
+            job = Job.objects.filter(pk=task_id).first()
+            download = None if job else Download.objects.filter(pk=task_id).first()
+        except (ValidationError, ValueError):
+            job = download = None
+        if job is not None:
+            progress = jobs.job_progress(job)
+        elif download is not None:
+            progress = downloads.download_progress(download)
+        else:
+            progress = {'status': 'pending'}
+    return progress
+
+@metrics.timed('get_progress')
 def get_progress(request, task_id):
     """Returns the progress of a task."""
-    progress = PROGRESS_CACHE.get(task_id, {'status': 'pending'})
-    return JsonResponse(progress)
+    return JsonResponse(task_progress(task_id))
 
-def run_download_task(url, task_id):
-    """Wrapper to run download in thread."""
-    try:
-        msg = download_youtube_video(url, task_id)
-        if msg:
-            PROGRESS_CACHE[task_id] = {
-                'status': 'complete',
-                'percent': 100, 
-                'msg': 'Download Complete!'
-            }
-        else:
-             PROGRESS_CACHE[task_id] = {
-                'status': 'error',
-                'msg': 'Download failed (Check logs)'
-            }
-    except Exception as e:
-        PROGRESS_CACHE[task_id] = {
-            'status': 'error',
-            'msg': str(e)
-        }
+def _read_progress_many(task_ids):
+    return {task_id: task_progress(task_id) for task_id in task_ids}
+
+async def progress_stream(request):
+    """Server-Sent Events: pushes progress for ?tasks=a,b,c whenever it changes.
+
+    One connection multiplexes every task the client is watching. Needs an
+    ASGI server (see video_project/asgi.py); under WSGI the stream is buffered.
+    """
+    task_ids = [t for t in request.GET.get('tasks', '').split(',') if t][:SSE_MAX_TASKS]
+
+    async def events():
+        last_sent = {}
+        pending = set(task_ids)
+        unknown = {}  # task id -> consecutive checks it was found nowhere
+        started = last_write = time.monotonic()
+        yield "retry: 3000\n\n"
+        while pending:
+            snapshot = await sync_to_async(_read_progress_many)(sorted(pending))
+            for task_id, progress in snapshot.items():
+                if progress.get('status') == 'pending':
+                    unknown[task_id] = unknown.get(task_id, 0) + 1
+                    if unknown[task_id] >= SSE_UNKNOWN_POLLS:
+                        # Evicted from the progress store with no row behind it, or never existed
+                        progress = {'status': 'error', 'msg': "Unknown task."}
+                else:
+                    unknown.pop(task_id, None)
+                encoded = json.dumps(progress, sort_keys=True)
+                if last_sent.get(task_id) != encoded:
+                    last_sent[task_id] = encoded
+                    last_write = time.monotonic()
+                    yield f"event: progress\ndata: {json.dumps({'task_id': task_id, **progress})}\n\n"
+                if progress.get('status') in ('complete', 'error', 'cancelled'):
+                    pending.discard(task_id)
+            if not pending:
+                break
+            if time.monotonic() - started > SSE_MAX_LIFETIME:
+                return  # Without 'done': the client reconnects with the tasks it still watches
+            if time.monotonic() - last_write > SSE_KEEPALIVE:
+                last_write = time.monotonic()
+                yield ": keepalive\n\n"
+            await asyncio.sleep(SSE_INTERVAL)
+        yield "event: done\ndata: {}\n\n"
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Don't let nginx buffer the stream
+    return response
 
 def download_video(request):
     if request.method == 'POST':
         form = YouTubeDownloadForm(request.POST)
         if form.is_valid():
-            url = form.cleaned_data['url']
-            
-            # Generate Task ID
-            task_id = str(uuid.uuid4())
-            PROGRESS_CACHE[task_id] = {
-                'status': 'starting',
-                'percent': 0,
-                'msg': 'Initializing download...'
-            }
-            
-            # Start Thread
-            thread = threading.Thread(target=run_download_task, args=(url, task_id))
-            thread.daemon = True
-            thread.start()
-            
-            return JsonResponse({'task_id': task_id})
+            # Optional profile to queue as soon as the download is complete
+            process = None
+            cmd_key = request.POST.get('process')
+            if cmd_key:
+                compiled = COMMAND_REGISTRY.get(cmd_key)
+                if compiled is None:
+                    return JsonResponse({'status': 'error', 'msg': f"Unknown operation: {cmd_key}"}, status=400)
+                params = {p: request.POST[p] for p in compiled.parameters if request.POST.get(p)}
+                process = {'op': cmd_key, 'params': params}
+
+            # Queued on the download manager; a URL that is already downloading
+            # returns the existing task, one that was downloaded before is served from the archive
+            return JsonResponse(downloads.submit(form.cleaned_data['url'], process))
         else:
              return JsonResponse({'status': 'error', 'msg': 'Invalid URL'}, status=400)
     return redirect('index')
 
+@csrf_exempt
 def upload_video(request):
+    # The upload handler has to be swapped in before anything reads the body,
+    # which the CSRF middleware would do. A token sent as X-CSRFToken is checked
+    # here first; one in the form body only once the body is in (_upload_video).
+    process = request.GET.get('process')
+    if process and (COMMAND_REGISTRY.get(process) is None or COMMAND_REGISTRY.get(process).engine != 'ffmpeg'):
+        return JsonResponse({'status': 'error', 'msg': f"{process} can't run on an upload."}, status=400)
+    if request.method == 'POST' and settings.CSRF_HEADER_NAME in request.META:
+        rejected = _check_csrf_header(request)
+        if rejected is not None:
+            return rejected
+    sessions, jobs_started = [], []
+
+    def on_start(session):
+        sessions.append(session)
+        # Only a request already known to be genuine starts processing while the file arrives
+        if process and getattr(request, 'csrf_processing_done', False):
+            jobs_started.append(_queue_upload_job(session, process, request.GET))
+
+    request.upload_handlers = [uploads.StreamingUploadHandler(request, on_start=on_start)]
+    response = _upload_video(request, process, jobs_started)
+    if not getattr(request, 'csrf_processing_done', False):
+        # Rejected by the CSRF check: drop what the body wrote
+        for session in sessions:
+            session.abort()
+    return response
+
+def _check_csrf_header(request):
+    """The CSRF middleware's verdict on the X-CSRFToken header alone, without reading the body."""
+    # An empty POST makes the middleware fall back to the header
+    request._post, request._files = QueryDict(), MultiValueDict()
+    try:
+        return CsrfViewMiddleware(lambda r: None).process_view(request, None, (), {})
+    finally:
+        del request._post, request._files
+
+@csrf_protect
+def _upload_video(request, process, jobs_started):
+    wants_json = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
     if request.method == 'POST':
         form = VideoUploadForm(request.POST, request.FILES)
         if form.is_valid():
             f = request.FILES['file']
-            save_path = settings.MEDIA_ROOT / 'local_videos'
-            save_path.mkdir(parents=True, exist_ok=True)
-            
-            file_path = save_path / f.name
-            with open(file_path, 'wb+') as destination:
-                for chunk in f.chunks():
-                    destination.write(chunk)
-            
-            messages.success(request, f"Uploaded {f.name} successfully.")
+            if process and not jobs_started:
+                # The token was in the body, so the job waited for the check
+                jobs_started.append(_queue_upload_job(f.session, process, request.GET))
+            try:
+                file_path = f.finish()
+            except uploads.UploadError as e:
+                if wants_json:
+                    return JsonResponse({'status': 'error', 'msg': str(e)}, status=400)
+                messages.error(request, f"Upload failed: {e}")
+                return redirect('index')
+            if wants_json:
+                response = {'path': library.relative_path(file_path), 'sha256': f.session.meta['sha256']}
+                if jobs_started:
+                    response['task_id'] = str(jobs_started[0].id)
+                return JsonResponse(response)
+            messages.success(request, f"Uploaded {file_path.name} successfully.")
         else:
+            for f in request.FILES.values():
+                if isinstance(f, uploads.StreamedUploadedFile):
+                    f.close()
+                    f.session.abort()
+            if wants_json:
+                return JsonResponse({'status': 'error', 'msg': "Upload failed."}, status=400)
             messages.error(request, "Upload failed.")
     return redirect('index')
 
+def _queue_upload_job(session, cmd_key, params):
+    """Queues cmd_key on an upload that's still arriving; ffmpeg reads it from stdin."""
+    compiled = COMMAND_REGISTRY.get(cmd_key)
+    kwargs, output_path, payload = command_kwargs(cmd_key, uploads.PIPE_INPUT, session.path.stem, None, params)
+    payload['upload'] = session.id
+
+    job = enqueue(compiled.build(**kwargs), profile=cmd_key, input_path=session.path, output_path=output_path,
+                  kind='upload_stream', priority=uploads.JOB_PRIORITY, payload=payload)
+    session.meta['job'] = str(job.id)
+    session.save()
+    return job
+
+def uploads_api(request):
+    """Starts a resumable upload: POST {"name", "size", "sha256"?, "process"?, "params"?}."""
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'msg': "POST to start an upload."}, status=405)
+    try:
+        data = json.loads(request.body or b'{}')
+    except json.JSONDecodeError:
+        return JsonResponse({'status': 'error', 'msg': "Invalid JSON."}, status=400)
+    if not isinstance(data.get('size'), int):
+        return JsonResponse({'status': 'error', 'msg': "size is required."}, status=400)
+    process = data.get('process')
+    if process and (COMMAND_REGISTRY.get(process) is None or COMMAND_REGISTRY.get(process).engine != 'ffmpeg'):
+        return JsonResponse({'status': 'error', 'msg': f"{process} can't run on an upload."}, status=400)
+    try:
+        session = uploads.UploadSession.create(data.get('name'), size=data['size'], sha256=data.get('sha256'))
+    except uploads.UploadError as e:
+        return JsonResponse({'status': 'error', 'msg': str(e)}, status=400)
+    if process:
+        _queue_upload_job(session, process, {k: str(v) for k, v in (data.get('params') or {}).items()})
+    return JsonResponse({**session.as_dict(), 'chunk_size': uploads.CLIENT_CHUNK_SIZE}, status=201)
+
+def upload_session(request, upload_id):
+    """GET: where to resume. PATCH (Upload-Offset header, raw body): append a chunk. DELETE: abort."""
+    session = uploads.UploadSession.get(upload_id)
+    if session is None:
+        raise Http404("No such upload")
+    if request.method == 'DELETE':
+        session.abort()
+        return JsonResponse(session.reload().as_dict())
+    if request.method != 'PATCH':
+        return JsonResponse(session.as_dict())
+
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+    except ValueError:
+        return JsonResponse({'status': 'error', 'msg': "Upload-Offset header is required."}, status=400)
+
+    def body():
+        # Read in pieces so a chunk is never held in memory whole
+        while True:
+            data = request.read(uploads.CHUNK_SIZE)
+            if not data:
+                return
+            yield data
+
+    try:
+        received = session.append(body(), offset)
+        if received == session.size:
+            session.finish()
+            # A job that gave up waiting on a stalled upload runs from the finished file
+            if session.reload().meta.get('job'):
+                jobs.requeue(session.meta['job'])
+    except uploads.OffsetMismatch as e:
+        return JsonResponse({**session.as_dict(), 'status': 'error', 'msg': str(e), 'offset': e.offset}, status=409)
+    except uploads.UploadError as e:
+        return JsonResponse({**session.reload().as_dict(), 'status': 'error', 'msg': str(e)}, status=400)
+    return JsonResponse(session.reload().as_dict())
+
+def _command_kwargs(cmd_key, input_path, source, form, request, timestamp):
+    """Placeholder values for one profile: (kwargs, output path, job payload)."""
+    compiled = COMMAND_REGISTRY.get(cmd_key)
+    # Standard form fields first (cleaned data), then raw POST data (dynamic fields)
+    values = {}
+    for param in compiled.parameters if compiled else []:
+        value = form.cleaned_data.get(param)
+        values[param] = request.POST.get(param) if value is None else value
+    return command_kwargs(cmd_key, input_path, input_path.stem, source, values, timestamp)
+
+def _process_multi(cmd_keys, input_path, source, form, request, timestamp, trace):
+    """Queues several profiles on one input as a single-decode multi-output job."""
+    trace.phase('plan', profiles=len(cmd_keys))
+    specs, outputs, streams = [], [], {}
+    for cmd_key in cmd_keys:
+        compiled = COMMAND_REGISTRY.get(cmd_key)
+        if compiled is None:
+            return JsonResponse({'status': 'error', 'msg': f"Unknown operation: {cmd_key}"}, status=400)
+        if compiled.engine != 'ffmpeg':
+            return JsonResponse({'status': 'error', 'msg': f"{cmd_key} can't be combined with other operations."}, status=400)
+        kwargs, output_path, payload = _command_kwargs(cmd_key, input_path, source, form, request, timestamp)
+        problem = library.check_command(compiled, source, kwargs)
+        if problem:
+            return JsonResponse({'status': 'error', 'msg': f"{cmd_key}: {problem}"}, status=400)
+        try:
+            command, decision = stream_copy.plan(compiled, compiled.build(**kwargs), source)
+            if decision:
+                streams[cmd_key] = decision
+            spec = multi_output.parse_output(
+                cmd_key, command,
+                has_video=source.has_video if source and source.probed else True,
+                has_audio=source.has_audio if source and source.probed else True,
+            )
+        except (KeyError, IndexError, ValueError) as e:
+            return JsonResponse({'status': 'error', 'msg': f"Can't combine {cmd_key}: {e}"}, status=400)
+        specs.append(spec)
+        outputs.extend(payload.get('outputs') or [str(output_path)])
+
+    command = multi_output.build(input_path, specs)
+    trace.phase('enqueue')
+    payload = {'profiles': cmd_keys, 'outputs': outputs, 'stream_copy': streams}
+    if request.POST.get('benchmark'):
+        payload['benchmark'] = True
+    job = enqueue(command, profile="+".join(cmd_keys), input_path=input_path, output_path=specs[0].path,
+                  kind='multi', payload=payload)
+    trace.save(job.id)
+    return JsonResponse({'task_id': str(job.id), 'output': Path(specs[0].path).name, 'outputs': [Path(o).name for o in outputs]})
+
+@metrics.timed('process_video')
 def process_video(request):
     if request.method == 'POST':
+        # Request phases; saved under the job id, where the job's own phases follow
+        trace = tracing.Trace()
+        trace.phase('validate')
         file_path_rel = request.POST.get('selected_file')
         if not file_path_rel:
-            messages.error(request, "No file selected.")
-            return redirect('index')
+            return JsonResponse({'status': 'error', 'msg': "No file selected."}, status=400)
 
         input_path = (settings.MEDIA_ROOT / file_path_rel).resolve()
         
         # Security Check: Prevent Directory Traversal
         if not str(input_path).startswith(str(settings.MEDIA_ROOT.resolve())):
-             messages.error(request, "Invalid file path.")
-             return redirect('index')
+             return JsonResponse({'status': 'error', 'msg': "Invalid file path."}, status=400)
 
         if not input_path.exists():
-             messages.error(request, "File not found.")
-             return redirect('index')
+             return JsonResponse({'status': 'error', 'msg': "File not found."}, status=404)
 
         form = ProcessVideoForm(request.POST)
         if form.is_valid():
             cmd_key = form.cleaned_data['command']
             
-            # Prepare output path
-            output_folder = settings.MEDIA_ROOT / "download"
-            output_folder.mkdir(parents=True, exist_ok=True)
-            
             # Clean filename (renames file on disk if needed)
+            trace.phase('clean_filename')
             input_path = clean_filename(input_path)
-            clean_name = input_path.stem
+            trace.phase('probe')
+            source = library.index_file(input_path)
 
-            # Just use stem + command suffix + proper extension
-            # Note: We need to know target extension. 
-            # ffmpeg commands in utils rely on {output} having extension.
-            # Most output mp4. extract_audio uses wav/aac.
-            
-            ext = ".mp4"
-            if "audio_wav" in cmd_key: ext = ".wav"
-            elif "audio_aac" in cmd_key: ext = ".aac"
-            
             timestamp = int(time.time())
-            output_filename = f"{clean_name}_{cmd_key}_{timestamp}{ext}"
-            output_path = output_folder / output_filename
-            
-            # Dynamic Kwargs: Fetch ANY param required by the command
-            from .utils import get_command_params_map
-            cmd_map = get_command_params_map()
-            required_params = cmd_map.get(cmd_key, [])
-            
-            kwargs = {
-                "input": str(input_path),
-                "output": str(output_path),
-            }
-            
-            # Populate from form (standard fields) or raw POST (dynamic fields)
-            for param in required_params:
-                # Try standard form field first (cleaned data)
-                val = form.cleaned_data.get(param)
-                
-                # If None/Empty, try raw POST data (for dynamic fields)
-                if val is None:
-                    val = request.POST.get(param)
-                
-                # Default fallbacks if still empty (Prevents None error)
-                if not val:
-                    defaults = {'width': 1920, 'height': 1080, 'factors': 2.0}
-                    val = defaults.get(param, "")
-                
-                kwargs[param] = val
-            
-            # Special case for split_segments output_pattern
-            if cmd_key == "split_segments":
-                 kwargs["output_pattern"] = str(output_folder / f"{clean_name}_{timestamp}_%03d.mp4")
+            extra_keys = list(dict.fromkeys(k for k in request.POST.getlist('extra_commands') if k != cmd_key))
+            if extra_keys:
+                return _process_multi([cmd_key, *extra_keys], input_path, source, form, request, timestamp, trace)
+
+            trace.phase('plan')
+            kwargs, output_path, payload = _command_kwargs(cmd_key, input_path, source, form, request, timestamp)
+            output_filename = output_path.name
 
+            compiled = COMMAND_REGISTRY.get(cmd_key)
+            problem = library.check_command(compiled, source, kwargs)
+            if problem:
+                return JsonResponse({'status': 'error', 'msg': problem}, status=400)
+
+            # Same input + same resolved command: reuse the output or the job already making it
+            trace.phase('output_cache')
+            fingerprint = source.fingerprint if source else ''
+            try:
+                key = output_cache.key_for(fingerprint, compiled, kwargs)
+            except (KeyError, IndexError, ValueError):
+                key = None
+            cached = output_cache.lookup(key)
+            if cached is not None:
+                return JsonResponse(_cached_output_response(cached))
+
+            trace.phase('build_command')
             try:
                 command = build_command(cmd_key, **kwargs)
-                # Run command
-                subprocess.run(command, check=True)
-                messages.success(request, f"Processed successfully! Saved to {output_filename}")
             except Exception as e:
-                messages.error(request, f"Processing failed: {str(e)}")
+                return JsonResponse({'status': 'error', 'msg': f"Processing failed: {str(e)}"}, status=400)
+
+            # Streams the source already has in the profile's target shape are copied
+            trace.phase('stream_copy_plan')
+            command, streams = stream_copy.plan(compiled, command, source)
+            if streams:
+                payload['stream_copy'] = streams
+            # Opt-in ffmpeg profiling (-benchmark) for this job's trace
+            if request.POST.get('benchmark'):
+                payload['benchmark'] = True
+
+            # Run in the background job queue instead of inside the request
+            trace.phase('enqueue')
+            job = None
+            for _attempt in range(ENQUEUE_CACHE_ATTEMPTS):
+                job = _enqueue_cached(key, fingerprint, command, profile=cmd_key, input_path=input_path,
+                                      output_path=output_path, kind=compiled.engine, payload=payload)
+                if job is not None:
+                    break
+                # An identical request registered first: share theirs, or try again if it's already gone
+                cached = output_cache.lookup(key)
+                if cached is not None:
+                    return JsonResponse(_cached_output_response(cached))
+            if job is None:
+                job = enqueue(command, profile=cmd_key, input_path=input_path, output_path=output_path,
+                              kind=compiled.engine, payload=payload)
+            trace.save(job.id)
+            response = {'task_id': str(job.id), 'output': output_filename}
+            if streams:
+                response['stream_copy'] = streams
+            return JsonResponse(response)
         else:
-            messages.error(request, "Invalid form data.")
-            
+            return JsonResponse({'status': 'error', 'msg': "Invalid form data."}, status=400)
+
+    return redirect('index')
+
+# Times a request retries enqueueing under a cache key that identical requests keep winning
+ENQUEUE_CACHE_ATTEMPTS = 3
+
+def _enqueue_cached(key, fingerprint, command, **fields):
+    """Enqueues a job recorded under its output-cache key, atomically.
+
+    Returns None, with nothing enqueued, if an identical request registered the key first.
+    """
+    if key is None:
+        return enqueue(command, **fields)
+    with transaction.atomic():
+        job = enqueue(command, **fields)
+        if output_cache.register(key, job, fingerprint):
+            return job
+        transaction.set_rollback(True)
+    return None
+
+def _cached_output_response(entry):
+    """Response for a request served from the output cache."""
+    output = Path(entry.outputs[0]).name if entry.outputs else ''
+    if entry.job_id is not None:
+        return {'task_id': str(entry.job_id), 'output': output, 'cached': True}
+    task_id = str(uuid.uuid4())
+    PROGRESS_CACHE[task_id] = {
+        'status': 'complete',
+        'percent': 100,
+        'msg': 'Already processed (cached result)',
+        'output': output,
+    }
+    return {'task_id': task_id, 'output': output, 'cached': True}
+
+def pipeline_api(request):
+    """Queues a pipeline: POST {"file": <library path>, "steps": [{"op": ..., "params": {...}}, ...]}.
+
+    Steps are fused into as few ffmpeg runs as possible (core/pipeline.py).
+    """
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'msg': "POST a pipeline."}, status=405)
+    try:
+        data = json.loads(request.body or b'{}')
+    except json.JSONDecodeError:
+        return JsonResponse({'status': 'error', 'msg': "Invalid JSON."}, status=400)
+
+    file_path_rel = data.get('file') or ''
+    input_path = (settings.MEDIA_ROOT / file_path_rel).resolve()
+    if not file_path_rel or not str(input_path).startswith(str(settings.MEDIA_ROOT.resolve())):
+        return JsonResponse({'status': 'error', 'msg': "Invalid file path."}, status=400)
+    if not input_path.is_file():
+        return JsonResponse({'status': 'error', 'msg': "File not found."}, status=404)
+
+    source = library.index_file(input_path)
+    defaults = library.command_defaults(source)
+    declared = data.get('steps')
+    if isinstance(declared, list):
+        # Parameters a step leaves out default to the source's values, as in the form.
+        # Those without a default stay missing, for load_steps to report.
+        filled = []
+        for item in declared:
+            compiled = COMMAND_REGISTRY.get(item['op']) if isinstance(item, dict) and isinstance(item.get('op'), str) else None
+            if compiled is not None and isinstance(item.get('params') or {}, dict):
+                item = {**item, 'params': {**{p: defaults[p] for p in compiled.parameters if p in defaults},
+                                           **(item.get('params') or {})}}
+            filled.append(item)
+        declared = filled
+    try:
+        steps = pipeline.load_steps(declared)
+        stages = pipeline.fuse(steps)
+    except pipeline.PipelineError as e:
+        return JsonResponse({'status': 'error', 'msg': str(e)}, status=400)
+
+    output_folder = settings.MEDIA_ROOT / "download"
+    output_folder.mkdir(parents=True, exist_ok=True)
+    timestamp = int(time.time())
+    last = steps[-1].key
+    if last == "split_segments":
+        output_path = output_folder / f"{input_path.stem}_{timestamp}_%03d.mp4"
+    else:
+        output_path = output_folder / f"{input_path.stem}_pipeline_{timestamp}{output_extension(last)}"
+
+    command = pipeline.plan(steps, input_path, output_path, output_folder)[-1]
+    job = enqueue(command, profile="|".join(step.key for step in steps), input_path=input_path,
+                  output_path=output_path, kind='pipeline',
+                  payload={'steps': [{'op': step.key, 'params': step.params} for step in steps],
+                           'outputs': [str(output_path)]})
+    return JsonResponse({
+        'task_id': str(job.id),
+        'output': output_path.name,
+        'stages': [[step.key for step in stage.steps] for stage in stages],
+    })
+
+def cancel_job(request, task_id):
+    """Cancels a queued or running processing job or download."""
+    if request.method == 'POST':
+        try:
+            # A job shared by identical requests keeps running while others wait on it
+            if output_cache.release(task_id):
+                return JsonResponse({'cancelled': True, 'shared': True})
+            cancelled = jobs.cancel_job(task_id) or downloads.cancel(task_id)
+        except (ValidationError, ValueError):
+            cancelled = False
+        return JsonResponse({'cancelled': cancelled})
     return redirect('index')
 
 def delete_video(request):
@@ -242,7 +606,11 @@ def delete_video(request):
                     return redirect('index')
 
                 if path.exists():
+                    rel_path = str(path.relative_to(settings.MEDIA_ROOT.resolve())).replace('\\', '/')
+                    # Requests that shared this output get it encoded again next time
+                    output_cache.forget_output(rel_path)
                     path.unlink()
+                    library.index_file(settings.MEDIA_ROOT / rel_path)  # Drops the index entry
                     messages.success(request, "File deleted.")
             except Exception as e:
                 messages.error(request, f"Delete failed: {str(e)}")
@@ -260,10 +628,168 @@ def add_custom_command(request):
             # logic: shlex.split to handle quotes
             try:
                 command_list = shlex.split(command_str)
-                save_custom_command(key, command_list, description)
+                missing = validate_command(command_list)
+                if missing:
+                    messages.error(request, f"Your FFmpeg build does not support: {', '.join(missing)}")
+                    return redirect('index')
+                save_custom_command(key, command_list, description, form.cleaned_data['target'])
                 messages.success(request, f"Command '{form.cleaned_data['name']}' added successfully!")
             except Exception as e:
                 messages.error(request, f"Failed to parse command: {e}")
         else:
              messages.error(request, "Invalid command form.")
     return redirect('index')
+
+
+# =========================
+# Library API
+# =========================
+
+def _library_etag(request):
+    """ETag for the whole index and this query.
+
+    There's deliberately no Last-Modified: deleting a file doesn't move
+    Max(updated_at), so If-Modified-Since would answer 304 with a stale list.
+    """
+    library.rescan()
+    state = MediaFile.objects.aggregate(count=Count('id'), last=Max('updated_at'))
+    # The count is part of the tag so that deletions change it
+    raw = f"{state['count']}:{state['last'].timestamp() if state['last'] else 0}:{request.GET.urlencode()}"
+    return hashlib.md5(raw.encode()).hexdigest()
+
+def _encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+def _decode_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    return json.loads(base64.urlsafe_b64decode(padded.encode()))
+
+def _int_param(request, name):
+    try:
+        return int(request.GET[name])
+    except (KeyError, ValueError):
+        return None
+
+@condition(etag_func=_library_etag)
+def library_api(request):
+    """Paginated, filterable media library listing.
+
+    Filters: source, codec, ext, min_size, max_size (bytes), q (name search).
+    Sort: see LIBRARY_SORTS. Paging: limit + the opaque next_cursor returned
+    by the previous page (keyset pagination, so deep pages stay cheap).
+    """
+    qs = MediaFile.objects.all()
+
+    source = request.GET.get('source')
+    if source:
+        qs = qs.filter(Q(source__iexact=source) | Q(folder=source))
+    codec = request.GET.get('codec')
+    if codec:
+        qs = qs.filter(Q(video_codec__iexact=codec) | Q(audio_codec__iexact=codec))
+    ext = request.GET.get('ext')
+    if ext:
+        qs = qs.filter(extension='.' + ext.lower().lstrip('.'))
+    min_size = _int_param(request, 'min_size')
+    if min_size is not None:
+        qs = qs.filter(size__gte=min_size)
+    max_size = _int_param(request, 'max_size')
+    if max_size is not None:
+        qs = qs.filter(size__lte=max_size)
+    query = request.GET.get('q', '').strip()
+    if query:
+        qs = qs.filter(name__icontains=query)
+
+    sort = LIBRARY_SORTS.get(request.GET.get('sort', 'name'))
+    if sort is None:
+        return JsonResponse({'status': 'error', 'msg': 'Unknown sort order.'}, status=400)
+    field = sort.lstrip('-')
+    descending = sort.startswith('-')
+    # Keyset paging can't step over NULLs, so unprobed files are left out of duration sorts
+    qs = qs.exclude(**{f'{field}__isnull': True}) if field == 'duration' else qs
+    qs = qs.order_by(sort, '-id' if descending else 'id')
+
+    cursor = request.GET.get('cursor')
+    if cursor:
+        try:
+            last_value, last_id = _decode_cursor(cursor)
+        except (ValueError, TypeError, binascii.Error):
+            return JsonResponse({'status': 'error', 'msg': 'Invalid cursor.'}, status=400)
+        op = 'lt' if descending else 'gt'
+        qs = qs.filter(Q(**{f'{field}__{op}': last_value}) | Q(**{field: last_value, f'id__{op}': last_id}))
+
+    limit = _int_param(request, 'limit') or LIBRARY_PAGE_SIZE
+    limit = max(1, min(limit, LIBRARY_MAX_PAGE_SIZE))
+    page = list(qs[:limit + 1])
+    has_more = len(page) > limit
+    page = page[:limit]
+
+    next_cursor = None
+    if has_more:
+        last = page[-1]
+        next_cursor = _encode_cursor([getattr(last, field), last.id])
+
+    return JsonResponse({
+        'results': [media_file_dict(e) for e in page],
+        'next_cursor': next_cursor,
+    })
+
+
+# =========================
+# Thumbnails
+# =========================
+
+THUMBNAIL_KINDS = {'poster.jpg': 'poster', 'sprite.jpg': 'sprite', 'sprite.json': 'sprite.json'}
+
+def thumbnail(request, fingerprint, kind):
+    """Serves a cached poster/sprite. Named by content fingerprint, so cacheable forever."""
+    if kind not in THUMBNAIL_KINDS or not re.fullmatch(r'[0-9a-f]{16,64}', fingerprint):
+        raise Http404()
+    path = thumbnails.thumb_path(fingerprint, THUMBNAIL_KINDS[kind])
+    if not path.exists():
+        # Not generated yet; the client shows its placeholder and retries on the next load
+        entry = MediaFile.objects.filter(fingerprint=fingerprint, has_video=True).first()
+        if entry is not None:
+            thumbnails.schedule(settings.MEDIA_ROOT / entry.path, fingerprint, entry.duration)
+        raise Http404()
+    response = FileResponse(open(path, 'rb'))
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+# =========================
+# Media delivery
+# =========================
+
+def serve_media(request, path):
+    """Files under MEDIA_URL, with byte ranges and conditional requests (see core/media.py)."""
+    response = media.serve(request, path, asgi=isinstance(request, ASGIRequest))
+    if request.method == 'GET' and response.status_code in (200, 206):
+        # Watched or downloaded files are the last to be evicted
+        storage.touch(path)
+    return response
+
+
+# =========================
+# Metrics
+# =========================
+
+def metrics_view(request):
+    """Prometheus metrics (see core/metrics.py). Set METRICS_TOKEN to require a bearer token."""
+    if not getattr(settings, 'METRICS_ENABLED', True):
+        raise Http404("Metrics are disabled")
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if token and not constant_time_compare(request.headers.get('Authorization', ''), f"Bearer {token}"):
+        return HttpResponse("Unauthorized", status=401, content_type="text/plain")
+    return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+# =========================
+# Tracing
+# =========================
+
+def job_trace(request, task_id):
+    """The phases of a job or download as JSON (see core/tracing.py)."""
+    trace = tracing.get_trace(task_id)
+    if trace is None:
+        return JsonResponse({'status': 'error', 'msg': "No trace for this task."}, status=404)
+    return JsonResponse(trace)
@@ -5,6 +5,11 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
+
+Serve the app through this module (e.g. `uvicorn video_project.asgi:application`)
+to get the Server-Sent Events progress stream at /progress-stream/; each open
+stream is a coroutine instead of a tied-up worker thread. Under WSGI the page
+falls back to polling /get-progress/<task_id>/.
 """
 
 import os
@@ -83,6 +83,8 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Job workers write from background threads; wait for locks instead of failing
+        'OPTIONS': {'timeout': 20},
     }
 }
 
@@ -126,8 +128,113 @@ STATICFILES_DIRS = [BASE_DIR / 'static']
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
+# Behind nginx or Apache, let the proxy send media files (core/media.py):
+# 'x-accel' (nginx; MEDIA_ACCEL_PREFIX must be an internal location aliased
+# to MEDIA_ROOT) or 'x-sendfile' (Apache mod_xsendfile / lighttpd)
+MEDIA_ACCEL = os.getenv('MEDIA_ACCEL') or None
+MEDIA_ACCEL_PREFIX = '/protected-media/'
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Background job queue (core/jobs.py)
+# Set JOB_WORKERS_IN_PROCESS=False and run `python manage.py run_workers` to
+# execute jobs in a dedicated process instead of inside the web server.
+# JOB_WORKERS is the most jobs that run at once; the scheduler starts fewer
+# when the machine is busy.
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', str(max((os.cpu_count() or 2) // 2, 2))))
+JOB_WORKERS_IN_PROCESS = os.getenv('JOB_WORKERS_IN_PROCESS', 'True') == 'True'
+JOB_MAX_ATTEMPTS = 2
+JOB_POLL_INTERVAL = 2.0
+# Seconds without a heartbeat before a running job on another host is considered dead
+JOB_STALE_AFTER = 60
+
+# Resource-aware scheduling (core/scheduler.py): jobs are admitted by cost class
+# (copy / light / heavy / gpu, learned per profile from past runs) against live
+# CPU load and free memory, and get a matching ffmpeg thread count and nice level.
+SCHEDULER_ENABLED = True
+SCHEDULER_CAPACITY = None  # cores to fill; None = all of them
+SCHEDULER_MAX_THREADS = 16  # encoders stop scaling well beyond this
+SCHEDULER_MEMORY_RESERVE_MB = 512
+SCHEDULER_GPU_SLOTS = 2  # concurrent hardware encodes (consumer NVENC allows only a few sessions)
+SCHEDULER_STARVATION_WAIT = 120  # seconds before a big job stops letting smaller ones go first
+SCHEDULER_NICE = {'copy': 0, 'light': 5, 'heavy': 10, 'gpu': 0}
+SCHEDULER_IONICE = {'copy': 4, 'light': 5, 'heavy': 7, 'gpu': 4}
+
+# Prometheus metrics at /metrics (core/metrics.py). Each process buffers its
+# series in memory and writes them to METRICS_PATH every METRICS_FLUSH_INTERVAL
+# seconds; a scrape merges every process. With METRICS_TOKEN set, scrapers must
+# send "Authorization: Bearer <token>".
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'True') == 'True'
+METRICS_PATH = BASE_DIR / '.cache' / 'metrics.sqlite3'
+METRICS_FLUSH_INTERVAL = 5
+METRICS_TOKEN = os.getenv('METRICS_TOKEN') or None
+
+# Per-task phase traces (GET /jobs/<id>/trace/): request, queue, probe, encode,
+# index and download phases with timings. The oldest spans are dropped past
+# TRACE_MAX_SPANS; TRACE_FFMPEG_BENCHMARK runs every ffmpeg with -benchmark to
+# add decode/encode CPU and per-stream fps (or pass benchmark=1 per request)
+TRACING_ENABLED = os.getenv('TRACING_ENABLED', 'True') == 'True'
+TRACE_MAX_SPANS = 50000
+TRACE_SPANS_PER_TASK = 200
+TRACE_FFMPEG_BENCHMARK = os.getenv('TRACE_FFMPEG_BENCHMARK', 'False') == 'True'
+
+# Media storage (core/storage.py): bytes allowed per media folder, past which
+# the least recently used files are deleted (files used in the last
+# STORAGE_MIN_IDLE seconds and inputs of pending jobs are kept). Quotas are
+# off unless set, e.g. STORAGE_QUOTA_DOWNLOAD_GB=50 in the environment or
+# STORAGE_QUOTAS = {'download': 50 * 1024 ** 3}. Partial outputs, temp dirs
+# and yt-dlp .part files untouched for STORAGE_ORPHAN_AGE seconds are deleted
+# either way; both run every STORAGE_SWEEP_INTERVAL seconds.
+STORAGE_QUOTAS = {
+    'download': int(float(os.getenv('STORAGE_QUOTA_DOWNLOAD_GB', '0')) * 1024 ** 3),
+}
+STORAGE_MIN_IDLE = 600
+STORAGE_ORPHAN_AGE = 24 * 3600
+STORAGE_SWEEP_INTERVAL = 300
+
+# Profile benchmarks (`manage.py bench_profiles`): run history and the saved
+# baseline that new runs are compared against
+BENCHMARK_DIR = BASE_DIR / 'benchmarks'
+
+# Task progress store (core/progress.py). 'sqlite' is shared by every worker
+# process; 'memory' only works with a single process.
+PROGRESS_STORE = {
+    'BACKEND': os.getenv('PROGRESS_BACKEND', 'sqlite'),
+    'PATH': BASE_DIR / '.cache' / 'progress.sqlite3',
+    'TTL': 3600,
+    'MAX_ENTRIES': 10000,
+    'FLUSH_INTERVAL': 0.5,
+}
+
+# Thumbnail / seek-preview sprite generation (core/thumbnails.py)
+THUMBNAIL_WORKERS = 2
+
+# Parallel chunked encoding (core/chunked.py): whole-file encodes of videos at
+# least this many seconds long are split at keyframes and encoded by several
+# ffmpeg processes. None disables it; WORKERS=None means one per 8 cores.
+CHUNKED_ENCODE_MIN_DURATION = 300
+CHUNKED_ENCODE_WORKERS = None
+
+# Pipelines: lossless intermediates between stages go here when it has room
+PIPELINE_TMPFS = '/dev/shm'
+
+# Copy source streams that already match a profile's declared target instead of
+# re-encoding them (core/stream_copy.py)
+STREAM_COPY_PLANNER = True
+
+# Uploads (core/uploads.py): unfinished resumable uploads are dropped after
+# UPLOAD_SESSION_TTL seconds; a job transcoding an upload as it arrives falls
+# back to the finished file if no data comes for UPLOAD_PIPE_STALL seconds
+UPLOAD_SESSION_TTL = 24 * 3600
+UPLOAD_PIPE_STALL = 30
+UPLOAD_MAX_SIZE = None
+
+# YouTube downloads (core/downloads.py): at most DOWNLOAD_WORKERS at once and
+# DOWNLOAD_PER_HOST from the same site; DOWNLOAD_FRAGMENTS DASH/HLS fragments
+# are fetched in parallel per download. Downloads run where the job workers do.
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', '3'))
+DOWNLOAD_PER_HOST = 2
+DOWNLOAD_FRAGMENTS = 4